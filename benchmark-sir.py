@@ -0,0 +1,53 @@
+"""
+Rough throughput numbers for the SIR engines in models.py, for a 730 day horizon in Australia.
+
+Run using:
+
+python benchmark-sir.py
+"""
+
+import timeit
+
+import data.constants as constants
+import models
+
+NUM_DAYS = constants.MAX_PREDICTION_DAYS
+
+
+def benchmark(name, func, num_runs=3, num_items=1, unit="runs"):
+    seconds = min(timeit.repeat(func, number=1, repeat=num_runs))
+    print(f"{name}: {seconds * 1000:.1f} ms, {num_items / seconds:,.0f} {unit}/second")
+
+
+if __name__ == "__main__":
+    australia = constants.OZ_STATES.loc["Australia"]
+
+    sir_model = models.SIRModel(
+        transmission_rate_per_contact=constants.TransmissionRatePerContact.default,
+        contact_rate=constants.AverageDailyContacts.default,
+        recovery_rate=constants.RecoveryRate.default,
+        normal_death_rate=constants.MortalityRate.default,
+        critical_death_rate=constants.CriticalDeathRate.default,
+        hospitalization_rate=constants.HospitalizationRate.default,
+        hospital_capacity=australia["Num Hospital Beds"],
+    )
+
+    initial_state = dict(
+        susceptible=australia["Population"] - 40000,
+        infected=40000,
+        recovered=0,
+        dead=0,
+        num_days=NUM_DAYS,
+    )
+
+    benchmark("Deterministic predict", lambda: sir_model.predict(**initial_state))
+
+    for num_replicates, num_processes in [(1000, 1), (10000, 1), (10000, 4)]:
+        benchmark(
+            f"Stochastic ensemble, {num_replicates} replicates on {num_processes} process(es)",
+            lambda: sir_model.predict_ensemble(
+                num_replicates=num_replicates, seed=0, num_processes=num_processes, **initial_state
+            ),
+            num_items=num_replicates,
+            unit="replicates",
+        )
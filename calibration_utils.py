@@ -0,0 +1,247 @@
+"""
+Calibration of the SIR transmission rate to the case history of each region.
+
+Every region's recent confirmed cases are compared with SIR runs started from the first day of the window, and the
+transmission rate per contact is fitted by a grid search that evaluates all candidate rates in one batched run of
+the SIR engine. Regions are spread over a process pool and the fitted parameters are stored next to the processed
+pickles, one CSV per dataset and snapshot.
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+import pandas as pd
+
+import data.constants as constants
+import models
+
+TIME_STAMP_FORMAT = '%d-%m-%Y-%H-%M-%S'
+
+# Days of history the transmission rate is fitted to. Recent days only, since distancing changes it over time.
+CALIBRATION_WINDOW = 21
+
+# Regions need at least this many confirmed cases at the start of the window to be calibrated
+MIN_CONFIRMED_CASES = 20
+
+MAX_TRANSMISSION_RATE_PER_CONTACT = 0.1
+
+# Calibration last read, filename -> (file version, DataFrame), see load_calibration
+_loaded_calibrations = {}
+
+
+def get_calibration_filename(timestamp, global_flag=False):
+
+    return os.path.join(
+        constants.PROCESSED_DIR,
+        "{}_calibration_{}.csv".format("global" if global_flag else "country", timestamp.strftime(TIME_STAMP_FORMAT)),
+    )
+
+
+def get_region_history(historical_data, region, num_days=CALIBRATION_WINDOW):
+    """
+    Get the last days of a region's case history.
+    :param historical_data: historical_country_data of a snapshot, indexed by region.
+    :param region: Country or state name.
+    :param num_days: Number of days to keep.
+    :return: Dict of column -> array with one entry per day, for Confirmed, Recovered and Deaths.
+    """
+
+    history = (
+        historical_data.loc[historical_data.index == region, ["Date", "Confirmed", "Recovered", "Deaths"]]
+        .groupby("Date")
+        .sum()
+        .sort_index()
+        .tail(num_days)
+        .fillna(0)
+    )
+
+    return {column: history[column].to_numpy(dtype=np.float64) for column in ["Confirmed", "Recovered", "Deaths"]}
+
+
+def fit_transmission_rate(history, population, hospital_capacity, num_candidates=32, num_rounds=4):
+    """
+    Fit the transmission rate per contact of one region to its confirmed cases, with the other constants at their
+    defaults.
+
+    Each round simulates num_candidates evenly spaced rates in one batch and narrows the range to the neighbours of
+    the best one. The loss is the mean squared error of log confirmed cases, where the model's confirmed cases are
+    the first day's plus the reported share of its new Total Cases.
+
+    :param history: Dict of Confirmed, Recovered and Deaths arrays, as returned by get_region_history.
+    :param population: Population of the region.
+    :param hospital_capacity: Hospital beds of the region.
+    :param num_candidates: Rates simulated per round.
+    :param num_rounds: Number of rounds.
+    :return: Dict with the fitted Transmission Rate Per Contact, its Loss and the Num Days fitted to. The rate and
+        loss are NaN if the region has too little history.
+    """
+
+    confirmed = history["Confirmed"]
+
+    if len(confirmed) < 7 or confirmed[0] < MIN_CONFIRMED_CASES or not population > 0:
+
+        return {"Transmission Rate Per Contact": np.nan, "Loss": np.nan, "Num Days": len(confirmed)}
+
+    infected = models.TrueInfectedCasesModel(constants.ReportingRate.default).predict(confirmed[0])
+    recovered, dead = history["Recovered"][0], history["Deaths"][0]
+
+    low, high = 0.0, MAX_TRANSMISSION_RATE_PER_CONTACT
+
+    for _ in range(num_rounds):
+
+        candidates = np.linspace(low, high, num_candidates)
+
+        predictions = models.integrate_sir(
+            susceptible=population - infected - recovered - dead,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=len(confirmed) - 1,
+            infection_rate=candidates * constants.AverageDailyContacts.default,
+            recovery_rate=constants.RecoveryRate.default,
+            normal_death_rate=constants.MortalityRate.default * constants.RecoveryRate.default,
+            critical_death_rate=constants.CriticalDeathRate.default * constants.RecoveryRate.default,
+            hospitalization_rate=constants.HospitalizationRate.default,
+            hospital_capacity=hospital_capacity,
+            rounded=False,
+        )
+
+        total_cases = predictions["Total Cases"]
+        predicted = confirmed[0] + constants.ReportingRate.default * (total_cases - total_cases[:, :1])
+
+        losses = np.mean((np.log1p(np.maximum(predicted, 0)) - np.log1p(confirmed)) ** 2, axis=1)
+
+        # E.g. missing beds or counts in the history, no rate can be fitted then
+        if np.all(np.isnan(losses)):
+
+            return {"Transmission Rate Per Contact": np.nan, "Loss": np.nan, "Num Days": len(confirmed)}
+
+        best = np.nanargmin(losses)
+        step = candidates[1] - candidates[0]
+        low, high = max(candidates[best] - step, 0.0), candidates[best] + step
+
+    return {"Transmission Rate Per Contact": candidates[best], "Loss": losses[best], "Num Days": len(confirmed)}
+
+
+def _fit_region(arguments):
+    # Module level so that process pools can pickle it
+    return fit_transmission_rate(*arguments)
+
+
+def calibrate_regions(data, num_days=CALIBRATION_WINDOW, num_processes=None):
+    """
+    Fit the transmission rate of every region of a snapshot, spread over a process pool.
+    :param data: Countries or Global snapshot.
+    :param num_days: Days of history to fit to.
+    :param num_processes: Number of worker processes, os.cpu_count() if None. 1 fits in this process.
+    :return: DataFrame indexed by Region with the columns of fit_transmission_rate.
+    """
+
+    print("Calibrating transmission rates")
+
+    regions = data.countries
+
+    arguments = [
+        (
+            get_region_history(data.historical_country_data, region, num_days),
+            data.country_data[region]["Population"],
+            data.country_data[region]["Num Hospital Beds"],
+        )
+        for region in regions
+    ]
+
+    if num_processes == 1:
+
+        fits = [_fit_region(x) for x in arguments]
+
+    else:
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+
+            fits = list(executor.map(_fit_region, arguments, chunksize=8))
+
+    return pd.DataFrame(fits, index=pd.Index(regions, name="Region"))
+
+
+def build_calibration(country_data, global_data, num_processes=None):
+    """
+    Calibrate both datasets of a snapshot and save the fitted parameters next to its pickles.
+    :param country_data: Countries snapshot.
+    :param global_data: Global snapshot with the same timestamp.
+    :param num_processes: See calibrate_regions.
+    :return: Filenames of the country and global calibrations.
+    """
+
+    fnames = []
+
+    for data, global_flag in ((country_data, False), (global_data, True)):
+
+        fname = get_calibration_filename(data.timestamp, global_flag)
+
+        calibrate_regions(data, num_processes=num_processes).to_csv(fname)
+
+        print("Saved calibration to:", fname)
+
+        fnames += [fname]
+
+    return fnames
+
+
+def load_calibration(timestamp, global_flag=False):
+    """
+    Read the calibration of a snapshot, again only when its file changes. Only the last one read is kept.
+    :param timestamp: Snapshot timestamp.
+    :param global_flag: Read the Global calibration instead of Countries.
+    :return: DataFrame indexed by Region, as returned by calibrate_regions. Shared, so it must not be modified.
+    """
+
+    fname = get_calibration_filename(timestamp, global_flag)
+
+    stat = os.stat(fname)
+
+    version = stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    loaded = _loaded_calibrations.get(fname)
+
+    if loaded is None or loaded[0] != version:
+
+        loaded = version, pd.read_csv(fname, index_col="Region")
+
+        _loaded_calibrations.clear()
+
+        _loaded_calibrations[fname] = loaded
+
+    return loaded[1]
+
+
+def get_transmission_rates(regions, timestamp, global_flag=False):
+    """
+    Get the calibrated transmission rates per contact of regions, with the default for those that couldn't be
+    calibrated.
+    :param regions: Country or state names.
+    :param timestamp: Snapshot timestamp.
+    :param global_flag: Look the regions up in the Global calibration instead of Countries.
+    :return: Array of transmission rates per contact, one per region.
+    """
+
+    try:
+
+        rates = load_calibration(timestamp, global_flag)["Transmission Rate Per Contact"].reindex(regions).to_numpy()
+
+    except FileNotFoundError:
+
+        # E.g. while the snapshot is still being built
+        print("No calibration for", timestamp)
+
+        rates = np.full(len(regions), np.nan)
+
+    return np.where(np.isnan(rates), constants.TransmissionRatePerContact.default, rates)
+
+
+def get_transmission_rate(region, timestamp, global_flag=False):
+    """
+    Get the calibrated transmission rate per contact of a region, see get_transmission_rates.
+    """
+
+    return float(get_transmission_rates([region], timestamp, global_flag)[0])
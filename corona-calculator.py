@@ -4,10 +4,12 @@ import warnings
 
 import streamlit as st
 
+import calibration_utils
 import data.io_utils as io_utils
 import data.utils as data_utils
 import graphing
 import models
+import scenario_utils
 import utils
 from data import constants
 from data.utils import check_if_aws_credentials_present, get_uk_death_mirror
@@ -37,7 +39,7 @@ class Sidebar:
         )
         self.country = country
 
-        transmission_probability = constants.TransmissionRatePerContact.default
+        transmission_probability = calibration_utils.get_transmission_rate(country, countries.timestamp)
         country_data = countries.country_data[country]
         date_last_fetched = countries.last_modified
 
@@ -112,7 +114,7 @@ class Sidebar:
             "3  months": 90,
             "6 months": 180,
             "12  months": 365,
-            "24 months": 730,
+            "24 months": constants.MAX_PREDICTION_DAYS,
         }
         _num_days_for_prediction = st.sidebar.radio(
             label="Time period for prediction",
@@ -169,6 +171,18 @@ def _fetch_global_data():
     return io_utils.load_data(global_flag=True)
 
 
+@st.cache
+def _get_max_contact_rate(country, region_data, num_days, transmission_rate):
+    """
+    Solved again only when the region's data, the number of days or its transmission rate change, not on every rerun
+    of the app
+    """
+
+    return scenario_utils.get_max_contact_rates(
+        {country: region_data}, [country], num_days, transmission_rates=transmission_rate
+    )[country]
+
+
 def run_app():
     ############################### Data Load ##################################
 
@@ -276,8 +290,6 @@ def run_app():
 
     num_hospital_beds = country_data["Num Hospital Beds"]
 
-    age_data = constants.AGE_DATA.loc[constants.AGE_DATA["State"] == country, :]
-
     st.subheader(f"How is the disease likely to spread in {country} in the next week?")
 
     # Estimate true cases
@@ -309,26 +321,43 @@ def run_app():
 
     ###################### SIR Model and Simulator ##############################
 
-    # Predict infection spread
-    sir_model = models.SIRModel(
-        transmission_rate_per_contact=constants.TransmissionRatePerContact.default,
-        contact_rate=sidebar.contact_rate,
-        recovery_rate=constants.RecoveryRate.default,
-        normal_death_rate=constants.MortalityRate.default,
-        critical_death_rate=constants.CriticalDeathRate.default,
-        hospitalization_rate=constants.HospitalizationRate.default,
-        hospital_capacity=num_hospital_beds,
-    )
+    # Fitted to the region's recent cases when the snapshot was built, like the scenario cube
+    transmission_rate = calibration_utils.get_transmission_rate(country, countries.timestamp)
 
-    df = models.get_predictions(
-        cases_estimator=true_cases_estimator,
-        sir_model=sir_model,
-        num_diagnosed=number_cases_confirmed,
-        num_recovered=country_data["Recovered"],
-        num_deaths=country_data["Deaths"],
-        area_population=population,
-        max_days=sidebar.num_days_for_prediction
-    )
+    try:
+
+        # Precomputed for every region and slider position when the snapshot was fetched
+        df = scenario_utils.get_predictions(
+            country, sidebar.contact_rate, sidebar.num_days_for_prediction, countries.timestamp
+        )
+
+    except Exception as exc:
+
+        print("Scenario cube unavailable, running simulation", exc)
+
+        # Predict infection spread
+        sir_model = models.SIRModel(
+            transmission_rate_per_contact=transmission_rate,
+            contact_rate=sidebar.contact_rate,
+            recovery_rate=constants.RecoveryRate.default,
+            normal_death_rate=constants.MortalityRate.default,
+            critical_death_rate=constants.CriticalDeathRate.default,
+            hospitalization_rate=constants.HospitalizationRate.default,
+            hospital_capacity=num_hospital_beds,
+        )
+
+        df = models.get_predictions(
+            cases_estimator=true_cases_estimator,
+            sir_model=sir_model,
+            num_diagnosed=number_cases_confirmed,
+            num_recovered=country_data["Recovered"],
+            num_deaths=country_data["Deaths"],
+            area_population=population,
+            max_days=sidebar.num_days_for_prediction,
+            early_stop=True,
+            region=country,
+            timestamp=countries.timestamp,
+        )
 
     st.subheader("How will my actions affect the spread?")
 
@@ -336,9 +365,9 @@ def run_app():
         "**Use the slider in the sidebar to see how this changes the dynamics of disease spread**"
     )
 
-    df_base = df[~df.Status.isin(["Need Hospitalization", "Recovered", "Susceptible"])]
+    y_max = max(df[status].max() for status in ["Infected", "Dead", "Total Cases"])
 
-    base_graph = graphing.infection_graph(df_base, df_base.Forecast.max(), population * 0.5, population * 0.75)
+    base_graph = graphing.infection_graph(df, y_max, population * 0.5, population * 0.75)
     # st.warning(graph_warning)
     st.write(base_graph)
 
@@ -356,7 +385,7 @@ def run_app():
         "are probably already in use for people sick for other reasons."
     )
 
-    peak_occupancy = df.loc[df.Status == "Need Hospitalization"]["Forecast"].max()
+    peak_occupancy = df["Need Hospitalization"].max()
 
     percent_beds_at_peak = min(100 * num_hospital_beds / peak_occupancy, 100)
 
@@ -371,13 +400,30 @@ def run_app():
         f" people who need a bed in hospital might not have access given historical resources of {country}."
     )
 
+    try:
+
+        max_contact_rate = _get_max_contact_rate(
+            country, countries.country_data[country], sidebar.num_days_for_prediction, transmission_rate
+        )
+
+        if constants.AverageDailyContacts.min <= max_contact_rate < constants.AverageDailyContacts.max:
+
+            st.markdown(
+                f"Keeping daily contacts at or below **{max_contact_rate:.1f}** would keep the people who need a "
+                f"hospital bed within the beds of {country}."
+            )
+
+    except ValueError as exc:
+
+        print(exc)
+
     ###################### Death Charts ##############################
 
     st.subheader("How severe will the impact be?")
 
-    num_dead = df[df.Status == "Dead"].Forecast.iloc[-1]
+    num_dead = df["Dead"][-1]
 
-    num_recovered = df[df.Status == "Recovered"].Forecast.iloc[-1]
+    num_recovered = df["Recovered"][-1]
 
     glob_hist = global_data.historical_country_data
 
@@ -386,7 +432,7 @@ def run_app():
 
     uk_death_mirror = get_uk_death_mirror(uk_data, country_data["Deaths"])
 
-    death_plot = graphing.plot_death_timeseries(df[df.Status == "Dead"], uk_death_mirror, country_name=country)
+    death_plot = graphing.plot_death_timeseries(df.to_frame("Dead"), uk_death_mirror, country_name=country)
 
     st.markdown(
         f"If the average person in {country} adopts the selected behavior, we estimate that **{int(num_dead):,}** "
@@ -397,7 +443,7 @@ def run_app():
         f"This graph illustrates predicted deaths."
     )
 
-    outcomes_by_age_group = models.get_status_by_age_group(num_dead, num_recovered, age_data)
+    outcomes_by_age_group = models.get_status_by_age_group(num_dead, num_recovered, country)
 
     fig = graphing.age_segregated_mortality(
         outcomes_by_age_group.loc[:, ["Dead"]]
@@ -12,6 +12,12 @@ from data.preprocessing import preprocess_bed_data
 
 FORECAST_HORIZON = 7
 
+# Forecaster used for the FORECAST_HORIZON forecasts, "prophet" or the faster "numpy", see forecast_utils.FORECASTERS
+FORECAST_BACKEND = os.environ.get("FORECAST_BACKEND", "prophet")
+
+# Longest time period offered for SIR predictions in the sidebar
+MAX_PREDICTION_DAYS = 730
+
 READABLE_DATESTRING_FORMAT = "%A %d %B %Y, %H:%M %Z"
 S3_ACCESS_KEY = os.environ.get("AWSAccessKeyId", "").replace("\r", "")
 S3_SECRET_KEY = os.environ.get("AWSSecretKey", "").replace("\r", "")
@@ -36,8 +42,32 @@ PROCESSED_DIR = os.path.join("data", "processed")
 
 CONTACT_US_DIR = os.path.join("data", "contact-us")
 
+ARCHIVE_DIR = os.path.join("data", "archive")
+
+# Lists the retained snapshots and their files, see data/retention_utils.py
+MANIFEST_PATH = os.path.join(PROCESSED_DIR, "manifest.json")
+
 STALE_LIMIT = 3600
 
+# Unpickled snapshots kept in memory by io_utils.load_data. Each snapshot is a Countries and a Global object.
+SNAPSHOT_CACHE_SIZE = int(os.environ.get("SNAPSHOT_CACHE_SIZE", 4))
+
+# Worker processes used to fit the forecasting models of all regions
+NUM_BUILD_PROCESSES = int(os.environ.get("NUM_BUILD_PROCESSES", os.cpu_count() or 1))
+
+# Memory budget, in bytes of their arrays and frames, of the forecasting models kept loaded between page views
+MODEL_CACHE_BYTES = int(os.environ.get("MODEL_CACHE_BYTES", 256 * 2 ** 20))
+
+# Deflate saved forecasting models, see prophet_utils.save_parameters
+COMPRESS_MODELS = True
+
+# Snapshots kept by data/retention_utils.py: the latest few, plus the last one of each of the latest days
+RETAIN_SNAPSHOTS = int(os.environ.get("RETAIN_SNAPSHOTS", 3))
+RETAIN_DAILY_CHECKPOINTS = int(os.environ.get("RETAIN_DAILY_CHECKPOINTS", 14))
+
+# Move expired snapshots to ARCHIVE_DIR instead of deleting them
+ARCHIVE_EXPIRED = os.environ.get("ARCHIVE_EXPIRED", "") == "1"
+
 OZ_STATES = pd.DataFrame([{'Province/State': 'New South Wales', 'Population': 7317500, 'Num Hospital Beds': 28391},
                           {'Province/State': 'Victoria', 'Population': 5640900, 'Num Hospital Beds': 20025},
                           {'Province/State': 'Queensland', 'Population': 4599400, 'Num Hospital Beds': 17063},
@@ -63,6 +93,9 @@ SIR model constants
 
 class RecoveryRate:
     default = 1 / 10  # Recovery period around 10 days
+    # Recovery periods reported range from about a week to two weeks
+    min = 1 / 14
+    max = 1 / 7
 
 
 class MortalityRate:
@@ -77,12 +110,16 @@ class CriticalDeathRate:
     # This is the max reported from Wuhan:
     # https://wwwnc.cdc.gov/eid/article/26/6/20-0233_article
     default = 0.122
+    min = 0.05
+    max = 0.2
 
 
 class TransmissionRatePerContact:
     # Probability of a contact between carrier and susceptible leading to infection.
     # Found using binomial distribution in Wuhan scenario: 14 contacts per day, 10 infectious days, 2.5 average people infected.
     default = 0.018
+    min = 0.01
+    max = 0.03
 
 
 class AverageDailyContacts:
@@ -91,6 +128,12 @@ class AverageDailyContacts:
     default = 15
 
 
+class InterstateTravelRate:
+    # Share of a state's residents travelling to another state on a given day, used to couple the states when no
+    # mobility data is given. A rough assumption rather than a measured figure.
+    default = 0.002
+
+
 class AsymptomaticRate:
     # Proportion of true cases showing no symptoms
     # The number comes from a study led on passengers of the Diamond Princess Cruise, in Japan
@@ -107,9 +150,13 @@ Health care constants
 class ReportingRate:
     # Proportion of true cases diagnosed
     default = 0.14
+    min = 0.05
+    max = 0.3
 
 
 class HospitalizationRate:
     # Cases requiring hospitalization. We multiply by the ascertainment rate because our source got their estimate
     # from the reported cases, whereas we will be using it with total cases.
     default = 0.19 * ReportingRate.default
+    min = 0.1 * ReportingRate.default
+    max = 0.25 * ReportingRate.default
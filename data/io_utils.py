@@ -1,29 +1,33 @@
-import datetime, os, sys, pandas as pd, numpy as np, glob, re, pickle
+import datetime, os, sys, pandas as pd, numpy as np, glob, re, pickle, json, hashlib, threading, time, collections, tempfile
 from data.countries import Countries, Global
 import data.constants as constants
 
 TIME_STAMP_FORMAT = '%d-%m-%Y-%H-%M-%S'
 
+# Manifest as last read, with the version of the file it was read from, see get_manifest
+_manifest_cache = {"version": None, "manifest": {"snapshots": {}}}
+
+# Serialises read-modify-write updates of the manifest within a process
+_manifest_lock = threading.Lock()
+
 
 def check_staleness():
     
     timestamp = datetime.datetime.utcnow()
     
-    fnames = glob.glob(os.path.join(constants.PROCESSED_DIR,"country_data_*.pickle"))
-    
-    if len(fnames) < 1:
+    try:
+        
+        latest_ts = get_latest_timestamp()
         
+    except ValueError:
+        
+        # No snapshot yet
         return True
     
-    latest_ts = get_latest_timestamp(fnames)
-    
-    latest_fname = os.path.join(constants.PROCESSED_DIR,"country_data_{}.pickle".format(latest_ts.strftime(TIME_STAMP_FORMAT)))
-    
-    latest_ts = datetime.datetime.strptime(re.search("country_data_(.*).pickle$", latest_fname).group(1),TIME_STAMP_FORMAT)
-    
     delta = timestamp - latest_ts
     
-    return delta.seconds >= constants.STALE_LIMIT
+    # total_seconds, since seconds leaves out whole days
+    return delta.total_seconds() >= constants.STALE_LIMIT
 
 
 def fetch_data():
@@ -44,13 +48,28 @@ def fetch_data():
     with open(global_fname, 'wb') as handle:
         
         pickle.dump(global_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    # Point readers at the new snapshot only once both pickles are complete
+    register_snapshot(timestamp, [filename, global_fname],
+                      durations={"fetch": (datetime.datetime.utcnow() - timestamp).total_seconds()}, latest=True)
         
     return filename, global_fname
 
 
 def get_latest_timestamp(fnames=None):
+    """
+    :param fnames: Snapshot pickles to pick the latest of. If None, the latest snapshot of the manifest, or of the
+        pickles in PROCESSED_DIR if the manifest doesn't have one yet.
+    """
     
     if fnames==None:
+        
+        latest = get_manifest().get("latest")
+        
+        if latest is not None:
+            
+            return datetime.datetime.strptime(latest, TIME_STAMP_FORMAT)
+        
         fnames = glob.glob(os.path.join(constants.PROCESSED_DIR, "country_data_*.pickle"))
     
     timestamps = []
@@ -70,11 +89,93 @@ def get_latest_timestamp(fnames=None):
     return max(timestamps)
 
 
-def load_data(global_flag=False):
+class SnapshotCache:
+    """
+    Process-wide, thread-safe LRU cache of unpickled snapshots, keyed by filename and file version, so that a pickle
+    written again is loaded again. Every caller gets the same shared object: copy before modifying any of it.
+    """
+    
+    def __init__(self, max_size=constants.SNAPSHOT_CACHE_SIZE):
+        """
+        :param max_size: Max number of snapshots, the least recently used one is evicted beyond it.
+        """
+        
+        self.max_size = max_size
+        
+        self.hits = 0
+        
+        self.misses = 0
+        
+        self.load_seconds = 0.0
+        
+        self._entries = collections.OrderedDict()
+        
+        self._lock = threading.Lock()
+    
+    def load(self, fname):
+        
+        key = (fname,) + get_file_version(fname)
+        
+        # Held while unpickling too, so concurrent first requests load a snapshot only once
+        with self._lock:
+            
+            if key in self._entries:
+                
+                self._entries.move_to_end(key)
+                
+                self.hits += 1
+                
+                return self._entries[key]
+            
+            self.misses += 1
+            
+            start = time.perf_counter()
+            
+            with open(fname, 'rb') as handle:
+                
+                data = pickle.load(handle)
+            
+            self.load_seconds += time.perf_counter() - start
+            
+            self._entries[key] = data
+            
+            while len(self._entries) > self.max_size:
+                
+                self._entries.popitem(last=False)
+            
+            return data
     
-    country_fnames = glob.glob(os.path.join(constants.PROCESSED_DIR,"country_data_*.pickle"))
+    def clear(self):
+        
+        with self._lock:
+            
+            self._entries.clear()
+            
+            self.hits = 0
+            
+            self.misses = 0
+            
+            self.load_seconds = 0.0
+    
+    def stats(self):
+        
+        with self._lock:
+            
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                    "load_seconds": self.load_seconds}
+
+
+SNAPSHOT_CACHE = SnapshotCache()
+
+
+def load_data(global_flag=False, cache=SNAPSHOT_CACHE):
+    """
+    :param global_flag: Load the Global snapshot instead of Countries.
+    :param cache: SnapshotCache to load through, or None to always unpickle a private copy.
+    :return: Latest snapshot. Shared with other callers when cached, so it must not be modified.
+    """
     
-    timestamp = get_latest_timestamp(country_fnames)
+    timestamp = get_latest_timestamp()
     
     if global_flag:
         
@@ -86,8 +187,151 @@ def load_data(global_flag=False):
         latest_filename = os.path.join(constants.PROCESSED_DIR,
                                        "country_data_{}.pickle".format(str(timestamp.strftime(TIME_STAMP_FORMAT))))
     
+    if cache is not None:
+        
+        return cache.load(latest_filename)
+    
     with open(latest_filename, 'rb') as handle:
         
         data = pickle.load(handle)
     
     return data
+
+
+def get_manifest():
+    """
+    The manifest, read again only when its file changes, so resolving the latest snapshot is one stat.
+    """
+    
+    try:
+        
+        version = get_file_version(constants.MANIFEST_PATH)
+        
+    except FileNotFoundError:
+        
+        return {"snapshots": {}}
+    
+    if version != _manifest_cache["version"]:
+        
+        _manifest_cache["manifest"] = read_manifest()
+        
+        _manifest_cache["version"] = version
+    
+    return _manifest_cache["manifest"]
+
+
+def get_file_version(fname):
+    """
+    Tell apart versions of a file, including two written within the resolution of mtimes: a file replaced by a rename
+    has another inode, and one written again in place usually has another size.
+    :return: Inode, mtime and size of the file.
+    """
+    
+    stat = os.stat(fname)
+    
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_manifest():
+    
+    try:
+        
+        with open(constants.MANIFEST_PATH, 'r') as handle:
+            
+            return json.load(handle)
+        
+    except FileNotFoundError:
+        
+        return {"snapshots": {}}
+
+
+def write_manifest(manifest):
+    
+    # Replaced in one rename, so readers see either the old manifest or the new one. The temporary file has a unique
+    # name in the same directory, so concurrent writers don't write into each other's file
+    fd, tmp_fname = tempfile.mkstemp(
+        prefix=os.path.basename(constants.MANIFEST_PATH) + ".", suffix=".tmp",
+        dir=os.path.dirname(constants.MANIFEST_PATH)
+    )
+    
+    try:
+        
+        with os.fdopen(fd, 'w') as handle:
+            
+            json.dump(manifest, handle, indent=1, sort_keys=True)
+        
+        os.replace(tmp_fname, constants.MANIFEST_PATH)
+        
+    except BaseException:
+        
+        if os.path.exists(tmp_fname):
+            
+            os.remove(tmp_fname)
+        
+        raise
+
+
+def update_manifest(fn):
+    """
+    Read, modify and write the manifest as one update, so concurrent updates within a process don't lose each other.
+    :param fn: Function modifying the manifest dict it's given in place.
+    :return: The written manifest.
+    """
+    
+    with _manifest_lock:
+        
+        manifest = read_manifest()
+        
+        fn(manifest)
+        
+        write_manifest(manifest)
+    
+    return manifest
+
+
+def get_file_hash(fname):
+    
+    digest = hashlib.sha1()
+    
+    with open(fname, 'rb') as handle:
+        
+        for chunk in iter(lambda: handle.read(2 ** 20), b""):
+            
+            digest.update(chunk)
+    
+    return digest.hexdigest()
+
+
+def register_snapshot(timestamp, fnames=(), durations=None, latest=False, replaced=()):
+    """
+    Record files and build steps of a snapshot in the manifest.
+    :param timestamp: Snapshot timestamp.
+    :param fnames: Files of the snapshot, recorded with their content hashes.
+    :param durations: Dict of build step -> seconds it took.
+    :param latest: Make this the latest snapshot, the one every reader resolves to.
+    :param replaced: Files of the snapshot that fnames replace, dropped from the manifest.
+    """
+    
+    suffix = timestamp.strftime(TIME_STAMP_FORMAT)
+    
+    hashes = {fname: get_file_hash(fname) for fname in fnames}
+    
+    def update(manifest):
+        
+        entry = manifest.setdefault("snapshots", {}).setdefault(suffix, {})
+        
+        entry["files"] = sorted((set(entry.get("files", [])) - set(replaced)) | set(fnames))
+        
+        entry["hashes"] = {
+            fname: digest for fname, digest in entry.get("hashes", {}).items() if fname not in replaced
+        }
+        
+        entry["hashes"].update(hashes)
+        
+        entry.setdefault("durations", {}).update(durations or {})
+        
+        if latest:
+            
+            manifest["latest"] = suffix
+    
+    update_manifest(update)
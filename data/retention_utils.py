@@ -0,0 +1,175 @@
+"""
+Retention of the timestamped files every refresh leaves in data/processed, data/models and data/outputs.
+
+Each file of a snapshot has the snapshot's timestamp in its name, so files are grouped by it whatever produced them.
+The latest RETAIN_SNAPSHOTS snapshots are kept, plus the last snapshot of each of the latest RETAIN_DAILY_CHECKPOINTS
+days. The others are expired: their files are deleted, or moved to the snapshot's directory under ARCHIVE_DIR. The
+data directories may be separate mounts, so files are moved with shutil.move, which copies across filesystems. A
+snapshot is only dropped from the manifest once all of its files are gone, so a failed expiry is retried by the next
+refresh instead of leaving untracked files behind.
+"""
+
+import datetime
+import os
+import re
+import shutil
+
+import data.constants as constants
+import data.io_utils as io_utils
+
+TIME_STAMP_FORMAT = '%d-%m-%Y-%H-%M-%S'
+
+TIME_STAMP_PATTERN = re.compile(r"\d{2}-\d{2}-\d{4}-\d{2}-\d{2}-\d{2}")
+
+
+def get_snapshot_dirs():
+
+    return [constants.PROCESSED_DIR, constants.MODELS_DIR, constants.OUTPUTS_DIR]
+
+
+def get_snapshot_files():
+    """
+    :return: Dict of snapshot timestamp -> list of its filenames.
+    """
+
+    files = {}
+
+    for directory in get_snapshot_dirs():
+
+        for name in os.listdir(directory):
+
+            match = TIME_STAMP_PATTERN.search(name)
+
+            # Files still being written are renamed into place when complete
+            if match is None or name.endswith(".tmp"):
+                continue
+
+            try:
+                timestamp = datetime.datetime.strptime(match.group(0), TIME_STAMP_FORMAT)
+            except ValueError:
+                continue
+
+            files.setdefault(timestamp, []).append(os.path.join(directory, name))
+
+    return files
+
+
+def select_retained(timestamps, num_latest=constants.RETAIN_SNAPSHOTS, num_days=constants.RETAIN_DAILY_CHECKPOINTS):
+    """
+    :param timestamps: Snapshot timestamps.
+    :param num_latest: Number of latest snapshots to keep.
+    :param num_days: Number of latest days to keep the last snapshot of.
+    :return: Set of the timestamps to keep and set of the daily checkpoints among them.
+    """
+
+    timestamps = sorted(timestamps, reverse=True)
+
+    checkpoints = {}
+
+    for timestamp in timestamps:
+        checkpoints.setdefault(timestamp.date(), timestamp)
+
+    checkpoints = {checkpoints[day] for day in sorted(checkpoints, reverse=True)[:num_days]}
+
+    return set(timestamps[:max(num_latest, 1)]) | checkpoints, checkpoints
+
+
+def expire_snapshot(timestamp, fnames, archive=constants.ARCHIVE_EXPIRED):
+    """
+    Archive or delete the files of a snapshot.
+    :param timestamp: Snapshot timestamp.
+    :param fnames: Filenames of the snapshot.
+    :param archive: Keep the files in ARCHIVE_DIR/<timestamp> instead of deleting them.
+    :return: Filenames that couldn't be expired.
+    """
+
+    archive_dir = os.path.join(constants.ARCHIVE_DIR, timestamp.strftime(TIME_STAMP_FORMAT))
+
+    remaining = []
+
+    for fname in fnames:
+
+        try:
+
+            if archive:
+
+                # Keep the data/<directory> layout, since the same name could appear in more than one of them
+                target_dir = os.path.join(archive_dir, os.path.basename(os.path.dirname(fname)))
+
+                os.makedirs(target_dir, exist_ok=True)
+
+                # Replaces a copy left by an earlier attempt that failed halfway
+                shutil.move(fname, os.path.join(target_dir, os.path.basename(fname)))
+
+            else:
+
+                os.remove(fname)
+
+        except FileNotFoundError:
+
+            continue
+
+        except Exception as exc:
+
+            print("Error in expiring", fname, exc)
+
+            remaining.append(fname)
+
+    return remaining
+
+
+def apply_retention(num_latest=constants.RETAIN_SNAPSHOTS, num_days=constants.RETAIN_DAILY_CHECKPOINTS,
+                    archive=constants.ARCHIVE_EXPIRED):
+    """
+    Expire the snapshots outside the retention policy and record the ones left in the manifest.
+    :param num_latest: Number of latest snapshots to keep.
+    :param num_days: Number of latest days to keep the last snapshot of.
+    :param archive: Move expired snapshots to ARCHIVE_DIR instead of deleting them.
+    :return: Timestamps of the expired snapshots.
+    """
+
+    files = get_snapshot_files()
+
+    retained, checkpoints = select_retained(files, num_latest, num_days)
+
+    expired = []
+
+    for timestamp in sorted(set(files) - retained):
+
+        remaining = expire_snapshot(timestamp, files[timestamp], archive)
+
+        if remaining:
+
+            # Still tracked, so that the next refresh tries again
+            files[timestamp] = remaining
+
+        else:
+
+            expired.append(timestamp)
+
+            del files[timestamp]
+
+    def update(manifest):
+
+        snapshots = manifest.get("snapshots", {})
+
+        manifest["snapshots"] = {}
+
+        for timestamp in sorted(files):
+
+            suffix = timestamp.strftime(TIME_STAMP_FORMAT)
+
+            entry = snapshots.get(suffix, {})
+
+            entry.update({"files": sorted(files[timestamp]), "checkpoint": timestamp in checkpoints})
+
+            manifest["snapshots"][suffix] = entry
+
+        manifest["retention"] = {"num_latest": num_latest, "num_days": num_days, "archive": archive}
+
+    io_utils.update_manifest(update)
+
+    print("Retained {} snapshots, {} {} snapshots".format(len(retained), "archived" if archive else "deleted",
+                                                          len(expired)))
+
+    return expired
@@ -1,15 +1,31 @@
-import pandas as pd, numpy as np, os, sys, re, joblib
+import collections, concurrent.futures, datetime, hashlib, json, shutil, tempfile, threading, time
 
-try:
-    from fbprophet import Prophet
-except Exception as exp:
-    print(exp)
+import pandas as pd, numpy as np, os, sys, re, joblib
+import scipy.stats
 
 import data.io_utils as io_utils
 import data.constants as constants
+import data.retention_utils as retention_utils
+import calibration_utils
+import prophet_utils
+import scenario_utils
 
 TIME_STAMP_FORMAT = '%d-%m-%Y-%H-%M-%S'
 
+# Upper bound on any forecast of cumulative cases
+WORLD_POPULATION = 8e9
+
+# Columns of every forecast frame besides date, as stored in the forecast store
+FORECAST_COLUMNS = ["confirmed", "lower_bound", "upper_bound"]
+
+_loaded_stores = {}
+
+# Serialises read-modify-write updates of the forecast store by on demand forecasts
+_store_lock = threading.Lock()
+
+# Previous snapshot and unchanged regions of the current snapshot, see get_unchanged_regions
+_unchanged_regions = {}
+
 def prepare_data(df, log_flag = True):
     
     print("Running data prep for model build- Log transform?:", log_flag)
@@ -39,6 +55,9 @@ def prepare_data(df, log_flag = True):
 
 def fit_model(historical_data):
     
+    # Imported here rather than at startup, since it is slow and the NumPy backend doesn't need it
+    from fbprophet import Prophet
+    
     m = Prophet(interval_width=0.95, daily_seasonality=True)
 
     m.fit(historical_data)
@@ -127,84 +146,458 @@ def get_forecasts(country, horizon=7):
         
         build_all_models()
         
-        forecast(horizon=horizon)
-        
     try:
         
         forecasted_data = read_forecast(country)
         
     except:
         
-        #Force rebuild ignoring stale check
-        
+        # Forecast only this region, the first time it is asked for in a snapshot
         try:
             
-            print("Force building models, ignored staleness")
-            
-            build_all_models()
+            forecasted_data = forecast_region(country, horizon=horizon)
         
-            forecast(horizon=horizon)
+        except:
             
-            forecasted_data = read_forecast(country)
+            #Force rebuild ignoring stale check
             
-        except Exception as exc:
-            print("Error in getting forecasts", exc)
+            try:
+                
+                print("Force building models, ignored staleness")
+                
+                build_all_models()
+            
+                forecasted_data = forecast_region(country, horizon=horizon)
+                
+            except Exception as exc:
+                print("Error in getting forecasts", exc)
             
     
     return forecasted_data
 
-def forecast(country_data=None, horizon=7):
+def forecast_region(country, country_data=None, horizon=7, backend=constants.FORECAST_BACKEND):
+    """
+    Forecast one region and add it to the forecast store of its snapshot, loading only that region's models.
+    :param country: Region name.
+    :param country_data: Countries snapshot, the latest one if None.
+    :param horizon: Number of days to forecast.
+    :param backend: Name of the forecaster in FORECASTERS.
+    :return: DataFrame with date, confirmed, lower_bound and upper_bound columns, as read_forecast returns.
+    """
     
-    if country_data==None:
+    if country_data is None:
         
         country_data = io_utils.load_data()
     
-    for country in country_data.countries:
+    start = time.perf_counter()
+    
+    forecasts = get_carried_over_forecasts(country_data, [country], backend, horizon)
+    
+    if country in forecasts.get("forecast", {}):
         
-        try:
+        print("Carried over forecast of unchanged region {}".format(country))
+        
+    else:
+        
+        print("Forecasting {} on demand".format(country))
+        
+        forecasts = get_forecaster(backend).forecast(country_data, horizon=horizon, regions=[country])
+    
+    add_to_forecast_store(forecasts, country_data.timestamp, backend, horizon)
+    
+    # Per request, so only printed, the manifest keeps the durations of build steps
+    print("Forecast {} in {:.2f}s".format(country, time.perf_counter() - start))
+    
+    return read_forecast(country, country_data.timestamp)
 
-            model_log = load_model(country, country_data.timestamp, log_flag=True)
-            
-            model_linear = load_model(country, country_data.timestamp, log_flag=False)
+def get_carried_over_forecasts(country_data, regions, backend=constants.FORECAST_BACKEND, horizon=7):
+    """
+    Get the previous snapshot's forecasts of the regions whose history hasn't changed since, when they were made by
+    the same backend and horizon.
+    :param country_data: Countries snapshot.
+    :param regions: Regions to look for.
+    :param backend: Name of the forecaster.
+    :param horizon: Number of days forecast.
+    :return: Dict of variant -> dict of region -> DataFrame, like the forecasters return. Only regions with a
+        "forecast" variant are carried over.
+    """
+    
+    forecasts = {}
+    
+    previous_timestamp, unchanged = get_unchanged_regions(country_data)
+    
+    unchanged = [country for country in unchanged if country in regions]
+    
+    if not unchanged:
+        
+        return forecasts
+    
+    try:
+        
+        previous_store, previous_index = load_forecast_store(previous_timestamp)
+        
+        # Forecasts of another backend or horizon aren't interchangeable with this one's
+        if previous_index["backend"] != backend or previous_index["horizon"] != horizon:
             
-        except:
+            return forecasts
+        
+        for country in unchanged:
             
-            try:
-                #if any model is not present/unreadable force rebuild with the same time stamp
-                print("Force rebuilding model for {}".format(country))
-
-                build_model(country, log_flag=True)
+            if country not in previous_index["days"].get("forecast", {}):
                 
-                build_model(country, log_flag=False)
+                continue
+            
+            for variant in previous_index["variants"]:
                 
-                model_log = load_model(country, country_data.timestamp, log_flag=True)
+                if country in previous_index["days"][variant]:
+                    
+                    forecasts.setdefault(variant, {})[country] = read_forecast(country, previous_timestamp, variant)
+        
+    except Exception as exc:
+        
+        print("No forecasts to carry over", exc)
+    
+    return forecasts
+
+def forecast(country_data=None, horizon=7, backend=constants.FORECAST_BACKEND, incremental=True):
+    """
+    Forecast confirmed cases of every region and save them in the forecast store read by read_forecast.
+    :param country_data: Countries snapshot, the latest one if None.
+    :param horizon: Number of days to forecast.
+    :param backend: Name of the forecaster in FORECASTERS.
+    :param incremental: Carry over the predictions of regions whose history hasn't changed since the previous
+        snapshot, instead of forecasting them again.
+    """
+    
+    if country_data==None:
+        
+        country_data = io_utils.load_data()
+    
+    start = time.perf_counter()
+    
+    regions = country_data.countries
+    
+    carried_over = get_carried_over_forecasts(country_data, regions, backend, horizon) if incremental else {}
+    
+    print("Carried over predictions of {} unchanged regions".format(len(carried_over.get("forecast", {}))))
+    
+    regions = [country for country in regions if country not in carried_over.get("forecast", {})]
+    
+    # Nothing to forecast when every region is carried over
+    forecasts = get_forecaster(backend).forecast(country_data, horizon=horizon, regions=regions) if regions else {}
+    
+    for variant, frames in carried_over.items():
+        
+        forecasts.setdefault(variant, {}).update(frames)
+    
+    write_forecast_store(forecasts, country_data.timestamp, backend, horizon)
+    
+    io_utils.register_snapshot(country_data.timestamp, durations={"forecast": time.perf_counter() - start})
+
+def get_forecaster(backend=constants.FORECAST_BACKEND):
+    
+    return FORECASTERS[backend]()
+
+class ProphetForecaster:
+    """
+    Average of a Prophet model of cases and one of log cases per region, fitted by build_all_models.
+    """
+    
+    needs_models = True
+    
+    def forecast(self, country_data, horizon=7, regions=None):
+        """
+        :param country_data: Countries snapshot.
+        :param horizon: Number of days to forecast.
+        :param regions: Regions to forecast, all of the snapshot if None.
+        :return: Dict of variant -> dict of region -> DataFrame with date, confirmed, lower_bound and upper_bound
+            columns. The "forecast" variant is the ensemble, "log" and "linear" are its two models.
+        """
+        
+        forecasts = {"forecast": {}, "log": {}, "linear": {}}
+        
+        for country in (country_data.countries if regions is None else regions):
             
+            try:
+    
+                model_log = load_model(country, country_data.timestamp, log_flag=True)
+                
                 model_linear = load_model(country, country_data.timestamp, log_flag=False)
                 
-            except Exception as exc:
+            except:
+                
+                try:
+                    #if any model is not present/unreadable force rebuild with the same time stamp
+                    print("Force rebuilding model for {}".format(country))
+    
+                    build_model(country, log_flag=True, countries_data=country_data)
+                    
+                    build_model(country, log_flag=False, countries_data=country_data)
+                    
+                    model_log = load_model(country, country_data.timestamp, log_flag=True)
+                
+                    model_linear = load_model(country, country_data.timestamp, log_flag=False)
+                    
+                except Exception as exc:
+                    
+                    print("Error in forecasting", exc)
+            
+            predictions_log = get_predictions_dataframe(model_log, horizon=horizon, log_flag=True)
+            
+            predictions_linear = get_predictions_dataframe(model_linear, horizon=horizon, log_flag=False)
+            
+            forecasts["forecast"][country] = get_ensembled_forecast(predictions_log, predictions_linear)
+            
+            forecasts["log"][country] = predictions_log
+            
+            forecasts["linear"][country] = predictions_linear
+        
+        return forecasts
+
+class NumpyForecaster:
+    """
+    Growth curves fitted to the last days of every region's cumulative cases at once, in pure NumPy.
+    
+    "log_linear" fits a straight line to log cases, i.e. exponential growth. "gompertz" fits a straight line to the
+    log of the daily growth of log cases, i.e. growth that slows down exponentially, and falls back to log-linear
+    for regions whose growth isn't slowing. Both are least squares fits of every region in one batched solve, with
+    the usual analytic prediction intervals of a linear regression.
+    """
+    
+    needs_models = False
+    
+    def __init__(self, method="gompertz", window=14, interval_width=0.95):
+        """
+        :param method: "gompertz" or "log_linear".
+        :param window: Number of most recent days to fit to.
+        :param interval_width: Coverage of the prediction intervals.
+        """
+        
+        self.method = method
+        
+        self.window = window
+        
+        self.interval_width = interval_width
+    
+    def forecast(self, country_data, horizon=7, regions=None):
+        """
+        :param country_data: Countries snapshot.
+        :param horizon: Number of days to forecast.
+        :param regions: Regions to forecast, all of the snapshot if None.
+        :return: Dict with a "forecast" variant, a dict of region -> DataFrame with date, confirmed, lower_bound and
+            upper_bound columns, like the Prophet forecasts.
+        """
+        
+        regions = country_data.countries if regions is None else regions
+        
+        print("Forecasting {} regions with NumPy".format(len(regions)), self.method, "curves")
+        
+        hist_data = country_data.historical_country_data
+        
+        # One column of cumulative cases per region, one row per day
+        hist_data = hist_data.loc[hist_data.index.isin(regions)].reset_index()
+        
+        confirmed = hist_data.pivot_table(
+            index="Date", columns=hist_data.columns[0], values="Confirmed", aggfunc="sum"
+        ).reindex(columns=regions)
+        
+        confirmed = confirmed.asfreq("D") if isinstance(confirmed.index, pd.DatetimeIndex) else confirmed
+        
+        predicted, lower, upper = forecast_growth(
+            confirmed.to_numpy(dtype=np.float64), horizon, self.method, self.window, self.interval_width
+        )
+        
+        dates = pd.date_range(confirmed.index[-1], periods=horizon + 1, freq="D")[1:]
+        
+        forecasts = {}
+        
+        for k, country in enumerate(regions):
+            
+            history = confirmed[country].dropna()
+            
+            history_df = pd.DataFrame({"date": history.index, "confirmed": history.to_numpy()})
+            
+            history_df["lower_bound"] = history_df["confirmed"]
+            
+            history_df["upper_bound"] = history_df["confirmed"]
+            
+            preds = pd.DataFrame(
+                {"date": dates, "confirmed": predicted[:, k], "lower_bound": lower[:, k], "upper_bound": upper[:, k]}
+            )
+            
+            df = pd.concat([history_df, preds], axis=0).reset_index(drop=True)
+            
+            for x in ["confirmed", "lower_bound", "upper_bound"]:
                 
-                print("Error in forecasting", exc)
+                df[x] = np.round(df[x]).astype(int)
+            
+            forecasts[country] = df
         
-        predictions_log = get_predictions_dataframe(model_log, horizon=horizon, log_flag=True)
+        return {"forecast": forecasts}
+
+def _fit_lines(t, y, valid):
+    """
+    Least squares fit of y = a + b * t for every column of y at once, using only the valid entries.
+    :return: Coefficients (a, b), the inverse normal matrices, residual variances and number of points per column.
+    """
+    
+    w = valid.astype(np.float64)
+    
+    y = np.where(valid, y, 0)
+    
+    t = t[:, np.newaxis]
+    
+    # Normal equations of all columns, solved as one batch of 2 x 2 systems
+    normal = np.stack([
+        np.stack([w.sum(axis=0), (w * t).sum(axis=0)], axis=-1),
+        np.stack([(w * t).sum(axis=0), (w * t ** 2).sum(axis=0)], axis=-1),
+    ], axis=-2)
+    
+    rhs = np.stack([(w * y).sum(axis=0), (w * t * y).sum(axis=0)], axis=-1)
+    
+    num_points = w.sum(axis=0)
+    
+    # Columns with fewer than three points get a flat line through zero and no spread
+    solvable = (num_points >= 3) & (np.linalg.det(normal) > 0)
+    
+    normal = np.where(solvable[:, np.newaxis, np.newaxis], normal, np.eye(2))
+    
+    inverse = np.linalg.inv(normal)
+    
+    coefficients = np.where(solvable[:, np.newaxis], (inverse @ rhs[..., np.newaxis])[..., 0], 0)
+    
+    residuals = w * (y - coefficients[:, 0] - coefficients[:, 1] * t)
+    
+    variance = np.where(solvable, (residuals ** 2).sum(axis=0) / np.maximum(num_points - 2, 1), 0)
+    
+    return coefficients, inverse, variance, np.where(solvable, num_points, 0)
+
+def _prediction_bands(coefficients, inverse, variance, num_points, t_future, interval_width):
+    # Fitted line and the half width of the prediction interval of a new observation at each future time
+    
+    x = np.stack([np.ones_like(t_future), t_future], axis=-1)
+    
+    fitted = coefficients[:, 0] + coefficients[:, 1] * t_future[:, np.newaxis]
+    
+    leverage = np.einsum("hi,rij,hj->hr", x, inverse, x)
+    
+    quantile = scipy.stats.t.ppf(0.5 + interval_width / 2, np.maximum(num_points - 2, 1))
+    
+    return fitted, quantile * np.sqrt(variance * (1 + leverage))
+
+def forecast_growth(confirmed, horizon, method="gompertz", window=14, interval_width=0.95):
+    """
+    Fit growth curves to the cumulative cases of many regions at once and extrapolate them.
+    :param confirmed: Array of shape (day, region) of cumulative confirmed cases, NaN where unknown.
+    :param horizon: Number of days to forecast.
+    :param method: "gompertz" or "log_linear", see NumpyForecaster.
+    :param window: Number of most recent days to fit to.
+    :param interval_width: Coverage of the prediction intervals.
+    :return: Forecast, lower bound and upper bound, each of shape (horizon, region). Forecasts never fall below the
+        last known count.
+    """
+    
+    if confirmed.shape[1] == 0:
+        
+        return np.empty((horizon, 0)), np.empty((horizon, 0)), np.empty((horizon, 0))
+    
+    recent = confirmed[-window:]
+    
+    t = np.arange(len(recent), dtype=np.float64)
+    
+    t_future = len(recent) - 1 + np.arange(1, horizon + 1, dtype=np.float64)
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        
+        log_confirmed = np.log(recent)
+    
+    valid = np.isfinite(log_confirmed)
+    
+    # Carry the last known count forward for regions whose latest days are missing
+    last = pd.DataFrame(confirmed).ffill().to_numpy()[-1]
+    
+    last = np.where(np.isfinite(last), last, 0)
+    
+    with np.errstate(divide="ignore"):
+        
+        log_last = np.log(last)
+    
+    fitted, half_width = _prediction_bands(*_fit_lines(t, log_confirmed, valid), t_future, interval_width)
+    
+    log_linear = np.exp(fitted), np.exp(fitted - half_width), np.exp(fitted + half_width)
+    
+    if method == "log_linear":
+        
+        predicted, lower, upper = log_linear
         
-        predictions_linear = get_predictions_dataframe(model_linear, horizon=horizon, log_flag=False)
+    elif method == "gompertz":
+        
+        # Daily growth of log cases, and a line through its log
+        with np.errstate(divide="ignore", invalid="ignore"):
+            
+            growth = np.diff(log_confirmed, axis=0)
+            
+            log_growth = np.log(growth)
         
-        predictions = get_ensembled_forecast(predictions_log, predictions_linear)
+        growth_valid = np.isfinite(log_growth)
         
-        write_predictions(predictions, country, country_data.timestamp, logname=None)
+        coefficients, inverse, variance, num_points = _fit_lines(t[1:], log_growth, growth_valid)
         
-        write_predictions(predictions_log, country, country_data.timestamp, logname="log")
+        fitted, half_width = _prediction_bands(coefficients, inverse, variance, num_points, t_future, interval_width)
+        
+        # Add up the daily growth of log cases from the last known count. Poor fits can overflow, which the cap
+        # below takes care of.
+        with np.errstate(over="ignore"):
+            
+            predicted, lower, upper = (
+                np.exp(log_last + np.cumsum(np.exp(x), axis=0))
+                for x in (fitted, fitted - half_width, fitted + half_width)
+            )
+        
+        # Growth that isn't slowing down is better described by the log-linear curve
+        slowing = (coefficients[:, 1] < 0) & (num_points > 0)
+        
+        predicted, lower, upper = (
+            np.where(slowing, x, y) for x, y in zip((predicted, lower, upper), log_linear)
+        )
+        
+    else:
         
-        write_predictions(predictions_linear, country, country_data.timestamp, logname="linear")
+        raise ValueError("Unknown method: {}".format(method))
+    
+    # Cumulative counts can't go down, nor exceed the world population, and regions without any usable history
+    # stay where they are
+    has_fit = valid.sum(axis=0) >= 3
+    
+    return tuple(
+        np.where(has_fit, np.clip(x, last, max(WORLD_POPULATION, last.max(initial=0))), last)
+        for x in (predicted, lower, upper)
+    )
+
+FORECASTERS = {"prophet": ProphetForecaster, "numpy": NumpyForecaster}
         
-def build_model(country, log_flag=True):
+def build_model(country, log_flag=True, countries_data=None):
     
-    countries_data = io_utils.load_data()
+    if countries_data is None:
+        
+        countries_data = io_utils.load_data()
     
     hist_data = countries_data.historical_country_data
     
     hist_data_c = hist_data.loc[hist_data.index == country]
     
+    return fit_and_save_model(country, hist_data_c, countries_data.timestamp, log_flag)
+    
+def fit_and_save_model(country, hist_data_c, timestamp, log_flag=True):
+    """
+    Fit one Prophet model to a region's history and save it. Module level so that process pools can pickle it.
+    :param country: Region name.
+    :param hist_data_c: Historical data of the region only.
+    :param timestamp: Snapshot timestamp the model belongs to.
+    :param log_flag: Fit to log cases instead of cases.
+    :return: Filename of the saved model.
+    """
+    
     prep_hist = prepare_data(hist_data_c, log_flag)
     
     print("building model for " + country)
@@ -213,25 +606,102 @@ def build_model(country, log_flag=True):
     
     print("Model build successful")
     
-    model.stan_backend.logger = None
+    filename = get_model_filename(country, timestamp, log_flag)
     
-    if log_flag:
+    print("Saving model to:", filename)
+    
+    prophet_utils.save_parameters(model, filename, compress=constants.COMPRESS_MODELS)
+    
+    return filename
+
+def _timed_fit_and_save_model(arguments):
+    # Catch errors here so that one failing region doesn't take down the whole pool
+    
+    country, hist_data_c, timestamp, log_flag = arguments
+    
+    start = time.perf_counter()
+    
+    try:
         
-        logname = "log"
+        fit_and_save_model(country, hist_data_c, timestamp, log_flag)
+        
+        error = None
+        
+    except Exception as exc:
+        
+        error = str(exc)
+    
+    return {"Region": country, "Model": "log" if log_flag else "linear",
+            "Seconds": time.perf_counter() - start, "Error": error}
+
+def build_models(countries_data, num_processes=constants.NUM_BUILD_PROCESSES, incremental=True):
+    """
+    Fit the log and linear Prophet models of every region of a snapshot on a process pool. Each worker only gets
+    the history of the region it fits, not the whole snapshot.
+    :param countries_data: Countries snapshot, loaded once by the caller.
+    :param num_processes: Number of worker processes. 1 fits in this process.
+    :param incremental: Carry over the models of regions whose history hasn't changed since the previous snapshot,
+        instead of fitting them again.
+    :return: DataFrame with the fitting time and error, if any, of every model that was fitted.
+    """
+    
+    hist_data = countries_data.historical_country_data
+    
+    regions = countries_data.countries
+    
+    if incremental:
+        
+        previous_timestamp, unchanged = get_unchanged_regions(countries_data)
+        
+        carried_over = [
+            country for country in unchanged
+            if carry_over_files([(get_model_filename(country, previous_timestamp, log_flag),
+                                  get_model_filename(country, countries_data.timestamp, log_flag))
+                                 for log_flag in (False, True)])
+        ]
+        
+        print("Carried over models of {} unchanged regions".format(len(carried_over)))
+        
+        regions = [country for country in regions if country not in carried_over]
+    
+    tasks = []
+    
+    for country in regions:
+        
+        hist_data_c = hist_data.loc[hist_data.index == country]
+        
+        tasks += [(country, hist_data_c, countries_data.timestamp, log_flag) for log_flag in (False, True)]
+    
+    start = time.perf_counter()
+    
+    if num_processes == 1:
+        
+        timings = [_timed_fit_and_save_model(x) for x in tasks]
         
     else:
         
-        logname = "linear"
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+            
+            timings = list(executor.map(_timed_fit_and_save_model, tasks))
     
-    filename = os.path.join(constants.MODELS_DIR, 
-                            "model_{}_{}_t_{}.joblib".format(logname, 
-                                                             country, countries_data.timestamp.strftime(TIME_STAMP_FORMAT)))
+    for row in timings:
+        
+        if row["Error"] is None:
+            
+            print("Built {} model for {} in {:.1f}s".format(row["Model"], row["Region"], row["Seconds"]))
+            
+        else:
+            
+            print("Error building {} model for {}: {}".format(row["Model"], row["Region"], row["Error"]))
     
-    print("Saving model to:", filename)
+    print("Built {} models in {:.1f}s".format(len(timings), time.perf_counter() - start))
     
-    joblib.dump(model, filename)
+    return pd.DataFrame(timings)
     
-def load_model(country, timestamp, log_flag=True):
+def get_model_filename(country, timestamp, log_flag=True, extension="npz"):
+    """
+    :param extension: "npz" for the parameters saved by prophet_utils, "joblib" for whole pickled Prophet models.
+    """
     
     if log_flag:
         
@@ -241,57 +711,563 @@ def load_model(country, timestamp, log_flag=True):
         
         logname = "linear"
     
-    fname = os.path.join(constants.MODELS_DIR, "model_{}_{}_t_{}.joblib".format(logname,
-                                                                                country, 
-                                                                                timestamp.strftime(TIME_STAMP_FORMAT)))
+    return os.path.join(constants.MODELS_DIR, "model_{}_{}_t_{}.{}".format(logname,
+                                                                         country, 
+                                                                         timestamp.strftime(TIME_STAMP_FORMAT),
+                                                                         extension))
+
+class ModelCache:
+    """
+    Thread-safe LRU cache of loaded forecasting models, bounded by the memory their arrays and frames take, see
+    get_model_bytes. Not by the size of their files, which are compressed. Entries are keyed by filename, so models
+    of an older snapshot just age out.
+    """
     
-    print("Loading model from:", fname)
+    def __init__(self, max_bytes=constants.MODEL_CACHE_BYTES):
+        """
+        :param max_bytes: Max total size of the cached models, least recently used ones are evicted beyond it.
+        """
+        
+        self.max_bytes = max_bytes
+        
+        self.hits = 0
+        
+        self.misses = 0
+        
+        self._entries = collections.OrderedDict()
+        
+        self._num_bytes = 0
+        
+        self._lock = threading.Lock()
     
-    model = joblib.load(fname)
+    def get(self, fname):
+        
+        with self._lock:
+            
+            entry = self._entries.get(fname)
+            
+            if entry is None:
+                
+                self.misses += 1
+                
+                return None
+            
+            self._entries.move_to_end(fname)
+            
+            self.hits += 1
+            
+            return entry[1]
+    
+    def put(self, fname, model, num_bytes):
+        
+        # A model bigger than the whole budget would evict everything else for nothing
+        if num_bytes > self.max_bytes:
+            
+            return
+        
+        with self._lock:
+            
+            if fname in self._entries:
+                
+                self._num_bytes -= self._entries.pop(fname)[0]
+            
+            self._entries[fname] = (num_bytes, model)
+            
+            self._num_bytes += num_bytes
+            
+            while self._num_bytes > self.max_bytes:
+                
+                self._num_bytes -= self._entries.popitem(last=False)[1][0]
+    
+    def clear(self):
+        
+        with self._lock:
+            
+            self._entries.clear()
+            
+            self._num_bytes = 0
+            
+            self.hits = 0
+            
+            self.misses = 0
+    
+    def stats(self):
+        
+        with self._lock:
+            
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "bytes": self._num_bytes}
+
+MODEL_CACHE = ModelCache()
+
+def get_model_bytes(model):
+    """
+    Memory taken by a loaded model, counted over the arrays, frames and dicts of arrays among its attributes, which
+    is where ProphetPredictor and Prophet models keep their data.
+    """
+    
+    def get_bytes(value):
+        
+        if isinstance(value, np.ndarray):
+            
+            return value.nbytes
+        
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            
+            return int(np.sum(value.memory_usage(deep=True)))
+        
+        if isinstance(value, dict):
+            
+            return sum(get_bytes(x) for x in value.values())
+        
+        return 0
+    
+    return sum(get_bytes(value) for value in vars(model).values())
+
+def load_model(country, timestamp, log_flag=True, cache=MODEL_CACHE):
+    
+    fname = get_model_filename(country, timestamp, log_flag)
+    
+    # Snapshots built before models were saved as parameters only have pickled models
+    if not os.path.exists(fname) and os.path.exists(get_model_filename(country, timestamp, log_flag, "joblib")):
+        
+        fname = get_model_filename(country, timestamp, log_flag, "joblib")
+    
+    model = cache.get(fname) if cache is not None else None
+    
+    if model is None:
+        
+        print("Loading model from:", fname)
+        
+        model = joblib.load(fname) if fname.endswith(".joblib") else prophet_utils.load_parameters(fname)
+        
+        if cache is not None:
+            
+            cache.put(fname, model, get_model_bytes(model))
     
     return model
 
-def write_predictions(df, country, timestamp, logname=None):
+def get_store_filenames(timestamp):
+    """
+    :return: Filename of the index of a snapshot's forecast store, and the prefix of its store files. Every write of
+        the store goes to a new store file, which the index names.
+    """
+    
+    suffix = timestamp.strftime(TIME_STAMP_FORMAT)
+    
+    index_fname = os.path.join(constants.OUTPUTS_DIR, "forecasts_t_{}.json".format(suffix))
     
-    if logname==None:
+    return index_fname, "forecasts_t_{}_".format(suffix)
 
-        fname = os.path.join(constants.OUTPUTS_DIR,
-                             "predictions_{}_t_{}.csv".format(country, timestamp.strftime(TIME_STAMP_FORMAT)))
-    else:
+def write_forecast_store(forecasts, timestamp, backend=constants.FORECAST_BACKEND, horizon=7):
+    """
+    Save every forecast of a snapshot as one memory-mappable .npy file of shape (variant, region, day, column) over
+    a shared daily date axis, with a JSON index of the variants, regions and the days each forecast spans. A last
+    "valid" column flags the days a forecast has, since a region's history can skip days within its span.
+    :param forecasts: Dict of variant -> dict of region -> DataFrame, as returned by the forecasters.
+    :param timestamp: Snapshot timestamp.
+    :param backend: Name of the forecaster, so that incremental refreshes only reuse forecasts of the same one.
+    :param horizon: Number of days forecast.
+    :return: Filenames of the store and of its index.
+    """
+    
+    variants = list(forecasts)
+    
+    regions = sorted({country for variant in variants for country in forecasts[variant]})
+    
+    dates = [pd.to_datetime(df["date"]) for variant in variants for df in forecasts[variant].values() if len(df)]
+    
+    start = min(x.min() for x in dates) if dates else pd.Timestamp(timestamp.date())
+    
+    num_days = (max(x.max() for x in dates) - start).days + 1 if dates else 0
+    
+    index_fname, prefix = get_store_filenames(timestamp)
+    
+    # A new file per write, so readers of the current index keep a store that matches it
+    handle, store_fname = tempfile.mkstemp(suffix=".npy", prefix=prefix, dir=constants.OUTPUTS_DIR)
+    
+    os.close(handle)
+    
+    # mkstemp returns an absolute path, the manifest records paths relative to the app like every other file
+    store_fname = os.path.join(constants.OUTPUTS_DIR, os.path.basename(store_fname))
+    
+    store = np.lib.format.open_memmap(
+        store_fname, mode="w+", dtype=np.int64,
+        shape=(len(variants), len(regions), num_days, len(FORECAST_COLUMNS) + 1)
+    )
+    
+    index = {
+        "timestamp": timestamp.strftime(TIME_STAMP_FORMAT),
+        "store": os.path.basename(store_fname),
+        "backend": backend,
+        "horizon": horizon,
+        "start": start.strftime("%Y-%m-%d"),
+        "columns": FORECAST_COLUMNS + ["valid"],
+        "variants": variants,
+        "regions": {country: row for row, country in enumerate(regions)},
+        # [first day, last day + 1] of each forecast, by variant and region
+        "days": {variant: {} for variant in variants},
+    }
+    
+    for i, variant in enumerate(variants):
         
-        fname = os.path.join(constants.OUTPUTS_DIR,
-                             "predictions_{}_{}_t_{}.csv".format(logname,
-                                                              country, timestamp.strftime(TIME_STAMP_FORMAT)))
+        for country, df in forecasts[variant].items():
+            
+            if not len(df):
+                
+                continue
+            
+            days = (pd.to_datetime(df["date"]) - start).dt.days.to_numpy()
+            
+            first, last = int(days.min()), int(days.max()) + 1
+            
+            store[i, index["regions"][country], days, :-1] = np.round(df[FORECAST_COLUMNS].to_numpy(dtype=np.float64))
+            
+            # Days missing from the frame stay at 0, and are dropped by read_forecast
+            store[i, index["regions"][country], days, -1] = 1
+            
+            index["days"][variant][country] = [first, last]
+    
+    store.flush()
+    
+    del store
+    
+    try:
+        
+        with open(index_fname, "r") as handle:
+            
+            previous_store_fname = os.path.join(constants.OUTPUTS_DIR, json.load(handle)["store"])
+        
+    except (FileNotFoundError, KeyError, ValueError):
+        
+        previous_store_fname = None
+    
+    handle, tmp_fname = tempfile.mkstemp(suffix=".json.tmp", prefix=prefix, dir=constants.OUTPUTS_DIR)
+    
+    with os.fdopen(handle, "w") as handle:
+        
+        json.dump(index, handle)
+    
+    # Replacing the index is the single commit point: readers see the old index and store, or the new ones
+    os.replace(tmp_fname, index_fname)
     
-    df.to_csv(fname, index=False)
+    # Processes that already mapped the previous store keep it until they unmap it
+    if previous_store_fname is not None and previous_store_fname != store_fname:
+        
+        try:
+            
+            os.remove(previous_store_fname)
+            
+        except FileNotFoundError:
+            
+            pass
+    
+    # The snapshot's entry names the current store only. Stores used to be registered by their absolute path.
+    replaced = [previous_store_fname, os.path.abspath(previous_store_fname)] if previous_store_fname else []
+    
+    io_utils.register_snapshot(timestamp, [store_fname, index_fname], replaced=replaced)
+    
+    print("Saved forecasts to:", store_fname)
+    
+    return store_fname, index_fname
+
+def load_forecast_store(timestamp):
+    """
+    Memory-map the forecast store of a snapshot. The mapping is kept until the store is rewritten.
+    :param timestamp: Snapshot timestamp.
+    :return: Read-only store array and its index.
+    """
+    
+    index_fname, _ = get_store_filenames(timestamp)
+    
+    # Every write replaces the index with a new file
+    stat = os.stat(index_fname)
+    
+    version = stat.st_ino, stat.st_mtime_ns
+    
+    if index_fname not in _loaded_stores or _loaded_stores[index_fname][0] != version:
+        
+        with open(index_fname, "r") as handle:
+            
+            index = json.load(handle)
+        
+        try:
+            
+            store = np.load(os.path.join(constants.OUTPUTS_DIR, index["store"]), mmap_mode="r")
+            
+        except FileNotFoundError:
+            
+            # The store was rewritten between reading its index and mapping it, so read the new index
+            if (os.stat(index_fname).st_ino, os.stat(index_fname).st_mtime_ns) != version:
+                
+                return load_forecast_store(timestamp)
+            
+            raise
+        
+        _loaded_stores[index_fname] = version, store, index
+    
+    return _loaded_stores[index_fname][1:]
+
+def add_to_forecast_store(forecasts, timestamp, backend=constants.FORECAST_BACKEND, horizon=7):
+    """
+    Add forecasts to the forecast store of a snapshot, keeping the regions it already has. The store is created if
+    there is none yet, and replaced if it holds forecasts of another backend or horizon.
+    :param forecasts: Dict of variant -> dict of region -> DataFrame, as returned by the forecasters.
+    :param timestamp: Snapshot timestamp.
+    :param backend: Name of the forecaster.
+    :param horizon: Number of days forecast.
+    :return: Filenames of the store and of its index.
+    """
+    
+    with _store_lock:
+        
+        merged = {variant: dict(frames) for variant, frames in forecasts.items()}
+        
+        try:
+            
+            store, index = load_forecast_store(timestamp)
+            
+            if index["backend"] == backend and index["horizon"] == horizon:
+                
+                for variant in index["variants"]:
+                    
+                    for country in index["days"][variant]:
+                        
+                        if country not in merged.setdefault(variant, {}):
+                            
+                            merged[variant][country] = read_forecast(country, timestamp, variant)
+        
+        except FileNotFoundError:
+            
+            pass
+        
+        return write_forecast_store(merged, timestamp, backend, horizon)
+
+def get_region_hashes(countries_data):
+    """
+    Hash every region's historical series, to tell which regions changed between snapshots.
+    :param countries_data: Countries snapshot.
+    :return: Dict of region -> hex digest of its rows of historical_country_data.
+    """
+    
+    hashes = {}
+    
+    for country, hist_data_c in countries_data.historical_country_data.groupby(level=0, sort=False):
+        
+        rows = pd.util.hash_pandas_object(hist_data_c.sort_values("Date"), index=True).to_numpy()
+        
+        hashes[country] = hashlib.sha1(rows.tobytes()).hexdigest()
+    
+    return hashes
+
+def get_hashes_filename(timestamp):
+    
+    return os.path.join(constants.PROCESSED_DIR, "region_hashes_{}.json".format(timestamp.strftime(TIME_STAMP_FORMAT)))
+
+def save_region_hashes(countries_data):
+    
+    fname = get_hashes_filename(countries_data.timestamp)
+    
+    with open(fname, "w") as handle:
+        
+        json.dump(get_region_hashes(countries_data), handle)
     
     return fname
 
-def read_forecast(country="Australia"):
+def get_unchanged_regions(countries_data):
+    """
+    Compare a snapshot's region hashes with those saved for the latest earlier snapshot of the manifest. Worked out
+    once per snapshot, since on demand forecasts ask for it on every request.
+    :param countries_data: Countries snapshot.
+    :return: Timestamp of the earlier snapshot, or None if there is none, and the regions whose history is the same
+        in both.
+    """
+    
+    key = countries_data.timestamp
     
-    timestamp = io_utils.get_latest_timestamp()
+    if key in _unchanged_regions:
+        
+        return _unchanged_regions[key]
     
-    fname = os.path.join(constants.OUTPUTS_DIR, 
-                         "predictions_{}_t_{}.csv".format(country, timestamp.strftime(TIME_STAMP_FORMAT)))
+    previous_timestamp = None
     
-    return pd.read_csv(fname)
+    for suffix, entry in io_utils.get_manifest().get("snapshots", {}).items():
+        
+        try:
+            
+            timestamp = datetime.datetime.strptime(suffix, TIME_STAMP_FORMAT)
+            
+        except ValueError as exc:
+            
+            print(exc)
+            
+            continue
+        
+        # Only snapshots that completed a build have their hashes
+        if get_hashes_filename(timestamp) not in entry.get("files", []):
+            
+            continue
+        
+        if timestamp < countries_data.timestamp and (previous_timestamp is None or timestamp > previous_timestamp):
+            
+            previous_timestamp = timestamp
+    
+    if previous_timestamp is None:
+        
+        unchanged = []
+        
+    else:
+        
+        with open(get_hashes_filename(previous_timestamp), "r") as handle:
+            
+            previous_hashes = json.load(handle)
+        
+        # build_all_models saves the snapshot's hashes, which spares hashing every region
+        try:
+            
+            with open(get_hashes_filename(countries_data.timestamp), "r") as handle:
+                
+                hashes = json.load(handle)
+            
+        except FileNotFoundError:
+            
+            hashes = get_region_hashes(countries_data)
+        
+        unchanged = [
+            country for country in countries_data.countries
+            if country in hashes and previous_hashes.get(country) == hashes[country]
+        ]
+    
+    # Only the current snapshot is asked for, older ones are dropped
+    _unchanged_regions.clear()
+    
+    _unchanged_regions[key] = previous_timestamp, unchanged
+    
+    return previous_timestamp, unchanged
+
+def carry_over_files(pairs):
+    """
+    Make files of an earlier snapshot available under a new snapshot's names, as hard links where the file system
+    allows it and as copies otherwise.
+    :param pairs: List of (existing filename, new filename).
+    :return: True if every file was carried over, False if any of the existing files is missing.
+    """
+    
+    if not all(os.path.exists(src) for src, _ in pairs):
+        
+        return False
+    
+    for src, dst in pairs:
+        
+        if os.path.exists(dst):
+            
+            os.remove(dst)
+        
+        try:
+            
+            os.link(src, dst)
+            
+        except OSError:
+            
+            shutil.copyfile(src, dst)
+    
+    return True
+
+def read_forecast(country="Australia", timestamp=None, variant="forecast"):
+    """
+    Read one region's forecast from the forecast store of a snapshot.
+    :param country: Region name.
+    :param timestamp: Snapshot timestamp, the latest one if None.
+    :param variant: "forecast", or "log" and "linear" for the models of a Prophet ensemble.
+    :return: DataFrame with date, confirmed, lower_bound and upper_bound columns.
+    """
+    
+    if timestamp is None:
+        
+        timestamp = io_utils.get_latest_timestamp()
+    
+    store, index = load_forecast_store(timestamp)
+    
+    first, last = index["days"][variant][country]
+    
+    values = store[index["variants"].index(variant), index["regions"][country], first:last]
+    
+    df = pd.DataFrame(values, columns=index["columns"])
+    
+    df.insert(0, "date", pd.date_range(pd.Timestamp(index["start"]) + pd.Timedelta(days=first), periods=last - first))
+    
+    # Stores written before the valid column have every day of each span
+    if "valid" in df:
+        
+        df = df[df.pop("valid") == 1].reset_index(drop=True)
+    
+    return df
 
 
-def build_all_models():
+def build_all_models(num_processes=constants.NUM_BUILD_PROCESSES):
     
     io_utils.fetch_data()
     
+    # Load the snapshot once for every build step
     data = io_utils.load_data()
     
+    global_data = io_utils.load_data(global_flag=True)
+    
+    # Files and seconds taken by each build step, for the manifest
+    fnames, durations = [], {}
+    
+    start = time.perf_counter()
+    
+    # Calibrated first, since the scenario cube simulates every region with its calibrated transmission rate
     try:
         
-        for country in data.countries:
-
-            build_model(country, log_flag=False)
-            
-            build_model(country, log_flag=True)
+        fnames += calibration_utils.build_calibration(data, global_data, num_processes=num_processes)
+        
+    except Exception as exc:
+        print("Error in calibrating transmission rates", exc)
+    
+    durations["calibration"], start = time.perf_counter() - start, time.perf_counter()
+    
+    try:
+        
+        fnames += scenario_utils.build_scenario_cube(data, global_data)
+        
+    except Exception as exc:
+        print("Error in building scenario cube", exc)
+    
+    durations["scenario_cube"], start = time.perf_counter() - start, time.perf_counter()
+    
+    try:
+        
+        if FORECASTERS[constants.FORECAST_BACKEND].needs_models:
+        
+            build_models(data, num_processes=num_processes)
             
     except Exception as exc:        
         print(exc)
+    
+    durations["models"] = time.perf_counter() - start
+    
+    # Record the regions' histories last, so the next refresh only carries over what this one built
+    try:
+        
+        fnames += [save_region_hashes(data)]
+        
+    except Exception as exc:
+        print("Error in saving region hashes", exc)
+    
+    try:
+        
+        io_utils.register_snapshot(data.timestamp, fnames, durations)
+        
+    except Exception as exc:
+        print("Error in updating manifest", exc)
+    
+    # Expire old snapshots once this one is complete
+    try:
+        
+        retention_utils.apply_retention()
+        
+    except Exception as exc:
+        print("Error in applying retention", exc)
         
     return
@@ -64,24 +64,26 @@ def plot_true_versus_confirmed(confirmed, predicted):
     return fig
 
 
-def infection_graph(df, y_max, pop_50, pop_75):
+def infection_graph(predictions, y_max, pop_50, pop_75):
+    """
+    :param predictions: models.Predictions of a region.
+    """
     
     # We cannot explicitly set graph width here, have to do it as injected css: see interface.css
     fig = go.Figure(layout=dict(template=TEMPLATE))
 
+    days = predictions.days
+
     total, infected, dead = (
-        df.loc[df.Status == "Total Cases"],
-        df.loc[df.Status == "Infected"],
-        df.loc[df.Status == "Recovered"],
+        predictions["Total Cases"],
+        predictions["Infected"],
+        predictions["Recovered"],
     )
     
-    total["pop_50"] = abs(total["Forecast"] - pop_50)
+    # First day closest to each population share
+    pop_50_day = [int(days[np.argmin(np.abs(total - pop_50))])]
     
-    total["pop_75"] = abs(total["Forecast"] - pop_75)
-    
-    pop_50_day = total.loc[total["pop_50"] == total["pop_50"].min(), "Days"].tolist()
-    
-    pop_75_day = total.loc[total["pop_75"] == total["pop_75"].min(), "Days"].tolist()
+    pop_75_day = [int(days[np.argmin(np.abs(total - pop_75))])]
     
     annotations = [
             dict(
@@ -113,8 +115,8 @@ def infection_graph(df, y_max, pop_50, pop_75):
     
     
     fig.add_scatter(
-        x=total.Days,
-        y=total.Forecast,
+        x=days,
+        y=total,
         fillcolor=COLOR_MAP["susceptible"],
         fill="tozeroy",
         mode="lines",
@@ -124,8 +126,8 @@ def infection_graph(df, y_max, pop_50, pop_75):
     )
 
     fig.add_scatter(
-        x=dead.Days,
-        y=dead.Forecast,
+        x=days,
+        y=dead,
         fillcolor=COLOR_MAP["recovered"],
         fill="tozeroy",
         mode="lines",
@@ -135,8 +137,8 @@ def infection_graph(df, y_max, pop_50, pop_75):
     )
 
     fig.add_scatter(
-        x=infected.Days,
-        y=infected.Forecast,
+        x=days,
+        y=infected,
         fillcolor="#FFA000",
         fill="tozeroy",
         mode="lines",
@@ -470,13 +472,12 @@ def plot_death_timeseries(df, df_uk, country_name="Australia"):
     
     annotations = []
     
-    total_rows = df.shape[0]
-    
-    factor = total_rows//6
+    # Days after the steady state are not materialised as rows, so space annotations by day rather than by row
+    factor = max(df["Days"].max() // 6, 1)
     
     for rownum, row in df.iterrows():
         
-        if rownum % factor == 0:
+        if row["Days"] % factor == 0:
         
             annotations += [
                     dict(
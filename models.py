@@ -1,5 +1,10 @@
-import itertools
+import collections
+import concurrent.futures
+import functools
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 
 import data.constants as constants
@@ -15,6 +20,82 @@ _STATUSES_TO_SHOW = [
 
 _DEFAULT_TIME_SCALE = 12 * 3 * 31  # 36 months
 
+# Smallest positive float64, used to guard divisions by an empty infected compartment
+_TINY = np.finfo(np.float64).tiny
+
+
+class PredictionCache:
+    """
+    Bounded, thread-safe LRU cache of predictions, whose entries also expire after a time to live.
+
+    Entries belong to a data snapshot: storing or looking up an entry for a different snapshot than the current one
+    drops every entry, so a new fetch_data snapshot invalidates the cache on first use.
+    """
+
+    def __init__(self, max_size=256, ttl=constants.STALE_LIMIT):
+        """
+        :param max_size: Max number of entries, the least recently used one is evicted beyond it.
+        :param ttl: Seconds an entry stays valid for. None to keep entries until evicted.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def _set_snapshot(self, snapshot):
+        if snapshot != self._snapshot:
+            self._entries.clear()
+            self._snapshot = snapshot
+
+    def get(self, key, snapshot=None):
+        """
+        :return: Copy of the cached value, or None if there is no valid entry.
+        """
+        with self._lock:
+            self._set_snapshot(snapshot)
+
+            entry = self._entries.get(key)
+
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        # Callers are free to modify what they get back
+        return entry[1].copy()
+
+    def put(self, key, value, snapshot=None):
+        with self._lock:
+            self._set_snapshot(snapshot)
+
+            self._entries[key] = (time.monotonic(), value.copy())
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+PREDICTION_CACHE = PredictionCache()
+
 
 def get_predictions(
     cases_estimator,
@@ -23,40 +104,284 @@ def get_predictions(
     num_recovered,
     num_deaths,
     area_population,
-    max_days
+    max_days,
+    rounded=True,
+    early_stop=False,
+    region=None,
+    timestamp=None,
+    cache=PREDICTION_CACHE,
 ):
+    """
+    Predictions for one region, as a Predictions object. Results are memoised in cache, keyed by the region, its
+    initial state, every model parameter (so any change to the constants or the contact rate is a new entry) and the
+    horizon.
+    :param early_stop: Stop once the epidemic has burned out, see integrate_sir. The predictions are then held at
+        their steady state, which drops the rounding remainder a frozen Infected would keep adding to Recovered, Dead
+        and Total Cases, so their tails aren't bit-identical to a full run.
+    :param region: Region name, for the cache key.
+    :param timestamp: Timestamp of the data snapshot the statistics come from. Entries of older snapshots are
+        dropped once a newer one is seen.
+    :param cache: PredictionCache to use, or None to always simulate.
+    """
+
+    key = _get_cache_key(
+        region, cases_estimator, sir_model, num_diagnosed, num_recovered, num_deaths, area_population, max_days,
+        rounded, early_stop,
+    )
+
+    if cache is not None and key is not None:
+
+        predictions = cache.get(key, snapshot=timestamp)
+
+        if predictions is not None:
+
+            return predictions
+
+    predictions = get_region_predictions(
+        cases_estimator=cases_estimator,
+        sir_model=sir_model,
+        num_diagnosed=num_diagnosed,
+        num_recovered=num_recovered,
+        num_deaths=num_deaths,
+        area_population=area_population,
+        max_days=max_days,
+        rounded=rounded,
+        early_stop=early_stop,
+    )
+
+    predictions = Predictions.from_dict(predictions, max_days)
+
+    if cache is not None and key is not None:
+
+        cache.put(key, predictions, snapshot=timestamp)
+
+    return predictions
+
+
+def _get_cache_key(region, cases_estimator, sir_model, *inputs):
+    # Only scalar simulations are cached, arrays of regions or parameters are simulated every time
+    values = list(inputs) + list(vars(cases_estimator).values()) + list(vars(sir_model).values())
+
+    if any(np.ndim(x) for x in values):
+        return None
+
+    # NaN never equals itself, so it would never hit
+    return (region, type(cases_estimator).__name__, type(sir_model).__name__) + tuple(
+        None if x != x else float(x) for x in values
+    )
+
+
+def get_region_predictions(
+    cases_estimator,
+    sir_model,
+    num_diagnosed,
+    num_recovered,
+    num_deaths,
+    area_population,
+    max_days,
+    rounded=True,
+    early_stop=False,
+):
+    """
+    Simulate many regions at once. Same inputs as get_predictions, but every count may be an array with one entry
+    per region, and sir_model may have been built with a per-region hospital_capacity array. All regions are advanced
+    together, each with its own hospital-capacity death-rate switch.
+    :return: Dict of status -> array of shape regions + (max_days + 1,).
+    """
+
+    true_cases = cases_estimator.predict(np.asarray(num_diagnosed, dtype=np.float64))
 
-    true_cases = cases_estimator.predict(num_diagnosed)
-    
     # For now assume removed starts at 0. Doesn't have a huge effect on the model
-    predictions = sir_model.predict(
+    return sir_model.predict(
         susceptible=area_population - true_cases - num_recovered - num_deaths,
         infected=true_cases,
         recovered=num_recovered,
         dead=num_deaths,
         num_days=max_days,
+        rounded=rounded,
+        early_stop=early_stop,
     )
 
-    num_entries = max_days + 1
-    
-    # Have to use the long format to make plotly express happy
+
+def rank_regions(regions, predictions, hospital_capacity, by="Dead"):
+    """
+    Summarise simulated regions into one row each, ranked by an outcome.
+    :param regions: Region names, in the order of the first axis of predictions.
+    :param predictions: Dict of status -> array of shape (region, day), as returned by get_region_predictions.
+    :param hospital_capacity: Hospital beds of each region.
+    :param by: Column to rank regions by, in descending order.
+    :return: DataFrame indexed by region.
+    """
+    need_hospitalization = predictions["Need Hospitalization"]
+
     df = pd.DataFrame(
         {
-            "Days": list(range(num_entries)) * len(_STATUSES_TO_SHOW),
-            "Forecast": list(
-                itertools.chain.from_iterable(
-                    predictions[status] for status in _STATUSES_TO_SHOW
-                )
-            ),
-            "Status": list(
-                itertools.chain.from_iterable(
-                    [status] * num_entries for status in _STATUSES_TO_SHOW
-                )
-            ),
-        }
+            "Dead": predictions["Dead"][:, -1],
+            "Total Cases": predictions["Total Cases"][:, -1],
+            "Peak Infected": predictions["Infected"].max(axis=1),
+            "Peak Day": predictions["Infected"].argmax(axis=1),
+            "Peak Need Hospitalization": need_hospitalization.max(axis=1),
+            "Num Hospital Beds": hospital_capacity,
+            "Days Over Capacity": (need_hospitalization > np.asarray(hospital_capacity)[:, np.newaxis]).sum(axis=1),
+        },
+        index=pd.Index(regions, name="Region"),
+    )
+
+    return df.sort_values(by, ascending=False)
+
+
+class Predictions:
+    """
+    Predictions of one region as a (status, day) array, with the statuses of _STATUSES_TO_SHOW as a categorical
+    index. Indexing by status returns a read-only view of its row, and the long DataFrame plotly express needs is
+    only built on request.
+    """
+
+    def __init__(self, values, days, statuses=_STATUSES_TO_SHOW):
+        """
+        :param values: Array of shape (len(statuses), len(days)).
+        :param days: Day of each column.
+        :param statuses: Status of each row.
+        """
+        self.values = values
+        self.days = days
+        self.statuses = pd.CategoricalIndex(statuses, categories=statuses, name="Status")
+
+        # Rows are shared between copies and cache entries, so nobody may write to them
+        self.values.flags.writeable = False
+        self.days.flags.writeable = False
+
+        self._long_frame = None
+
+    @classmethod
+    def from_dict(cls, predictions, num_days=None):
+        """
+        :param predictions: Dict of status -> 1-D array of daily values, as returned by SIRModel.predict.
+        :param num_days: Horizon of the predictions. If the arrays stop earlier because the epidemic reached its
+            steady state, the tail is constant and only represented by one last column on this day, which is enough
+            to draw it.
+        """
+        num_entries = len(predictions[_STATUSES_TO_SHOW[0]])
+        days = np.arange(num_entries)
+        values = np.stack([predictions[status] for status in _STATUSES_TO_SHOW])
+
+        if num_days is not None and num_days >= num_entries:
+            days = np.append(days, num_days)
+            values = np.concatenate([values, values[:, -1:]], axis=1)
+
+        return cls(values, days)
+
+    def __getitem__(self, status):
+        return self.values[self.statuses.get_loc(status)]
+
+    def copy(self):
+        # The arrays are read-only, so copies can share them
+        return Predictions(self.values, self.days, list(self.statuses))
+
+    def to_frame(self, status):
+        """
+        :return: DataFrame with the Days and Forecast columns of one status.
+        """
+        return pd.DataFrame({"Days": self.days, "Forecast": self[status]})
+
+    def to_long_frame(self):
+        """
+        :return: DataFrame with Days, Forecast and Status columns, as plotly express expects. Built on first use.
+        """
+        if self._long_frame is None:
+            self._long_frame = pd.DataFrame(
+                {
+                    "Days": np.tile(self.days, len(self.statuses)),
+                    "Forecast": self.values.ravel(),
+                    "Status": np.repeat(np.asarray(self.statuses), len(self.days)),
+                }
+            )
+
+        return self._long_frame.copy()
+
+
+def to_long_format(predictions, num_days=None):
+    """
+    Convert SIR predictions into the long DataFrame format plotly express expects.
+    :param predictions: Dict of status -> 1-D array of daily values, as returned by SIRModel.predict.
+    :param num_days: See Predictions.from_dict.
+    :return: DataFrame with Days, Forecast and Status columns.
+    """
+    return Predictions.from_dict(predictions, num_days).to_long_frame()
+
+
+def get_contact_schedule(num_days, days, contact_rates, gradual=False):
+    """
+    Build a daily contact rate schedule for SIRModel.predict_schedule from the days on which the contact rate changes.
+    :param num_days: Number of days to forecast.
+    :param days: Increasing days on which each contact rate starts to apply, the first one usually 0.
+    :param contact_rates: Mean number of daily contacts from each of those days. Stacking several alternatives along
+        leading axes, shape (..., len(days)), gives a batch of schedules.
+    :param gradual: If True, move linearly from one contact rate to the next between their days, e.g. for a
+        gradual reopening, instead of switching on the day itself.
+    :return: Array of shape (..., num_days) with the mean daily contacts of each day.
+    """
+
+    days = np.asarray(days, dtype=np.float64)
+    contact_rates = np.asarray(contact_rates, dtype=np.float64)
+    forecast_days = np.arange(num_days)
+
+    if gradual:
+        # Contact rates before the first day and after the last one are held
+        position = np.interp(forecast_days, days, np.arange(len(days)))
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, len(days) - 1)
+        weight = position - lower
+        return contact_rates[..., lower] * (1 - weight) + contact_rates[..., upper] * weight
+
+    return contact_rates[..., np.maximum(np.searchsorted(days, forecast_days, side="right") - 1, 0)]
+
+
+def get_ensemble_predictions(
+    cases_estimator,
+    sir_model,
+    num_diagnosed,
+    num_recovered,
+    num_deaths,
+    area_population,
+    max_days,
+    num_replicates=1000,
+    percentiles=(2.5, 50, 97.5),
+    seed=None,
+    num_processes=1
+):
+    """
+    Uncertainty bands for get_predictions, from an ensemble of stochastic simulations.
+    :param num_replicates: Number of stochastic replicates.
+    :param percentiles: Percentiles of the ensemble to report for each status and day.
+    :param seed: Seed for the random number generator.
+    :param num_processes: Number of processes to split the replicates across.
+    :return: DataFrame in the long format of get_predictions, with a Percentile column. There is one set of rows per
+        percentile.
+    """
+
+    true_cases = cases_estimator.predict(num_diagnosed)
+
+    ensemble = sir_model.predict_ensemble(
+        susceptible=area_population - true_cases - num_recovered - num_deaths,
+        infected=true_cases,
+        recovered=num_recovered,
+        dead=num_deaths,
+        num_days=max_days,
+        num_replicates=num_replicates,
+        seed=seed,
+        num_processes=num_processes,
+    )
+
+    bands = {status: np.percentile(values, percentiles, axis=-2) for status, values in ensemble.items()}
+
+    return pd.concat(
+        [
+            to_long_format({status: values[k] for status, values in bands.items()}).assign(Percentile=percentile)
+            for k, percentile in enumerate(percentiles)
+        ],
+        ignore_index=True,
     )
-    
-    return df
 
 
 def get_probability_of_infection_give_asymptomatic(
@@ -78,7 +403,7 @@ def get_probability_of_infection_give_asymptomatic(
     return p
 
 
-def get_status_by_age_group(death_prediction: int, recovered_prediction: int, age_data: pd.DataFrame):
+def get_status_by_age_group(death_prediction, recovered_prediction, state):
     """
     Get outcomes segmented by age.
 
@@ -88,33 +413,80 @@ def get_status_by_age_group(death_prediction: int, recovered_prediction: int, ag
 
     :param death_prediction: Number of deaths predicted.
     :param recovered_prediction: Number of recovered people predicted.
-    :return: Outcomes by age in a DataFrame.
+    :param state: State whose age data to use.
+    :return: Outcomes by age in a DataFrame, empty if there is no age data for the state.
     """
-    
-    #age_data = constants.AgeData.data
-    infections_prediction = recovered_prediction + death_prediction
+
+    states, age_groups, _ = get_age_matrix()
+
+    columns = ["Infected", "Need Hospitalization", "Dead", "Recovered"]
+
+    if state not in states:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name="Age Group"))
+
+    outcomes = get_status_by_age_groups(death_prediction, recovered_prediction, states=[state])
+
+    return pd.DataFrame(
+        {column: outcomes[column][0] for column in columns}, index=pd.Index(age_groups, name="Age Group")
+    )
+
+
+def get_status_by_age_groups(death_predictions, recovered_predictions, states=None):
+    """
+    Get outcomes segmented by age for many states or scenarios at once, as get_status_by_age_group does for one.
+    :param death_predictions: Number of deaths predicted, of shape (..., len(states)).
+    :param recovered_predictions: Number of recovered people predicted, of shape (..., len(states)).
+    :param states: States whose age data to use. Defaults to every state of constants.AGE_DATA.
+    :return: Dict of status -> array of shape (..., len(states), number of age groups), for Infected, Need
+        Hospitalization, Dead and Recovered.
+    """
+
+    all_states, _, rates = get_age_matrix()
+
+    rows = slice(None) if states is None else [all_states.index(state) for state in states]
+    proportion, hospitalization_rate, mortality = (
+        rates[column][rows] for column in ["Proportion", "Hospitalization Rate", "Mortality"]
+    )
+
+    death_predictions = np.asarray(death_predictions, dtype=np.float64)
+    infections_predictions = recovered_predictions + death_predictions
 
     # Effective mortality rate may be different than the one defined in data/constants.py because once we reach
     # hospital capacity, we increase the death rate. We assume the increase in death rate will be proportional, even
     # though it probably won't be since more old people require medical care, and thus will see increased mortality
     # when the medical system reaches capacity.
-    effective_death_rate = death_prediction / infections_prediction
+    has_infections = infections_predictions > 0
+    effective_death_rate = np.where(
+        has_infections, death_predictions / np.where(has_infections, infections_predictions, 1), 0
+    )
     death_increase_ratio = effective_death_rate / constants.MortalityRate.default
 
-    # Get outcomes by age
-    age_data["Infected"] = (age_data.Proportion * infections_prediction).astype(int)
-    
-    age_data["Need Hospitalization"] = (
-        age_data["Hospitalization Rate"] * age_data.Infected
-    )
-    
-    age_data["Dead"] = (
-        age_data.Mortality * death_increase_ratio * age_data.Infected
-    ).astype(int)
-    
-    age_data["Recovered"] = (age_data.Infected - age_data.Dead).astype(int)
+    infected = np.trunc(proportion * infections_predictions[..., np.newaxis])
+    dead = np.trunc(mortality * death_increase_ratio[..., np.newaxis] * infected)
+
+    return {
+        "Infected": infected.astype(np.int64),
+        "Need Hospitalization": hospitalization_rate * infected,
+        "Dead": dead.astype(np.int64),
+        "Recovered": (infected - dead).astype(np.int64),
+    }
 
-    return age_data.iloc[:, -4:]
+
+@functools.lru_cache(maxsize=None)
+def get_age_matrix():
+    """
+    The age data of every state in constants.AGE_DATA as arrays, computed once per process.
+    :return: List of states, list of age groups, and dict of column -> read-only array of shape (state, age group).
+    """
+
+    states = list(constants.AGE_DATA.State.unique())
+
+    age_groups, rates = get_age_group_rates(states)
+
+    for values in rates.values():
+        values.flags.writeable = False
+
+    return states, age_groups, rates
 
 
 class TrueInfectedCasesModel:
@@ -153,6 +525,7 @@ class SIRModel:
         :param hospitalization_rate: Proportion of illnesses who need are severely ill and need acute medical care.
         :param hospital_capacity: Max capacity of medical system in area.
         """
+        self._transmission_rate_per_contact = transmission_rate_per_contact
         self._infection_rate = transmission_rate_per_contact * contact_rate
         self._recovery_rate = recovery_rate
         # Death rate is amortized over the recovery period
@@ -163,7 +536,7 @@ class SIRModel:
         self._hospitalization_rate = hospitalization_rate
         self._hospital_capacity = hospital_capacity
 
-    def predict(self, susceptible, infected, recovered, dead, num_days):
+    def predict(self, susceptible, infected, recovered, dead, num_days, rounded=True, early_stop=False):
         """
         Run simulation.
         :param susceptible: Number of susceptible people in population.
@@ -171,75 +544,1260 @@ class SIRModel:
         :param recovered: Number of recovered people in population.
         :param dead: Number of dead people in the population
         :param num_days: Number of days to forecast.
-        :return: List of values for S, I, R over time steps
+        :param rounded: If True, round every compartment to whole people at each step (the original behaviour).
+            If False, keep the full float64 state throughout.
+        :param early_stop: Stop once the epidemic has burned out. See integrate_sir.
+        :return: Dict of arrays of length num_days + 1 for each status, keyed like _STATUSES_TO_SHOW.
         """
-        
+
         print("Getting SIR model predictions")
-        
-        population = susceptible + infected + recovered + dead
-
-        S = [int(susceptible)]
-        I = [int(infected)]
-        R = [int(recovered)]
-        D = [int(dead)]
-        H = [round(self._hospitalization_rate * infected)]
-        T = [int(infected) + int(recovered) + int(dead)]
-        
-        if int(dead) > 0:
-            
-            self._normal_death_rate = int(dead) / int(infected)
-
-        for t in range(num_days):
-
-            # There is an additional chance of dying if people are critically ill
-            # and have no access to the medical system.
-            if I[-1] > 0:
-                underserved_critically_ill_proportion = (
-                    max(0, H[-1] - self._hospital_capacity) / I[-1]
+
+        return integrate_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            infection_rate=self._infection_rate,
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            rounded=rounded,
+            early_stop=early_stop,
+        )
+
+    def predict_batch(
+        self, susceptible, infected, recovered, dead, num_days, contact_rates, rounded=True, early_stop=False
+    ):
+        """
+        Run the simulation for several contact rates in one vectorised pass, e.g. every position of the sidebar slider.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param num_days: Number of days to forecast.
+        :param contact_rates: Sequence of mean daily contacts, one scenario each. Overrides the model's contact rate.
+        :param rounded: See predict.
+        :param early_stop: See predict.
+        :return: Dict of arrays of shape (len(contact_rates), num_days + 1) for each status.
+        """
+
+        print("Getting batched SIR model predictions")
+
+        return integrate_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            infection_rate=self._transmission_rate_per_contact * np.asarray(contact_rates, dtype=np.float64),
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            rounded=rounded,
+            early_stop=early_stop,
+        )
+
+    def predict_schedule(
+        self, susceptible, infected, recovered, dead, contact_schedule, rounded=True, early_stop=False
+    ):
+        """
+        Run the simulation with a contact rate that changes from day to day, e.g. a lockdown followed by a gradual
+        reopening. Several alternative schedules are run in one vectorised pass when stacked along leading axes.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param contact_schedule: Array of shape (..., num_days) with the mean daily contacts of each day, e.g. from
+            get_contact_schedule. Overrides the model's contact rate; its length sets the number of days to forecast.
+        :param rounded: See predict.
+        :param early_stop: See predict.
+        :return: Dict of arrays of shape (..., num_days + 1) for each status.
+        """
+
+        print("Getting scheduled SIR model predictions")
+
+        contact_schedule = np.asarray(contact_schedule, dtype=np.float64)
+
+        return integrate_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=contact_schedule.shape[-1],
+            infection_rate=self._transmission_rate_per_contact * contact_schedule[..., 0],
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            rounded=rounded,
+            early_stop=early_stop,
+            infection_rate_schedule=self._transmission_rate_per_contact * contact_schedule,
+        )
+
+    @classmethod
+    def predict_grid(cls, grid, susceptible, infected, recovered, dead, num_days, rounded=True):
+        """
+        Run the simulation for every combination of a grid of model parameters in one vectorised pass.
+        :param grid: Dict of constructor argument name -> value or sequence of values. All constructor arguments
+            must be given; scalars are held fixed.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param num_days: Number of days to forecast.
+        :param rounded: See predict.
+        :return: DataFrame with the parameters of each scenario, and a dict of arrays of shape
+            (num_scenarios, num_days + 1) for each status whose rows line up with the DataFrame.
+        """
+        names = list(grid)
+        values = np.meshgrid(*(np.atleast_1d(np.asarray(grid[name], dtype=np.float64)) for name in names), indexing="ij")
+        scenarios = pd.DataFrame({name: value.ravel() for name, value in zip(names, values)})
+
+        # The constructor is plain arithmetic, so it builds a model whose parameters are per-scenario arrays
+        model = cls(**{name: scenarios[name].to_numpy() for name in names})
+
+        predictions = model.predict(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            rounded=rounded,
+        )
+
+        return scenarios, predictions
+
+    def estimate(self, susceptible, infected, recovered, dead, total_case_fractions=(0.5, 0.75)):
+        """
+        Get headline figures of the epidemic without simulating its trajectory. See estimate_sir.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param total_case_fractions: Fractions of the population for which to estimate the days until Total Cases
+            reaches them.
+        :return: Dict of figure name -> value (or array of values, if the inputs are arrays).
+        """
+        return estimate_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            infection_rate=self._infection_rate,
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            total_case_fractions=total_case_fractions,
+        )
+
+    def get_max_contact_rate(
+        self,
+        susceptible,
+        infected,
+        recovered,
+        dead,
+        num_days,
+        method="simulate",
+        min_contact_rate=constants.AverageDailyContacts.min,
+        max_contact_rate=constants.AverageDailyContacts.max,
+        tolerance=0.01,
+    ):
+        """
+        Find the highest contact rate at which Need Hospitalization never exceeds the hospital capacity, i.e. the
+        least distancing that keeps hospitals under capacity. The model's own contact rate is ignored. Regions given
+        as arrays, including a per-region hospital capacity, are solved together.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param num_days: Number of days to forecast, for method "simulate".
+        :param method: "simulate" to bisect over batched float simulations, "analytic" to bisect over the peak
+            estimated by estimate_sir, which is faster but approximate and ignores num_days.
+        :param min_contact_rate: Lowest contact rate to consider.
+        :param max_contact_rate: Highest contact rate to consider.
+        :param tolerance: Accuracy of the result in contacts per day.
+        :return: Contact rate (or array of contact rates). max_contact_rate if hospitals are never exceeded within
+            the range, NaN if they are exceeded even at min_contact_rate.
+        """
+
+        print("Solving for the contact rate that keeps hospitals under capacity")
+
+        # Candidate contact rates go along a trailing axis, after any region axes
+        susceptible, infected, recovered, dead, recovery_rate, normal_death_rate, critical_death_rate, \
+            hospitalization_rate, hospital_capacity = (
+                np.asarray(x, dtype=np.float64)[..., np.newaxis]
+                for x in (
+                    susceptible,
+                    infected,
+                    recovered,
+                    dead,
+                    self._recovery_rate,
+                    self._normal_death_rate,
+                    self._critical_death_rate,
+                    self._hospitalization_rate,
+                    self._hospital_capacity,
+                )
+            )
+
+        parameters = dict(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            recovery_rate=recovery_rate,
+            normal_death_rate=normal_death_rate,
+            critical_death_rate=critical_death_rate,
+            hospitalization_rate=hospitalization_rate,
+            hospital_capacity=hospital_capacity,
+        )
+
+        def peak_need_hospitalization(contact_rates):
+            infection_rate = np.asarray(self._transmission_rate_per_contact)[..., np.newaxis] * contact_rates
+            if method == "analytic":
+                return estimate_sir(infection_rate=infection_rate, **parameters)["Peak Need Hospitalization"]
+            predictions = integrate_sir(
+                num_days=num_days, infection_rate=infection_rate, rounded=False, early_stop=True, **parameters
+            )
+            return predictions["Need Hospitalization"].max(axis=-1)
+
+        if method not in ("simulate", "analytic"):
+            raise ValueError("Unknown method: {}".format(method))
+
+        return solve_max_contact_rate(
+            peak_need_hospitalization, hospital_capacity, min_contact_rate, max_contact_rate, tolerance=tolerance
+        )
+
+    def predict_ensemble(
+        self, susceptible, infected, recovered, dead, num_days, num_replicates=1000, seed=None, num_processes=1
+    ):
+        """
+        Run many replicates of a stochastic version of the simulation. See simulate_stochastic.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param num_days: Number of days to forecast.
+        :param num_replicates: Number of replicates to simulate.
+        :param seed: Seed for the random number generator, for reproducible ensembles. The replicates drawn for a
+            given seed also depend on num_processes.
+        :param num_processes: Number of processes to split the replicates across.
+        :return: Dict of arrays of shape (..., num_replicates, num_days + 1) for each status.
+        """
+
+        print("Getting stochastic SIR model predictions")
+
+        parameters = dict(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            infection_rate=self._infection_rate,
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+        )
+
+        if num_processes <= 1:
+            return simulate_stochastic(num_replicates=num_replicates, seed=seed, **parameters)
+
+        # Independent random streams and a share of the replicates for each process
+        seeds = np.random.SeedSequence(seed).spawn(num_processes)
+        chunks = [len(x) for x in np.array_split(np.arange(num_replicates), num_processes)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+            results = list(
+                executor.map(
+                    functools.partial(_simulate_stochastic_chunk, parameters), chunks, seeds
                 )
-            else:
-                underserved_critically_ill_proportion = 0
-            weighted_death_rate = (
-                self._normal_death_rate * (1 - underserved_critically_ill_proportion)
-                + self._critical_death_rate * underserved_critically_ill_proportion
             )
 
-            # Forecast
+        return {status: np.concatenate([x[status] for x in results], axis=-2) for status in results[0]}
+
+
+class AgeStructuredSIRModel:
+    def __init__(
+        self,
+        transmission_rate_per_contact,
+        contact_rate,
+        recovery_rate,
+        critical_death_rate,
+        proportion,
+        hospitalization_rate,
+        mortality_rate,
+        hospital_capacity,
+        contact_matrix=None,
+    ):
+        """
+        SIR model with one set of compartments per age group.
+
+        Age group parameters are arrays whose last axis is the age group, e.g. the columns returned by
+        get_age_group_rates for one state or for several states at once.
+
+        :param transmission_rate_per_contact: Prob of contact between infected and susceptible leading to infection.
+        :param contact_rate: Mean number of daily contacts between an infected individual and susceptible people.
+        :param recovery_rate: Rate of recovery of infected individuals.
+        :param critical_death_rate: Rate of mortality among severe or critical cases that can't get access
+            to necessary medical facilities.
+        :param proportion: Proportion of the population in each age group.
+        :param hospitalization_rate: Proportion of infections in each age group that need acute medical care.
+        :param mortality_rate: Death rate of each age group in normal conditions.
+        :param hospital_capacity: Max capacity of medical system in area, shared by all age groups.
+        :param contact_matrix: Relative contact intensity between age groups, of shape (..., groups, groups). Entry
+            [g, k] weighs how much the infected share of group k adds to the infection rate of group g. Defaults to
+            proportionate mixing, [g, k] = proportion[k], under which the age groups add up to SIRModel.
+        """
+        self._infection_rate = transmission_rate_per_contact * contact_rate
+        self._recovery_rate = recovery_rate
+        # Death rates are amortized over the recovery period, as in SIRModel
+        self._normal_death_rate = np.asarray(mortality_rate) * recovery_rate
+        self._critical_death_rate = critical_death_rate * recovery_rate
+        self._proportion = proportion
+        self._hospitalization_rate = hospitalization_rate
+        self._hospital_capacity = hospital_capacity
+        self._contact_matrix = contact_matrix
+
+    def predict(self, susceptible, infected, recovered, dead, num_days):
+        """
+        Run simulation. The totals are split across age groups by their proportion of the population.
+        :param susceptible: Number of susceptible people in population.
+        :param infected: Number of infected people in population.
+        :param recovered: Number of recovered people in population.
+        :param dead: Number of dead people in the population
+        :param num_days: Number of days to forecast.
+        :return: Dict of arrays of shape (..., groups, num_days + 1) for each status. Use sum_age_groups for the
+            totals.
+        """
+
+        print("Getting age structured SIR model predictions")
+
+        return integrate_age_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            infection_rate=self._infection_rate,
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            proportion=self._proportion,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            contact_matrix=self._contact_matrix,
+        )
+
+
+def get_age_group_rates(states, age_data=constants.AGE_DATA):
+    """
+    Arrange the age data of several states into one array per column, ready for AgeStructuredSIRModel.
+    :param states: State names, as in the State column of the age data.
+    :param age_data: Age data laid out like data/age_data_states.csv, indexed by Age Group.
+    :return: List of age groups, and dict of column -> array of shape (len(states), number of age groups).
+    """
+
+    age_groups = list(age_data.index.unique())
+
+    table = age_data.reset_index().pivot(index="State", columns="Age Group").loc[list(states)]
+
+    return age_groups, {
+        column: table[column][age_groups].to_numpy(dtype=np.float64)
+        for column in ["Proportion", "Hospitalization Rate", "Critical Care", "Mortality"]
+    }
+
+
+def sum_age_groups(predictions):
+    """
+    Add up the age groups of AgeStructuredSIRModel predictions.
+    :param predictions: Dict of status -> array of shape (..., groups, days).
+    :return: Dict of status -> array of shape (..., days), laid out like SIRModel predictions.
+    """
+
+    return {status: values.sum(axis=-2) for status, values in predictions.items()}
+
+
+class MetapopulationSIRModel:
+    def __init__(
+        self,
+        transmission_rate_per_contact,
+        contact_rate,
+        recovery_rate,
+        normal_death_rate,
+        critical_death_rate,
+        hospitalization_rate,
+        hospital_capacity,
+        coupling=None,
+    ):
+        """
+        SIR model of several regions, e.g. the states of a country, that infect each other through travel.
+
+        Parameters are as for SIRModel. Per-region parameters are arrays whose first axis is the region.
+
+        :param coupling: Square matrix, dense or scipy.sparse, whose entry [r, k] is the share of the contacts of
+            region r's residents made with residents of region k. See get_coupling_matrix. Defaults to the identity,
+            i.e. isolated regions.
+        """
+        self._infection_rate = transmission_rate_per_contact * contact_rate
+        self._recovery_rate = recovery_rate
+        # Death rates are amortized over the recovery period, as in SIRModel
+        self._normal_death_rate = normal_death_rate * recovery_rate
+        self._critical_death_rate = critical_death_rate * recovery_rate
+        self._hospitalization_rate = hospitalization_rate
+        self._hospital_capacity = hospital_capacity
+        self._coupling = coupling
+
+    def predict(self, susceptible, infected, recovered, dead, num_days):
+        """
+        Run simulation for all regions together.
+        :param susceptible: Number of susceptible people in each region.
+        :param infected: Number of infected people in each region.
+        :param recovered: Number of recovered people in each region.
+        :param dead: Number of dead people in each region.
+        :param num_days: Number of days to forecast.
+        :return: Dict of arrays of shape (regions, ..., num_days + 1) for each status. Summing over the first axis
+            gives the national curve.
+        """
+
+        print("Getting metapopulation SIR model predictions")
+
+        return integrate_metapopulation_sir(
+            susceptible=susceptible,
+            infected=infected,
+            recovered=recovered,
+            dead=dead,
+            num_days=num_days,
+            infection_rate=self._infection_rate,
+            recovery_rate=self._recovery_rate,
+            normal_death_rate=self._normal_death_rate,
+            critical_death_rate=self._critical_death_rate,
+            hospitalization_rate=self._hospitalization_rate,
+            hospital_capacity=self._hospital_capacity,
+            coupling=self._coupling,
+        )
+
+
+def get_gravity_trips(population, travel_rate):
+    """
+    Daily trips between regions when a share of every region's residents travels each day, to the other regions in
+    proportion to their population. A stand-in for observed mobility data.
+    :param population: Population of each region.
+    :param travel_rate: Share of residents travelling to another region each day.
+    :return: Dense array whose entry [r, k] is the number of daily trips from region r to region k.
+    """
+
+    population = np.asarray(population, dtype=np.float64)
+
+    destinations = np.broadcast_to(population, (len(population), len(population))).copy()
+    np.fill_diagonal(destinations, 0)
+
+    return travel_rate * population[:, np.newaxis] * destinations / np.maximum(
+        destinations.sum(axis=1, keepdims=True), _TINY
+    )
+
+
+def get_coupling_matrix(trips, population):
+    """
+    Turn daily trips between regions into the coupling matrix of MetapopulationSIRModel. Residents of region r make
+    trips[r, k] / population[r] of their contacts in region k, and the rest at home.
+    :param trips: Dense array or scipy.sparse matrix of daily trips from row region to column region.
+    :param population: Population of each region.
+    :return: scipy.sparse CSR matrix, with rows summing to one.
+    """
+    # Only imported here, so the app doesn't need scipy unless regions are coupled
+    import scipy.sparse
+
+    population = np.asarray(population, dtype=np.float64)
+
+    away = scipy.sparse.csr_matrix(trips, dtype=np.float64)
+    away.setdiag(0)
+    away.eliminate_zeros()
+
+    # Empty regions keep all their (non-existent) contacts at home
+    away = scipy.sparse.diags(1 / np.where(population > 0, population, np.inf)) @ away
+
+    home = 1 - np.asarray(away.sum(axis=1)).ravel()
+
+    return (away + scipy.sparse.diags(home)).tocsr()
+
+
+def solve_max_contact_rate(
+    peak_need_hospitalization, hospital_capacity, min_contact_rate, max_contact_rate, tolerance=0.01, num_points=8
+):
+    """
+    Bisect, in batches, for the highest contact rate whose peak hospitalizations stay within hospital capacity.
+
+    Each round evaluates num_points evenly spaced contact rates inside every bracket in one call, so the brackets
+    shrink num_points + 1 times per call instead of twice. Peak hospitalizations must increase with the contact rate.
+
+    :param peak_need_hospitalization: Function of an array of shape batch_shape + (n,) of contact rates, returning
+        the peak Need Hospitalization of each.
+    :param hospital_capacity: Max capacity of medical system, of shape batch_shape + (1,).
+    :param min_contact_rate: Lowest contact rate to consider.
+    :param max_contact_rate: Highest contact rate to consider.
+    :param tolerance: Accuracy of the result in contacts per day.
+    :param num_points: Contact rates evaluated per bracket and call.
+    :return: Array of shape batch_shape, see SIRModel.get_max_contact_rate.
+    """
+
+    # An unknown (NaN) capacity is never exceeded, as in integrate_sir
+    def within_capacity(contact_rates):
+        return ~(peak_need_hospitalization(contact_rates) > hospital_capacity)
+
+    ends = within_capacity(np.array([min_contact_rate, max_contact_rate], dtype=np.float64))
+    batch_shape = ends.shape[:-1]
+
+    low = np.full(batch_shape, min_contact_rate, dtype=np.float64)
+    high = np.full(batch_shape, max_contact_rate, dtype=np.float64)
+
+    # Only regions with the threshold strictly inside the range need bisecting
+    searching = ends[..., 0] & ~ends[..., 1]
+    high = np.where(searching, high, low)
+    steps = np.arange(1, num_points + 1) / (num_points + 1)
+
+    while (high - low).max(initial=0) > tolerance:
+        contact_rates = low[..., np.newaxis] + (high - low)[..., np.newaxis] * steps
+
+        # Number of candidates within capacity before the first one that isn't
+        num_within = np.cumprod(within_capacity(contact_rates), axis=-1).sum(axis=-1)
+
+        candidates = np.concatenate([low[..., np.newaxis], contact_rates, high[..., np.newaxis]], axis=-1)
+        low = np.take_along_axis(candidates, num_within[..., np.newaxis], axis=-1)[..., 0]
+        high = np.take_along_axis(candidates, num_within[..., np.newaxis] + 1, axis=-1)[..., 0]
+
+    return np.where(ends[..., 1], float(max_contact_rate), np.where(ends[..., 0], low, np.nan))[()]
+
+
+def integrate_sir(
+    susceptible,
+    infected,
+    recovered,
+    dead,
+    num_days,
+    infection_rate,
+    recovery_rate,
+    normal_death_rate,
+    critical_death_rate,
+    hospitalization_rate,
+    hospital_capacity,
+    rounded=True,
+    early_stop=False,
+    infection_rate_schedule=None,
+):
+    """
+    Integrate the SIR equations on preallocated float64 arrays.
+
+    Every argument other than num_days and rounded may be a scalar or an array. They are broadcast against each other,
+    so a batch of scenarios (regions, contact rates, ...) is advanced together, one vectorised step per day.
+    Death rates are per day, i.e. already amortized over the recovery period as in SIRModel.
+
+    :param susceptible: Initial number of susceptible people.
+    :param infected: Initial number of infected people.
+    :param recovered: Initial number of recovered people.
+    :param dead: Initial number of dead people. If positive, the normal death rate is replaced by dead / infected.
+    :param num_days: Number of days to forecast.
+    :param infection_rate: Transmission rate per contact times contact rate.
+    :param recovery_rate: Rate of recovery of infected individuals.
+    :param normal_death_rate: Daily death rate in normal conditions.
+    :param critical_death_rate: Daily death rate of critical cases that can't get access to a hospital bed.
+    :param hospitalization_rate: Proportion of infections that need acute medical care.
+    :param hospital_capacity: Max capacity of medical system in area.
+    :param rounded: If True, round every compartment to whole people at each step, reproducing the original
+        list-based implementation exactly. If False, keep the float64 state unrounded.
+    :param early_stop: If True, stop integrating once every scenario has burned out, and only return the days up to
+        the last of them. Rounded scenarios have burned out once S, I and H stop changing, float scenarios once less
+        than half a person is left to move between compartments.
+    :param infection_rate_schedule: Optional array of shape batch_shape + (num_days,) with the infection rate of
+        each day, replacing infection_rate. No scenario counts as burned out before the schedule's last change.
+    :return: Dict of status -> array of shape batch_shape + (num_days + 1,). With early_stop, the arrays may be
+        shorter, and "Steady State Day" holds the day each scenario burned out (num_days if it never did). From
+        that day on its values should be read as constant. S, I and H then match the full run, but in rounded
+        runs R, D and T are held at their steady state value instead of creeping up by the rounding remainder of I.
+    """
+    (
+        susceptible,
+        infected,
+        recovered,
+        dead,
+        infection_rate,
+        recovery_rate,
+        normal_death_rate,
+        critical_death_rate,
+        hospitalization_rate,
+        hospital_capacity,
+    ) = np.broadcast_arrays(
+        *(
+            np.asarray(x, dtype=np.float64)
+            for x in (
+                susceptible,
+                infected,
+                recovered,
+                dead,
+                infection_rate,
+                recovery_rate,
+                normal_death_rate,
+                critical_death_rate,
+                hospitalization_rate,
+                hospital_capacity,
+            )
+        )
+    )
+
+    population = susceptible + infected + recovered + dead
+
+    if infection_rate_schedule is not None:
+        # Day along the first axis, so a day's rates are one contiguous block
+        infection_rate_schedule = np.moveaxis(
+            np.broadcast_to(np.asarray(infection_rate_schedule, dtype=np.float64), population.shape + (num_days,)),
+            -1,
+            0,
+        ).copy()
+        changed = (infection_rate_schedule[1:] != infection_rate_schedule[:-1]).any(
+            axis=tuple(range(1, infection_rate_schedule.ndim))
+        )
+        last_schedule_change = np.flatnonzero(changed)[-1] + 1 if changed.any() else 0
+
+    # All compartments live in one preallocated (day, compartment, batch...) array, so a day is a single contiguous
+    # block that can be rounded in one go.
+    state = np.empty((num_days + 1, 6) + population.shape, dtype=np.float64)
+    S, I, R, D, H, T = (state[:, k] for k in range(6))
+
+    if rounded:
+        S[0], I[0], R[0], D[0] = (np.trunc(x) for x in (susceptible, infected, recovered, dead))
+        H[0] = np.rint(hospitalization_rate * infected)
+    else:
+        S[0], I[0], R[0], D[0] = susceptible, infected, recovered, dead
+        H[0] = hospitalization_rate * infected
+    T[0] = I[0] + R[0] + D[0]
+
+    # Use the observed case fatality rate when we have one.
+    has_deaths = D[0] > 0
+    normal_death_rate = np.where(has_deaths, D[0] / np.where(has_deaths, I[0], 1), normal_death_rate)
+
+    # Unwrap 0-d arrays into NumPy scalars, which are much cheaper to do arithmetic on in the daily loop.
+    population, infection_rate, recovery_rate, normal_death_rate, critical_death_rate, hospitalization_rate, \
+        hospital_capacity = (
+            x[()] for x in (
+                population,
+                infection_rate,
+                recovery_rate,
+                normal_death_rate,
+                critical_death_rate,
+                hospitalization_rate,
+                hospital_capacity,
+            )
+        )
+
+    compartment_axis = -1 - population.ndim
+
+    def settled(before, after):
+        if rounded:
+            # S, I and H only depend on each other, so once a day passes without any of them changing they are
+            # fixed for good. R and T would keep creeping up by the rounding remainder of the frozen I, an artifact
+            # of rounding that the steady state drops.
+            epidemic = [0, 1, 4]
+            return (np.take(after, epidemic, compartment_axis) == np.take(before, epidemic, compartment_axis)).all(
+                axis=compartment_axis
+            )
+        # I declines at least geometrically from here on, so I * q / (1 - q) bounds everyone still to move between
+        # compartments. Settled once that is less than half a person.
+        infected_before = np.take(before, 1, axis=compartment_axis)
+        infected_after = np.take(after, 1, axis=compartment_axis)
+        return (infected_after <= infected_before) & (
+            infected_after * infected_before <= 0.5 * (infected_before - infected_after)
+        )
+
+    num_steps = 0
+
+    for t in range(num_days):
+        s, i = S[t], I[t]
+
+        # There is an additional chance of dying if people are critically ill
+        # and have no access to the medical system. H is zero whenever I is, so guarding the denominator is enough.
+        # fmax treats an unknown (NaN) capacity as never exceeded.
+        underserved_critically_ill_proportion = np.fmax(H[t] - hospital_capacity, 0) / np.maximum(i, _TINY)
+        weighted_death_rate = (
+            normal_death_rate * (1 - underserved_critically_ill_proportion)
+            + critical_death_rate * underserved_critically_ill_proportion
+        )
+
+        if infection_rate_schedule is not None:
+            infection_rate = infection_rate_schedule[t]
+
+        new_infections = infection_rate * i * s / population
+
+        S[t + 1] = s - new_infections
+        I[t + 1] = i + new_infections - (weighted_death_rate + recovery_rate) * i
+        R[t + 1] = R[t] + recovery_rate * i
+        D[t + 1] = D[t] + weighted_death_rate * i
+        H[t + 1] = hospitalization_rate * I[t + 1]
+        T[t + 1] = I[t + 1] + R[t + 1] + D[t + 1]
+
+        if rounded:
+            np.rint(state[t + 1], out=state[t + 1])
+
+        num_steps = t + 1
+
+        # Checking once a week is enough, the steady state day is worked out exactly below. A scheduled scenario
+        # can flare up again until its infection rate stops changing.
+        if (
+            early_stop
+            and t % 7 == 6
+            and (infection_rate_schedule is None or t >= last_schedule_change)
+            and settled(state[t], state[t + 1]).all()
+        ):
+            break
+
+    if early_stop:
+        # Scenarios stay settled once they are, so each steady state starts right after the last unsettled step
+        unsettled = ~settled(state[:num_steps], state[1:num_steps + 1])
+        if infection_rate_schedule is not None:
+            unsettled[:last_schedule_change] = True
+        step_numbers = np.arange(1, num_steps + 1).reshape((-1,) + (1,) * population.ndim)
+        steady_day = (unsettled * step_numbers).max(axis=0, initial=0)
+        state = state[:steady_day.max() + 1]
+        S, I, R, D, H, T = (state[:, k] for k in range(6))
+
+        # Hold each scenario at its steady state until the last one settles
+        days = np.arange(len(state)).reshape((-1,) + (1,) * population.ndim)
+        held_days = np.broadcast_to(np.minimum(days, steady_day), S.shape)
+        for compartment in (S, I, R, D, H, T):
+            compartment[...] = np.take_along_axis(compartment, held_days, axis=0)
+
+    predictions = {
+        "Susceptible": S,
+        "Infected": I,
+        "Recovered": R,
+        "Dead": D,
+        "Need Hospitalization": H,
+        "Total Cases": T,
+    }
+
+    for status, values in predictions.items():
+        values = np.moveaxis(values, 0, -1)
+        predictions[status] = values.astype(np.int64) if rounded else values
+
+    if early_stop:
+        predictions["Steady State Day"] = steady_day
+
+    return predictions
+
+
+def _trapezoid(y, x):
+    # Trapezoidal rule along the last axis (np.trapz was renamed across NumPy versions)
+    return ((y[..., 1:] + y[..., :-1]) * np.diff(x, axis=-1)).sum(axis=-1) / 2
+
+
+def lambertw(x, num_iterations=12):
+    """
+    Principal branch of the Lambert W function, W(x) * exp(W(x)) = x, for real x >= -1/e.
+    Vectorised Halley iteration, so we don't need scipy for the handful of values used by estimate_sir.
+    """
+    x = np.maximum(np.asarray(x, dtype=np.float64), -np.exp(-1))
+
+    # Series around the branch point for negative x, log1p otherwise. Both are close enough for Halley to converge
+    p = np.sqrt(2 * (np.e * x + 1))
+    w = np.where(x < 0, -1 + p - p ** 2 / 3, np.log1p(x))
+
+    for _ in range(num_iterations):
+        ew = np.exp(w)
+        f = w * ew - x
+        # At the branch point w = -1 the derivative vanishes, and so does f: leave w where it is
+        denominator = ew * (w + 1) - (w + 2) * f / (2 * w + 2 + (w == -1))
+        w = np.where(denominator != 0, w - f / np.where(denominator != 0, denominator, 1), w)
+
+    return w
+
+
+def estimate_sir(
+    susceptible,
+    infected,
+    recovered,
+    dead,
+    infection_rate,
+    recovery_rate,
+    normal_death_rate,
+    critical_death_rate,
+    hospitalization_rate,
+    hospital_capacity,
+    total_case_fractions=(0.5, 0.75),
+    num_quadrature_points=200,
+):
+    """
+    Estimate headline figures of the epidemic from the continuous-time SIR equations instead of stepping through it.
+
+    The final size comes from the Lambert W solution of the final size relation, and the peak from the
+    S-I phase plane invariant. Times and deaths in excess of hospital capacity are one-dimensional integrals over
+    the susceptible fraction, evaluated with a fixed quadrature. The daily steps of integrate_sir spread slightly
+    faster than the continuous equations, so the figures are approximations that are closest when the daily
+    infection rate is small. Arguments are as for integrate_sir and broadcast the same way.
+
+    :param total_case_fractions: Fractions of the population for which to estimate the days until Total Cases
+        reaches them.
+    :param num_quadrature_points: Number of points used by each integral.
+    :return: Dict with the final Susceptible, Total Cases and Dead, the Peak Infected, Peak Need Hospitalization
+        and Peak Day, and "Days To <fraction> Total Cases" per fraction, inf if it is never reached.
+    """
+    (
+        susceptible,
+        infected,
+        recovered,
+        dead,
+        infection_rate,
+        recovery_rate,
+        normal_death_rate,
+        critical_death_rate,
+        hospitalization_rate,
+        hospital_capacity,
+    ) = np.broadcast_arrays(
+        *(
+            np.asarray(x, dtype=np.float64)
+            for x in (
+                susceptible,
+                infected,
+                recovered,
+                dead,
+                infection_rate,
+                recovery_rate,
+                normal_death_rate,
+                critical_death_rate,
+                hospitalization_rate,
+                hospital_capacity,
+            )
+        )
+    )
+
+    population = susceptible + infected + recovered + dead
+
+    # Use the observed case fatality rate when we have one, as integrate_sir does
+    has_deaths = dead > 0
+    normal_death_rate = np.where(has_deaths, dead / np.where(has_deaths, infected, 1), normal_death_rate)
+
+    # Without contacts nobody gets infected; substitute a harmless rate to keep the algebra below finite
+    has_spread = infection_rate > 0
+    infection_rate = np.where(has_spread, infection_rate, 1)
+
+    removal_rate = recovery_rate + normal_death_rate
+    r0 = infection_rate / removal_rate
+    s0 = susceptible / population
+    i0 = infected / population
+
+    def grid(x):
+        # Add a trailing axis for quadrature points
+        return x[..., np.newaxis]
+
+    def infected_fraction(s):
+        # Phase plane invariant: s + i - ln(s) / R0 is constant along the trajectory
+        return np.maximum(grid(s0 + i0) - s + np.log(s / grid(s0)) / grid(r0), 0)
+
+    def days_until(s_target):
+        # dt = -ds / (beta * s * i). Most of the time is spent while i is still small, right after s0, so the
+        # quadrature points are spaced geometrically away from s0.
+        reachable = has_spread & (s_target > final_s)
+        offsets = grid(np.where(reachable, s0 - s_target, 0)) * np.geomspace(1e-9, 1, num_quadrature_points)
+        s = grid(s0) - offsets
+        integrand = 1 / (grid(infection_rate) * s * np.maximum(infected_fraction(s), _TINY))
+        days = _trapezoid(integrand, offsets) + integrand[..., 0] * offsets[..., 0]
+        return np.where(s_target >= s0, 0, np.where(reachable, days, np.inf))
+
+    # Final size relation: s_inf = -W(-R0 * s0 * exp(-R0 * (s0 + i0))) / R0
+    final_s = np.where(has_spread, -lambertw(-r0 * s0 * np.exp(-r0 * (s0 + i0))) / r0, s0)
+
+    # Infections peak when s crosses 1 / R0, if it ever does
+    epidemic_grows = has_spread & (r0 * s0 > 1)
+    peak_s = np.where(epidemic_grows, 1 / r0, s0)
+    peak_infected = population * np.where(epidemic_grows, infected_fraction(grid(peak_s))[..., 0], i0)
+
+    # Integral of I over time, from d(S + I)/dt = -(recovery + death rate) * I
+    infected_days = population * (s0 + i0 - final_s) / removal_rate
+
+    # Integral over time of the hospitalizations exceeding capacity, which die at the critical rather than the
+    # normal rate. fmax treats an unknown (NaN) capacity as never exceeded.
+    s = grid(final_s) + grid(s0 - final_s) * np.linspace(0, 1, num_quadrature_points)
+    i = infected_fraction(s)
+    excess = np.fmax(grid(hospitalization_rate * population) * i - grid(hospital_capacity), 0)
+    excess_days = _trapezoid(excess / (grid(infection_rate) * s * np.maximum(i, _TINY)), s)
+
+    # Without spread I simply decays exponentially, and the excess has a closed form
+    initial_hospitalized = hospitalization_rate * infected
+    overflowing = initial_hospitalized > hospital_capacity
+    has_capacity = hospital_capacity > 0
+    overflow_ratio = np.where(
+        overflowing & has_capacity, initial_hospitalized / np.where(has_capacity, hospital_capacity, 1), 1
+    )
+    decay_excess_days = np.where(
+        overflowing,
+        (initial_hospitalized - hospital_capacity - hospital_capacity * np.log(overflow_ratio)) / removal_rate,
+        0,
+    )
+    excess_days = np.where(has_spread, excess_days, decay_excess_days)
+
+    final_dead = dead + normal_death_rate * infected_days + (critical_death_rate - normal_death_rate) * excess_days
+
+    estimates = {
+        "Susceptible": population * final_s,
+        "Total Cases": population * (1 - final_s),
+        "Dead": final_dead,
+        "Peak Infected": peak_infected,
+        "Peak Need Hospitalization": hospitalization_rate * peak_infected,
+        "Peak Day": np.where(epidemic_grows, days_until(peak_s), 0),
+    }
+
+    for fraction in total_case_fractions:
+        estimates["Days To {:g} Total Cases".format(fraction)] = days_until(np.full_like(s0, 1 - fraction))
+
+    return estimates
+
+
+def simulate_stochastic(
+    susceptible,
+    infected,
+    recovered,
+    dead,
+    num_days,
+    infection_rate,
+    recovery_rate,
+    normal_death_rate,
+    critical_death_rate,
+    hospitalization_rate,
+    hospital_capacity,
+    num_replicates=1000,
+    seed=None,
+):
+    """
+    Simulate replicates of a chain binomial version of the SIR model integrated by integrate_sir.
+
+    Each day every susceptible person is infected with probability infection_rate * I / population, every infected
+    person recovers with probability recovery_rate or dies with the weighted death rate, and every infected person
+    needs hospitalization with probability hospitalization_rate. The expected daily flows are those of
+    integrate_sir, including the higher death rate of hospitalizations exceeding hospital_capacity. All replicates
+    are advanced together. Arguments are as for integrate_sir and may be arrays, which get a trailing replicate axis.
+
+    :param num_replicates: Number of replicates to simulate.
+    :param seed: Seed, or np.random.SeedSequence, for the random number generator.
+    :return: Dict of status -> int64 array of shape batch_shape + (num_replicates, num_days + 1).
+    """
+    rng = np.random.default_rng(seed)
+
+    (
+        susceptible,
+        infected,
+        recovered,
+        dead,
+        infection_rate,
+        recovery_rate,
+        normal_death_rate,
+        critical_death_rate,
+        hospitalization_rate,
+        hospital_capacity,
+    ) = np.broadcast_arrays(
+        *(
+            np.asarray(x, dtype=np.float64)[..., np.newaxis]
+            for x in (
+                susceptible,
+                infected,
+                recovered,
+                dead,
+                infection_rate,
+                recovery_rate,
+                normal_death_rate,
+                critical_death_rate,
+                hospitalization_rate,
+                hospital_capacity,
+            )
+        ),
+        np.empty(num_replicates),
+    )[:-1]
+
+    population = susceptible + infected + recovered + dead
+
+    state = np.empty((num_days + 1, 6) + population.shape, dtype=np.int64)
+    S, I, R, D, H, T = (state[:, k] for k in range(6))
+
+    S[0], I[0], R[0], D[0] = (np.trunc(x) for x in (susceptible, infected, recovered, dead))
+    H[0] = rng.binomial(I[0], hospitalization_rate)
+    T[0] = I[0] + R[0] + D[0]
+
+    # Use the observed case fatality rate when we have one.
+    has_deaths = D[0] > 0
+    normal_death_rate = np.where(has_deaths, D[0] / np.where(has_deaths, I[0], 1), normal_death_rate)
+
+    for t in range(num_days):
+        i = I[t]
+
+        underserved_critically_ill_proportion = np.fmax(H[t] - hospital_capacity, 0) / np.maximum(i, 1)
+        weighted_death_rate = (
+            normal_death_rate * (1 - underserved_critically_ill_proportion)
+            + critical_death_rate * underserved_critically_ill_proportion
+        )
+
+        new_infections = rng.binomial(S[t], np.minimum(infection_rate * i / population, 1))
+        new_recoveries = rng.binomial(i, recovery_rate)
+        # Deaths among those who didn't recover, keeping the overall daily death probability at the weighted rate
+        new_deaths = rng.binomial(i - new_recoveries, np.minimum(weighted_death_rate / (1 - recovery_rate), 1))
+
+        S[t + 1] = S[t] - new_infections
+        I[t + 1] = i + new_infections - new_recoveries - new_deaths
+        R[t + 1] = R[t] + new_recoveries
+        D[t + 1] = D[t] + new_deaths
+        H[t + 1] = rng.binomial(I[t + 1], hospitalization_rate)
+        T[t + 1] = I[t + 1] + R[t + 1] + D[t + 1]
+
+    statuses = ["Susceptible", "Infected", "Recovered", "Dead", "Need Hospitalization", "Total Cases"]
+
+    return {status: np.moveaxis(state[:, k], 0, -1) for k, status in enumerate(statuses)}
+
+
+def _simulate_stochastic_chunk(parameters, num_replicates, seed):
+    # Module level so that process pools can pickle it
+    return simulate_stochastic(num_replicates=num_replicates, seed=seed, **parameters)
+
+
+def integrate_age_sir(
+    susceptible,
+    infected,
+    recovered,
+    dead,
+    num_days,
+    infection_rate,
+    recovery_rate,
+    normal_death_rate,
+    critical_death_rate,
+    proportion,
+    hospitalization_rate,
+    hospital_capacity,
+    contact_matrix=None,
+):
+    """
+    Integrate the SIR equations with one set of compartments per age group, on preallocated float64 arrays.
+
+    Each day is one matrix-vector product for the force of infection followed by elementwise updates, vectorised over
+    the age groups and over any batch (states, contact rates, ...) the arguments broadcast to. The last axis of
+    proportion, hospitalization_rate, normal_death_rate and contact_matrix rows is the age group; every other
+    argument is per scenario. The hospitals are shared: once total hospitalizations exceed capacity, the same share
+    of every group's hospitalizations goes without a bed and dies at the critical death rate.
+
+    :param susceptible: Initial number of susceptible people, split across groups by proportion.
+    :param infected: Initial number of infected people, split across groups by proportion.
+    :param recovered: Initial number of recovered people, split across groups by proportion.
+    :param dead: Initial number of dead people, split across groups by proportion. If positive, the death rates of
+        all groups are scaled so that their population weighted mean is dead / infected, as in integrate_sir.
+    :param num_days: Number of days to forecast.
+    :param infection_rate: Transmission rate per contact times contact rate.
+    :param recovery_rate: Rate of recovery of infected individuals.
+    :param normal_death_rate: Daily death rate of each group in normal conditions.
+    :param critical_death_rate: Daily death rate of critical cases that can't get access to a hospital bed.
+    :param proportion: Proportion of the population in each group.
+    :param hospitalization_rate: Proportion of infections in each group that need acute medical care.
+    :param hospital_capacity: Max capacity of medical system in area.
+    :param contact_matrix: Relative contact intensity between groups, see AgeStructuredSIRModel. Defaults to
+        proportionate mixing.
+    :return: Dict of status -> array of shape batch_shape + (groups, num_days + 1).
+    """
+    proportion, hospitalization_rate, normal_death_rate = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (proportion, hospitalization_rate, normal_death_rate))
+    )
+
+    if contact_matrix is None:
+        contact_matrix = proportion[..., np.newaxis, :]
+
+    # Per scenario arguments get a trailing age group axis
+    totals = np.broadcast_arrays(
+        *(
+            np.asarray(x, dtype=np.float64)[..., np.newaxis]
+            for x in (
+                susceptible,
+                infected,
+                recovered,
+                dead,
+                infection_rate,
+                recovery_rate,
+                critical_death_rate,
+                hospital_capacity,
+            )
+        ),
+        proportion,
+        np.asarray(contact_matrix, dtype=np.float64)[..., 0],
+    )
+    batch_shape = totals[0].shape[:-1]
+    num_groups = proportion.shape[-1]
+
+    susceptible, infected, recovered, dead, infection_rate, recovery_rate, critical_death_rate, hospital_capacity = (
+        x[..., :1] for x in totals[:-2]
+    )
+    proportion, hospitalization_rate, normal_death_rate = (
+        np.broadcast_to(x, batch_shape + (num_groups,)) for x in (proportion, hospitalization_rate, normal_death_rate)
+    )
+    contact_matrix = np.broadcast_to(contact_matrix, batch_shape + (num_groups, num_groups))
+
+    population = susceptible + infected + recovered + dead
+    group_population = population * proportion
+
+    state = np.empty((num_days + 1, 5) + batch_shape + (num_groups,), dtype=np.float64)
+    S, I, R, D, H = (state[:, k] for k in range(5))
+
+    S[0], I[0], R[0], D[0] = (x * proportion for x in (susceptible, infected, recovered, dead))
+    H[0] = hospitalization_rate * I[0]
+
+    # Use the observed case fatality rate when we have one, keeping the age profile of the death rates
+    has_deaths = dead > 0
+    mean_death_rate = (proportion * normal_death_rate).sum(axis=-1, keepdims=True)
+    normal_death_rate = normal_death_rate * np.where(
+        has_deaths, dead / np.where(has_deaths, infected * np.maximum(mean_death_rate, _TINY), 1), 1
+    )
+
+    # Fold the group sizes into the contact matrix, so the force of infection is one product with I. Empty groups
+    # never have anyone infected, so guarding their size is enough.
+    contact_matrix = infection_rate[..., np.newaxis] * contact_matrix / np.maximum(
+        group_population[..., np.newaxis, :], _TINY
+    )
+
+    # Extra death rate of each group when all of its hospitalizations go without a bed
+    critical_excess_death_rate = (critical_death_rate - normal_death_rate) * hospitalization_rate
+
+    for t in range(num_days):
+        s, i = S[t], I[t]
+
+        # Total hospitalizations over capacity, shared out over the groups in proportion to their hospitalizations
+        need_hospitalization = H[t].sum(axis=-1, keepdims=True)
+        underserved_share = np.fmax(need_hospitalization - hospital_capacity, 0) / np.maximum(
+            need_hospitalization, _TINY
+        )
+        weighted_death_rate = normal_death_rate + critical_excess_death_rate * underserved_share
+
+        new_infections = np.matmul(contact_matrix, i[..., np.newaxis])[..., 0] * s
+        new_deaths = weighted_death_rate * i
+        new_recoveries = recovery_rate * i
+
+        S[t + 1] = s - new_infections
+        I[t + 1] = i + new_infections - new_deaths - new_recoveries
+        R[t + 1] = R[t] + new_recoveries
+        D[t + 1] = D[t] + new_deaths
+        H[t + 1] = hospitalization_rate * I[t + 1]
+
+    predictions = {
+        "Susceptible": S,
+        "Infected": I,
+        "Recovered": R,
+        "Dead": D,
+        "Need Hospitalization": H,
+        "Total Cases": I + R + D,
+    }
+
+    return {status: np.moveaxis(values, 0, -1) for status, values in predictions.items()}
+
 
-            s_t = S[-1] - self._infection_rate * I[-1] * S[-1] / population
-            i_t = (
-                I[-1]
-                + self._infection_rate * I[-1] * S[-1] / population
-                - (weighted_death_rate + self._recovery_rate) * I[-1]
+def integrate_metapopulation_sir(
+    susceptible,
+    infected,
+    recovered,
+    dead,
+    num_days,
+    infection_rate,
+    recovery_rate,
+    normal_death_rate,
+    critical_death_rate,
+    hospitalization_rate,
+    hospital_capacity,
+    coupling=None,
+):
+    """
+    Integrate the SIR equations of coupled regions on preallocated float64 arrays.
+
+    The arguments are as for integrate_sir, with the region along the first axis. Susceptible people of region r are
+    infected at infection_rate[r] times the infected share of the populations they meet, coupling @ (I / population),
+    and every region keeps its own hospital-capacity death-rate switch. The coupling product is the only step that
+    mixes regions, so a sparse coupling keeps hundreds of regions cheap.
+
+    :param coupling: Square matrix, dense or scipy.sparse, see MetapopulationSIRModel. None for isolated regions,
+        which then match integrate_sir with rounded=False.
+    :return: Dict of status -> array of shape (regions, ...) + (num_days + 1,).
+    """
+    (
+        susceptible,
+        infected,
+        recovered,
+        dead,
+        infection_rate,
+        recovery_rate,
+        normal_death_rate,
+        critical_death_rate,
+        hospitalization_rate,
+        hospital_capacity,
+    ) = np.broadcast_arrays(
+        *(
+            np.asarray(x, dtype=np.float64)
+            for x in (
+                susceptible,
+                infected,
+                recovered,
+                dead,
+                infection_rate,
+                recovery_rate,
+                normal_death_rate,
+                critical_death_rate,
+                hospitalization_rate,
+                hospital_capacity,
             )
-            r_t = R[-1] + self._recovery_rate * I[-1]
-            d_t = D[-1] + weighted_death_rate * I[-1]
-
-            h_t = self._hospitalization_rate * i_t
-            
-            t_c = i_t + r_t + d_t
-
-            S.append(round(s_t))
-            I.append(round(i_t))
-            R.append(round(r_t))
-            D.append(round(d_t))
-            H.append(round(h_t))
-            T.append(round(t_c))
-
-        # Days with no change in I
-        days_to_clip = [I[-i] == I[-i - 1] for i in range(1, len(I))]
-        index_to_clip = days_to_clip.index(False)
-        if index_to_clip == 0:
-            index_to_clip = 1
-
-        # Look at at least a few months
-        index_to_clip = min(index_to_clip, _DEFAULT_TIME_SCALE - 3 * 31)
-
-        return {
-            "Susceptible": S,
-            "Infected": I,
-            "Recovered": R,
-            "Dead": D,
-            "Need Hospitalization": H,
-            "Total Cases": T
-        }
+        )
+    )
+
+    population = susceptible + infected + recovered + dead
+    num_regions = population.shape[0]
+
+    state = np.empty((num_days + 1, 6) + population.shape, dtype=np.float64)
+    S, I, R, D, H, T = (state[:, k] for k in range(6))
+
+    S[0], I[0], R[0], D[0] = susceptible, infected, recovered, dead
+    H[0] = hospitalization_rate * infected
+    T[0] = I[0] + R[0] + D[0]
+
+    # Use the observed case fatality rate when we have one.
+    has_deaths = D[0] > 0
+    normal_death_rate = np.where(has_deaths, D[0] / np.where(has_deaths, I[0], 1), normal_death_rate)
+
+    # Empty regions never have anyone infected, so guarding their size is enough
+    inverse_population = 1 / np.maximum(population, _TINY)
+
+    for t in range(num_days):
+        s, i = S[t], I[t]
+
+        underserved_critically_ill_proportion = np.fmax(H[t] - hospital_capacity, 0) / np.maximum(i, _TINY)
+        weighted_death_rate = (
+            normal_death_rate * (1 - underserved_critically_ill_proportion)
+            + critical_death_rate * underserved_critically_ill_proportion
+        )
+
+        infected_share = i * inverse_population
+        if coupling is not None:
+            # Sparse matrices only multiply 2-d arrays, so flatten any batch axes after the region
+            infected_share = (coupling @ infected_share.reshape(num_regions, -1)).reshape(infected_share.shape)
+
+        new_infections = infection_rate * infected_share * s
+
+        S[t + 1] = s - new_infections
+        I[t + 1] = i + new_infections - (weighted_death_rate + recovery_rate) * i
+        R[t + 1] = R[t] + recovery_rate * i
+        D[t + 1] = D[t] + weighted_death_rate * i
+        H[t + 1] = hospitalization_rate * I[t + 1]
+        T[t + 1] = I[t + 1] + R[t + 1] + D[t + 1]
+
+    predictions = {
+        "Susceptible": S,
+        "Infected": I,
+        "Recovered": R,
+        "Dead": D,
+        "Need Hospitalization": H,
+        "Total Cases": T,
+    }
+
+    return {status: np.moveaxis(values, 0, -1) for status, values in predictions.items()}
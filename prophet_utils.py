@@ -0,0 +1,298 @@
+"""
+Compact persistence of fitted Prophet models.
+
+A fitted Prophet object carries its whole training frame, Stan backend and fitting state, and unpickling it imports
+all of that. Predicting only needs the fitted parameters, the scaling of time and cases, the seasonalities and the
+dates of the history, so those are saved to a small .npz file and loaded back into a ProphetPredictor, a NumPy
+reimplementation of the parts of Prophet's predict used by forecast_utils. Models with logistic growth, holidays,
+extra regressors or conditional seasonalities aren't supported.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+SLIM_FORMAT_VERSION = 1
+
+_PARAMETERS = ["k", "m", "delta", "beta", "sigma_obs"]
+
+_EPOCH = pd.Timestamp("1970-01-01")
+
+
+def get_parameters(model):
+    """
+    Extract what a fitted Prophet model needs to predict.
+    :param model: Fitted Prophet model.
+    :return: Dict of metadata and dict of name -> array.
+    """
+
+    if model.growth != "linear" or model.logistic_floor:
+        raise ValueError("Only linear growth is supported, not {}".format(model.growth))
+
+    if model.holidays is not None or model.extra_regressors or getattr(model, "country_holidays", None):
+        raise ValueError("Holidays and extra regressors aren't supported")
+
+    if any(props.get("condition_name") is not None for props in model.seasonalities.values()):
+        raise ValueError("Conditional seasonalities aren't supported")
+
+    meta = {
+        "version": SLIM_FORMAT_VERSION,
+        "start": model.start.isoformat(),
+        "t_scale": model.t_scale.total_seconds(),
+        "y_scale": float(model.y_scale),
+        # Cases are offset by the floor, which is only non-zero for Prophet's "minmax" scaling
+        "floor": float(model.y_min) if getattr(model, "scaling", "absmax") == "minmax" else 0.0,
+        "interval_width": model.interval_width,
+        "uncertainty_samples": int(model.uncertainty_samples),
+        # In the order of Prophet's feature matrix, which the fitted betas follow
+        "seasonalities": [
+            {"name": name, "period": props["period"], "fourier_order": props["fourier_order"], "mode": props["mode"]}
+            for name, props in model.seasonalities.items()
+        ],
+    }
+
+    arrays = {name: np.asarray(model.params[name], dtype=np.float64) for name in _PARAMETERS}
+
+    arrays["changepoints_t"] = np.asarray(model.changepoints_t, dtype=np.float64)
+    arrays["history_ds"] = model.history["ds"].to_numpy(dtype="datetime64[ns]")
+    arrays["history_y"] = model.history["y"].to_numpy(dtype=np.float64)
+
+    return meta, arrays
+
+
+def save_parameters(model, fname, compress=True):
+    """
+    Save the parameters of a fitted Prophet model.
+    :param model: Fitted Prophet model.
+    :param fname: Filename, ending in .npz.
+    :param compress: Deflate the arrays. Smaller files, slightly slower loads.
+    :return: fname.
+    """
+
+    meta, arrays = get_parameters(model)
+
+    save = np.savez_compressed if compress else np.savez
+
+    # Saved through a handle, since np.savez appends .npz to filenames that don't end with it
+    with open(fname, "wb") as handle:
+
+        save(handle, meta=np.array(json.dumps(meta)), **arrays)
+
+    return fname
+
+
+def load_parameters(fname):
+    """
+    :param fname: File saved by save_parameters.
+    :return: ProphetPredictor.
+    """
+
+    with np.load(fname) as saved:
+
+        meta = json.loads(str(saved["meta"]))
+
+        arrays = {name: saved[name] for name in saved.files if name != "meta"}
+
+    if meta["version"] != SLIM_FORMAT_VERSION:
+        raise ValueError("Unknown model format version: {}".format(meta["version"]))
+
+    return ProphetPredictor(meta, arrays)
+
+
+class ProphetPredictor:
+    """
+    Predictions of a fitted Prophet model from its saved parameters, with the same make_future_dataframe, predict
+    and history as the model. Trends, seasonalities and yhat match Prophet's. The uncertainty intervals are Monte
+    Carlo estimates like Prophet's, with its vectorised sampling of future trend changes.
+    """
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.params = {name: arrays[name] for name in _PARAMETERS}
+        self.changepoints_t = arrays["changepoints_t"]
+        self.start = pd.Timestamp(meta["start"])
+        self.history = pd.DataFrame({"ds": pd.to_datetime(arrays["history_ds"]), "y": arrays["history_y"]})
+        self.history_dates = pd.Series(np.unique(arrays["history_ds"]))
+
+    def make_future_dataframe(self, periods, freq="D", include_history=True):
+
+        last_date = self.history_dates.max()
+
+        dates = pd.date_range(start=last_date, periods=periods + 1, freq=freq)
+        dates = dates[dates > last_date][:periods]
+
+        if include_history:
+            dates = np.concatenate((np.array(self.history_dates), dates))
+
+        return pd.DataFrame({"ds": dates})
+
+    def _get_t(self, ds):
+        return ((ds - self.start).dt.total_seconds() / self.meta["t_scale"]).to_numpy()
+
+    def _get_seasonal_terms(self, ds):
+        """
+        :return: Additive and multiplicative seasonal terms, of shape (iteration, date). Additive terms are in cases.
+        """
+
+        days = ((ds - _EPOCH).dt.total_seconds() / (24 * 60 * 60)).to_numpy()
+
+        features, modes = [], []
+
+        for props in self.meta["seasonalities"]:
+
+            for i in range(props["fourier_order"]):
+
+                x = 2 * np.pi * (i + 1) * days / props["period"]
+
+                features += [np.sin(x), np.cos(x)]
+                modes += [props["mode"]] * 2
+
+        if not features:
+            zeros = np.zeros((self.params["beta"].shape[0], len(ds)))
+            return zeros, zeros
+
+        features = np.column_stack(features)
+        additive = np.array([mode == "additive" for mode in modes])
+
+        beta = self.params["beta"]
+
+        return (
+            (beta * additive) @ features.T * self.meta["y_scale"],
+            (beta * ~additive) @ features.T,
+        )
+
+    @staticmethod
+    def _piecewise_linear(t, deltas, k, m, changepoints_t):
+        deltas_t = (changepoints_t[None, :] <= t[..., None]) * deltas
+        return (deltas_t.sum(axis=1) + k) * t + (deltas_t * -changepoints_t).sum(axis=1) + m
+
+    def _sample_trend_changes(self, t, num_samples, iteration, rng):
+        """
+        Sample future changes of the trend, the way Prophet's vectorised sampler does: every future step can change
+        the slope with the historical frequency of changepoints, by a Laplace amount of their historical size.
+        :return: Scaled trend changes of shape (num_samples, len(t)), zero up to the end of the history.
+        """
+
+        changes = np.zeros((num_samples, len(t)))
+
+        future = t > 1
+
+        if not future.any():
+            return changes
+
+        if future.sum() > 1:
+            single_diff = np.diff(t[future]).mean()
+        else:
+            single_diff = np.diff(self._get_t(self.history["ds"])).mean()
+
+        likelihood = len(self.changepoints_t) * single_diff
+        mean_delta = np.mean(np.abs(self.params["delta"][iteration])) + 1e-8
+
+        shape = (num_samples, future.sum())
+
+        shifts = rng.laplace(0, mean_delta, size=shape) * (rng.uniform(size=shape) < likelihood)
+        shifts = (np.hstack([np.zeros((num_samples, 1)), shifts])[:, :-1] + shifts) / 2
+
+        changes[:, future] = shifts.cumsum(axis=1).cumsum(axis=1) * single_diff
+
+        return changes
+
+    def predict(self, df=None, seed=None):
+        """
+        :param df: DataFrame with a ds column, the history if None.
+        :param seed: Seed for the uncertainty samples.
+        :return: DataFrame with ds, trend, yhat, yhat_lower and yhat_upper columns.
+        """
+
+        ds = pd.to_datetime((self.history if df is None else df)["ds"]).sort_values(kind="mergesort")
+        ds = ds.reset_index(drop=True)
+
+        t = self._get_t(ds)
+
+        y_scale, floor = self.meta["y_scale"], self.meta["floor"]
+
+        k, m, delta = self.params["k"], self.params["m"], self.params["delta"]
+
+        trend = self._piecewise_linear(
+            t, np.nanmean(delta, axis=0), np.nanmean(k), np.nanmean(m), self.changepoints_t
+        ) * y_scale + floor
+
+        additive, multiplicative = self._get_seasonal_terms(ds)
+
+        yhat = trend * (1 + np.nanmean(multiplicative, axis=0)) + np.nanmean(additive, axis=0)
+
+        result = pd.DataFrame({"ds": ds, "trend": trend})
+
+        num_samples = self.meta["uncertainty_samples"]
+
+        if num_samples:
+
+            rng = np.random.default_rng(seed)
+
+            num_iterations = k.shape[0]
+            samples_per_iteration = max(1, int(np.ceil(num_samples / num_iterations)))
+
+            samples = []
+
+            for i in range(num_iterations):
+
+                trends = self._piecewise_linear(t, delta[i], k[i], m[i], self.changepoints_t)
+                trends = (trends + self._sample_trend_changes(t, samples_per_iteration, i, rng)) * y_scale + floor
+
+                noise = rng.normal(0, self.params["sigma_obs"][i], trends.shape) * y_scale
+
+                samples += [trends * (1 + multiplicative[i]) + additive[i] + noise]
+
+            samples = np.concatenate(samples)
+
+            width = self.meta["interval_width"]
+
+            result["yhat_lower"] = np.nanpercentile(samples, 100 * (1 - width) / 2, axis=0)
+            result["yhat_upper"] = np.nanpercentile(samples, 100 * (1 + width) / 2, axis=0)
+
+        result["yhat"] = yhat
+
+        return result
+
+
+def benchmark(joblib_fnames, compress=True, repeat=5):
+    """
+    Compare the size and load time of pickled Prophet models with their slim equivalents.
+    :param joblib_fnames: Filenames of joblib dumps of fitted Prophet models.
+    :param compress: Compress the slim files.
+    :param repeat: Loads timed per file, the fastest one is reported.
+    :return: DataFrame indexed by filename, with the sizes in bytes and load times in seconds of both formats.
+    """
+
+    def fastest_load(load, fname):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            load(fname)
+            timings += [time.perf_counter() - start]
+        return min(timings)
+
+    rows = []
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        for fname in joblib_fnames:
+
+            slim_fname = save_parameters(
+                joblib.load(fname), os.path.join(directory, os.path.basename(fname) + ".npz"), compress
+            )
+
+            rows += [{
+                "Model": fname,
+                "Joblib Bytes": os.path.getsize(fname),
+                "Slim Bytes": os.path.getsize(slim_fname),
+                "Joblib Load Seconds": fastest_load(joblib.load, fname),
+                "Slim Load Seconds": fastest_load(load_parameters, slim_fname),
+            }]
+
+    return pd.DataFrame(rows).set_index("Model")
@@ -0,0 +1,365 @@
+"""
+Offline precomputation of SIR scenarios.
+
+Every region of a snapshot is simulated for every contact rate offered by the sidebar slider over the longest
+prediction horizon, and the results are stored in one memory-mapped array with a JSON index next to the processed
+pickles. Serving a prediction is then a slice of that array instead of a simulation.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import calibration_utils
+import data.constants as constants
+import models
+
+TIME_STAMP_FORMAT = '%d-%m-%Y-%H-%M-%S'
+
+CONTACT_RATES = list(range(constants.AverageDailyContacts.min, constants.AverageDailyContacts.max + 1))
+
+# Mapping of the last cube loaded, cube filename -> (cube, index). Older snapshots' cubes are released on refresh
+_loaded_cubes = {}
+
+
+def get_cube_filenames(timestamp):
+
+    suffix = timestamp.strftime(TIME_STAMP_FORMAT)
+
+    cube_fname = os.path.join(constants.PROCESSED_DIR, "scenario_cube_{}.npy".format(suffix))
+
+    index_fname = os.path.join(constants.PROCESSED_DIR, "scenario_cube_{}.json".format(suffix))
+
+    return cube_fname, index_fname
+
+
+def get_region_data(country_data, regions):
+    """
+    Collect the latest statistics of several regions into one array per column.
+    :param country_data: Dict of region -> dict with Confirmed, Recovered, Deaths, Population and Num Hospital Beds.
+    :param regions: Regions to collect.
+    :return: Dict of column -> array with one entry per region.
+    """
+
+    return {
+        column: np.array([country_data[region][column] for region in regions], dtype=np.float64)
+        for column in ["Confirmed", "Recovered", "Deaths", "Population", "Num Hospital Beds"]
+    }
+
+
+def simulate_regions(country_data, regions, contact_rates=CONTACT_RATES, num_days=constants.MAX_PREDICTION_DAYS,
+                     transmission_rates=constants.TransmissionRatePerContact.default):
+    """
+    Simulate every region for every contact rate with the default constants, exactly as run_app would.
+    :param country_data: Dict of region -> dict with Confirmed, Recovered, Deaths, Population and Num Hospital Beds.
+    :param regions: Regions to simulate.
+    :param contact_rates: Contact rates to simulate for each region.
+    :param num_days: Number of days to forecast.
+    :param transmission_rates: Transmission rate per contact, scalar or one per region.
+    :return: Array of shape (region, contact rate, status, day), statuses ordered like models._STATUSES_TO_SHOW.
+    """
+
+    # Regions along the first axis, contact rates along the second
+    region_data = {k: v[:, np.newaxis] for k, v in get_region_data(country_data, regions).items()}
+
+    transmission_rates = np.broadcast_to(np.asarray(transmission_rates, dtype=np.float64), (len(regions),))
+
+    predictions = predict_regions(
+        region_data, np.asarray(contact_rates, dtype=np.float64)[np.newaxis, :], num_days,
+        transmission_rates[:, np.newaxis],
+    )
+
+    return np.stack([predictions[status] for status in models._STATUSES_TO_SHOW], axis=2)
+
+
+def predict_regions(region_data, contact_rate, num_days,
+                    transmission_rate=constants.TransmissionRatePerContact.default):
+    """
+    Run the SIR model for all regions in one array pass, with the default constants.
+    :param region_data: Dict of column -> per-region array, as returned by get_region_data.
+    :param contact_rate: Mean number of daily contacts, scalar or broadcastable against the regions.
+    :param num_days: Number of days to forecast.
+    :param transmission_rate: Transmission rate per contact, scalar or broadcastable against the regions.
+    :return: Dict of status -> array of shape regions + (num_days + 1,).
+    """
+
+    return models.get_region_predictions(
+        cases_estimator=models.TrueInfectedCasesModel(constants.ReportingRate.default),
+        sir_model=get_sir_model(region_data, contact_rate, transmission_rate),
+        num_diagnosed=region_data["Confirmed"],
+        num_recovered=region_data["Recovered"],
+        num_deaths=region_data["Deaths"],
+        area_population=region_data["Population"],
+        max_days=num_days,
+    )
+
+
+def get_sir_model(region_data, contact_rate, transmission_rate=constants.TransmissionRatePerContact.default):
+    """
+    SIR model of all regions with the default constants, as run_app builds it.
+    :param region_data: Dict of column -> per-region array, as returned by get_region_data.
+    :param contact_rate: Mean number of daily contacts, scalar or broadcastable against the regions.
+    :param transmission_rate: Transmission rate per contact, scalar or broadcastable against the regions, e.g. the
+        calibrated ones of calibration_utils.get_transmission_rates.
+    """
+
+    return models.SIRModel(
+        transmission_rate_per_contact=transmission_rate,
+        contact_rate=contact_rate,
+        recovery_rate=constants.RecoveryRate.default,
+        normal_death_rate=constants.MortalityRate.default,
+        critical_death_rate=constants.CriticalDeathRate.default,
+        hospitalization_rate=constants.HospitalizationRate.default,
+        hospital_capacity=region_data["Num Hospital Beds"],
+    )
+
+
+def get_max_contact_rates(country_data, regions, num_days=constants.MAX_PREDICTION_DAYS, method="simulate",
+                          transmission_rates=constants.TransmissionRatePerContact.default):
+    """
+    Find, for all regions in one batch, the highest contact rate that keeps Need Hospitalization within the region's
+    hospital beds, with the default constants.
+    :param country_data: Dict of region -> dict with Confirmed, Recovered, Deaths, Population and Num Hospital Beds.
+    :param regions: Regions to solve for.
+    :param num_days: Number of days to forecast.
+    :param method: "simulate" or "analytic", see models.SIRModel.get_max_contact_rate.
+    :param transmission_rates: Transmission rate per contact, scalar or one per region.
+    :return: Series of contact rates indexed by region, see models.SIRModel.get_max_contact_rate.
+    """
+
+    region_data = get_region_data(country_data, regions)
+
+    true_cases = models.TrueInfectedCasesModel(constants.ReportingRate.default).predict(region_data["Confirmed"])
+
+    sir_model = get_sir_model(
+        region_data, constants.AverageDailyContacts.default, np.asarray(transmission_rates, dtype=np.float64)
+    )
+
+    max_contact_rates = sir_model.get_max_contact_rate(
+        susceptible=region_data["Population"] - true_cases - region_data["Recovered"] - region_data["Deaths"],
+        infected=true_cases,
+        recovered=region_data["Recovered"],
+        dead=region_data["Deaths"],
+        num_days=num_days,
+        method=method,
+    )
+
+    return pd.Series(max_contact_rates, index=pd.Index(regions, name="Region"), name="Max Contact Rate")
+
+
+def rank_all_regions(data, contact_rate=constants.AverageDailyContacts.default,
+                     num_days=constants.MAX_PREDICTION_DAYS, by="Dead"):
+    """
+    Project every region of a snapshot, e.g. all Global countries, in one pass and rank them.
+    :param data: Countries or Global snapshot.
+    :param contact_rate: Mean number of daily contacts applied to every region.
+    :param num_days: Number of days to forecast.
+    :param by: Column of models.rank_regions to rank by.
+    :return: DataFrame with one row per region.
+    """
+
+    regions = get_simulated_regions(data)
+
+    region_data = get_region_data(data.country_data, regions)
+
+    predictions = predict_regions(region_data, contact_rate, num_days)
+
+    return models.rank_regions(regions, predictions, region_data["Num Hospital Beds"], by=by)
+
+
+def predict_states(data, contact_rate=constants.AverageDailyContacts.default, num_days=constants.MAX_PREDICTION_DAYS,
+                   trips=None, national_region="Australia"):
+    """
+    Simulate the states of a country as one coupled system, with the national curve summed from the states instead
+    of simulated separately.
+    :param data: Countries snapshot.
+    :param contact_rate: Mean number of daily contacts applied to every state.
+    :param num_days: Number of days to forecast.
+    :param trips: Daily trips between the states, dense or scipy.sparse, in the order of the returned states.
+        Defaults to models.get_gravity_trips with constants.InterstateTravelRate.
+    :param national_region: Region of the snapshot holding the national totals, left out of the states.
+    :return: List of states, dict of status -> array of shape (state, day), and dict of status -> national array.
+    """
+
+    states = [region for region in get_simulated_regions(data) if region != national_region]
+
+    region_data = get_region_data(data.country_data, states)
+
+    if trips is None:
+        trips = models.get_gravity_trips(region_data["Population"], constants.InterstateTravelRate.default)
+
+    true_cases = models.TrueInfectedCasesModel(constants.ReportingRate.default).predict(region_data["Confirmed"])
+
+    sir_model = models.MetapopulationSIRModel(
+        transmission_rate_per_contact=constants.TransmissionRatePerContact.default,
+        contact_rate=contact_rate,
+        recovery_rate=constants.RecoveryRate.default,
+        normal_death_rate=constants.MortalityRate.default,
+        critical_death_rate=constants.CriticalDeathRate.default,
+        hospitalization_rate=constants.HospitalizationRate.default,
+        hospital_capacity=region_data["Num Hospital Beds"],
+        coupling=models.get_coupling_matrix(trips, region_data["Population"]),
+    )
+
+    predictions = sir_model.predict(
+        susceptible=region_data["Population"] - true_cases - region_data["Recovered"] - region_data["Deaths"],
+        infected=true_cases,
+        recovered=region_data["Recovered"],
+        dead=region_data["Deaths"],
+        num_days=num_days,
+    )
+
+    return states, predictions, {status: values.sum(axis=0) for status, values in predictions.items()}
+
+
+def get_simulated_regions(data):
+
+    # Regions without people can't be simulated, run_app falls back to get_predictions for those
+    return [region for region in data.countries if data.country_data[region]["Population"] > 0]
+
+
+def build_scenario_cube(country_data, global_data, num_days=constants.MAX_PREDICTION_DAYS):
+    """
+    Precompute the SIR predictions of every region in both datasets and save them as a memory-mappable .npy file,
+    with a JSON index mapping each dataset and region to its row. Regions are simulated with their calibrated
+    transmission rates, so the calibration of the snapshot has to be built first.
+    :param country_data: Countries snapshot.
+    :param global_data: Global snapshot with the same timestamp.
+    :param num_days: Longest horizon to simulate; shorter horizons are prefixes of it.
+    :return: Filenames of the cube and of its index.
+    """
+
+    print("Building scenario cube")
+
+    datasets = {"country": country_data, "global": global_data}
+
+    regions = {name: get_simulated_regions(data) for name, data in datasets.items()}
+
+    num_rows = sum(len(x) for x in regions.values())
+
+    max_population = max(data.country_data[region]["Population"]
+                         for name, data in datasets.items() for region in regions[name])
+
+    # Every compartment is bounded by the population, which fits in 32 bits for every country on earth
+    dtype = np.int32 if max_population < np.iinfo(np.int32).max else np.int64
+
+    cube_fname, index_fname = get_cube_filenames(country_data.timestamp)
+
+    cube = np.lib.format.open_memmap(
+        cube_fname,
+        mode="w+",
+        dtype=dtype,
+        shape=(num_rows, len(CONTACT_RATES), len(models._STATUSES_TO_SHOW), num_days + 1),
+    )
+
+    index = {
+        "timestamp": country_data.timestamp.strftime(TIME_STAMP_FORMAT),
+        "num_days": num_days,
+        "contact_rates": CONTACT_RATES,
+        "statuses": models._STATUSES_TO_SHOW,
+        "regions": {},
+    }
+
+    row = 0
+
+    for name, data in datasets.items():
+
+        transmission_rates = calibration_utils.get_transmission_rates(
+            regions[name], data.timestamp, global_flag=name == "global"
+        )
+
+        cube[row:row + len(regions[name])] = simulate_regions(
+            data.country_data, regions[name], num_days=num_days, transmission_rates=transmission_rates
+        )
+
+        index["regions"][name] = {region: row + i for i, region in enumerate(regions[name])}
+
+        row += len(regions[name])
+
+    cube.flush()
+
+    del cube
+
+    # Write the index last so a reader never sees an index for a partially written cube
+    with open(index_fname, "w") as handle:
+
+        json.dump(index, handle)
+
+    print("Saved scenario cube to:", cube_fname)
+
+    return cube_fname, index_fname
+
+
+def load_scenario_cube(timestamp):
+    """
+    Memory-map the scenario cube of a snapshot. Only the mapping of the last snapshot loaded is kept, so the cubes
+    of older snapshots are unmapped once a newer one is used.
+    :param timestamp: Snapshot timestamp.
+    :return: Read-only cube array and its index.
+    """
+
+    cube_fname, index_fname = get_cube_filenames(timestamp)
+
+    loaded = _loaded_cubes.get(cube_fname)
+
+    if loaded is None:
+
+        with open(index_fname, "r") as handle:
+
+            index = json.load(handle)
+
+        loaded = np.load(cube_fname, mmap_mode="r"), index
+
+        _loaded_cubes.clear()
+
+        _loaded_cubes[cube_fname] = loaded
+
+    return loaded
+
+
+def get_predictions(region, contact_rate, max_days, timestamp, global_flag=False):
+    """
+    Look up precomputed SIR predictions. Equivalent to models.get_predictions with the region's calibrated
+    transmission rate and the default other constants, and memoised in the same cache.
+    :param region: Country or state name.
+    :param contact_rate: Mean number of daily contacts, one of CONTACT_RATES.
+    :param max_days: Number of days to forecast, at most the horizon the cube was built for.
+    :param timestamp: Snapshot timestamp.
+    :param global_flag: Look the region up in the Global dataset instead of Countries.
+    :return: models.Predictions, like models.get_predictions.
+    """
+
+    key = ("scenario cube", region, contact_rate, max_days, global_flag)
+
+    predictions = models.PREDICTION_CACHE.get(key, snapshot=timestamp)
+
+    if predictions is not None:
+
+        return predictions
+
+    cube, index = load_scenario_cube(timestamp)
+
+    if max_days > index["num_days"]:
+
+        raise ValueError("Scenario cube only covers {} days".format(index["num_days"]))
+
+    row = index["regions"]["global" if global_flag else "country"][region]
+
+    scenario = cube[row, index["contact_rates"].index(contact_rate), :, :max_days + 1]
+
+    predictions = dict(zip(index["statuses"], scenario))
+
+    # Cut the days after the epidemic burned out, i.e. after S, I and H stopped changing, like get_predictions does
+    epidemic = np.stack([predictions[status] for status in ["Susceptible", "Infected", "Need Hospitalization"]])
+
+    changed = np.flatnonzero((epidemic[:, 1:] != epidemic[:, :-1]).any(axis=0))
+
+    steady_day = changed[-1] + 1 if len(changed) else 0
+
+    predictions = models.Predictions.from_dict({k: v[:steady_day + 1] for k, v in predictions.items()}, max_days)
+
+    models.PREDICTION_CACHE.put(key, predictions, snapshot=timestamp)
+
+    return predictions
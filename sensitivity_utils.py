@@ -0,0 +1,216 @@
+"""
+Global sensitivity analysis of the SIR model to the constants in data/constants.py.
+
+Constants are sampled over their min/max ranges, either by Latin hypercube (reported as rank correlations) or by
+Sobol sequences (reported as Sobol indices). The samples are evaluated in chunks, each chunk as one batched
+integrate_sir run, and only the outputs of interest are kept, so hundreds of thousands of samples fit in memory.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+from scipy.stats import qmc
+
+import data.constants as constants
+import models
+
+PARAMETERS = ["RecoveryRate", "CriticalDeathRate", "HospitalizationRate", "ReportingRate"]
+
+OUTPUTS = ["Dead", "Peak Need Hospitalization"]
+
+# Scenarios per batched run. A chunk holds six float64 compartments per scenario and day.
+CHUNK_SIZE = 2000
+
+
+def get_parameter_ranges(parameters=PARAMETERS):
+    """
+    :param parameters: Names of constant classes in data/constants.py that have a min and a max.
+    :return: Arrays of the lower and upper bounds, in the order of parameters.
+    """
+
+    return (
+        np.array([getattr(constants, name).min for name in parameters], dtype=np.float64),
+        np.array([getattr(constants, name).max for name in parameters], dtype=np.float64),
+    )
+
+
+def evaluate(samples, parameters, num_diagnosed, num_recovered, num_deaths, area_population, hospital_capacity,
+             num_days=constants.MAX_PREDICTION_DAYS, chunk_size=CHUNK_SIZE):
+    """
+    Run the SIR model for every sample of constants, chunk by chunk. Constants that aren't sampled keep their
+    defaults, and the region's statistics are turned into an initial state as get_predictions does.
+    :param samples: Array of shape (num_samples, len(parameters)) of constant values.
+    :param parameters: Names of the sampled constant classes.
+    :param num_diagnosed: Number of diagnosed cases in the region.
+    :param num_recovered: Number of recovered people in the region.
+    :param num_deaths: Number of dead people in the region.
+    :param area_population: Population of the region.
+    :param hospital_capacity: Hospital beds of the region.
+    :param num_days: Number of days to forecast.
+    :param chunk_size: Samples per batched run.
+    :return: Dict of output -> array of length num_samples, for OUTPUTS.
+    """
+
+    outputs = {output: np.empty(len(samples)) for output in OUTPUTS}
+
+    names = [
+        "TransmissionRatePerContact",
+        "AverageDailyContacts",
+        "RecoveryRate",
+        "MortalityRate",
+        "CriticalDeathRate",
+        "HospitalizationRate",
+        "ReportingRate",
+    ]
+
+    for start in range(0, len(samples), chunk_size):
+
+        chunk = samples[start:start + chunk_size]
+
+        values = {name: getattr(constants, name).default for name in names}
+        values.update({name: chunk[:, k] for k, name in enumerate(parameters)})
+
+        infected = num_diagnosed / values["ReportingRate"]
+
+        predictions = models.integrate_sir(
+            susceptible=area_population - infected - num_recovered - num_deaths,
+            infected=infected,
+            recovered=num_recovered,
+            dead=num_deaths,
+            num_days=num_days,
+            infection_rate=values["TransmissionRatePerContact"] * values["AverageDailyContacts"],
+            recovery_rate=values["RecoveryRate"],
+            normal_death_rate=values["MortalityRate"] * values["RecoveryRate"],
+            critical_death_rate=values["CriticalDeathRate"] * values["RecoveryRate"],
+            hospitalization_rate=values["HospitalizationRate"],
+            hospital_capacity=hospital_capacity,
+            rounded=False,
+            early_stop=True,
+        )
+
+        outputs["Dead"][start:start + len(chunk)] = predictions["Dead"][..., -1]
+        outputs["Peak Need Hospitalization"][start:start + len(chunk)] = predictions["Need Hospitalization"].max(
+            axis=-1
+        )
+
+    return outputs
+
+
+def analyse(num_diagnosed, num_recovered, num_deaths, area_population, hospital_capacity, num_samples=100000,
+            method="sobol", parameters=PARAMETERS, num_days=constants.MAX_PREDICTION_DAYS, chunk_size=CHUNK_SIZE,
+            seed=None):
+    """
+    Measure how much each constant drives deaths and peak hospitalizations in a region.
+
+    With method "lhs", num_samples Latin hypercube samples are drawn and each constant gets the Spearman rank
+    correlation between its values and each output. With method "sobol", the Saltelli scheme evaluates two Sobol
+    sample matrices A and B plus one matrix per constant mixing them, and each constant gets its first order and
+    total order Sobol index (Saltelli 2010 and Jansen estimators). num_samples is rounded up to a power of two and
+    the model is then run num_samples * (len(parameters) + 2) times.
+
+    :param num_diagnosed: Number of diagnosed cases in the region.
+    :param num_recovered: Number of recovered people in the region.
+    :param num_deaths: Number of dead people in the region.
+    :param area_population: Population of the region.
+    :param hospital_capacity: Hospital beds of the region.
+    :param num_samples: Number of samples.
+    :param method: "sobol" or "lhs".
+    :param parameters: Names of constant classes in data/constants.py to vary between their min and max.
+    :param num_days: Number of days to forecast.
+    :param chunk_size: Samples per batched run.
+    :param seed: Seed for the samplers.
+    :return: DataFrame indexed by (Output, Parameter).
+    """
+
+    print("Running {} sensitivity analysis".format(method))
+
+    lower, upper = get_parameter_ranges(parameters)
+
+    region = dict(
+        num_diagnosed=num_diagnosed,
+        num_recovered=num_recovered,
+        num_deaths=num_deaths,
+        area_population=area_population,
+        hospital_capacity=hospital_capacity,
+        num_days=num_days,
+        chunk_size=chunk_size,
+    )
+
+    index = pd.MultiIndex.from_product([OUTPUTS, parameters], names=["Output", "Parameter"])
+
+    if method == "lhs":
+
+        samples = qmc.scale(qmc.LatinHypercube(d=len(parameters), seed=seed).random(num_samples), lower, upper)
+
+        outputs = evaluate(samples, parameters, **region)
+
+        correlations = [
+            scipy.stats.spearmanr(samples[:, k], outputs[output])[0]
+            for output in OUTPUTS
+            for k in range(len(parameters))
+        ]
+
+        return pd.DataFrame({"Rank Correlation": correlations}, index=index)
+
+    if method != "sobol":
+
+        raise ValueError("Unknown method: {}".format(method))
+
+    num_parameters = len(parameters)
+
+    # A and B are the two halves of one Sobol sequence of twice the dimension
+    base = qmc.Sobol(d=2 * num_parameters, seed=seed).random_base2(int(np.ceil(np.log2(num_samples))))
+    a = qmc.scale(base[:, :num_parameters], lower, upper)
+    b = qmc.scale(base[:, num_parameters:], lower, upper)
+
+    # Stream the base rows in chunks, evaluating A, B and every A_B^i of a chunk in one batch, and keep running
+    # sums for the estimators
+    sums = {
+        output: {"a": 0.0, "a2": 0.0, "b": 0.0, "b2": 0.0, "first": np.zeros(num_parameters),
+                 "total": np.zeros(num_parameters)}
+        for output in OUTPUTS
+    }
+
+    rows_per_chunk = max(chunk_size // (num_parameters + 2), 1)
+
+    for start in range(0, len(a), rows_per_chunk):
+
+        a_chunk, b_chunk = a[start:start + rows_per_chunk], b[start:start + rows_per_chunk]
+
+        mixed = np.repeat(a_chunk[np.newaxis], num_parameters, axis=0)
+        mixed[np.arange(num_parameters), :, np.arange(num_parameters)] = b_chunk.T
+
+        samples = np.concatenate([a_chunk[np.newaxis], b_chunk[np.newaxis], mixed]).reshape(-1, num_parameters)
+
+        outputs = evaluate(samples, parameters, **{**region, "chunk_size": len(samples)})
+
+        for output in OUTPUTS:
+
+            y = outputs[output].reshape(num_parameters + 2, -1)
+            y_a, y_b, y_mixed = y[0], y[1], y[2:]
+
+            sums[output]["a"] += y_a.sum()
+            sums[output]["a2"] += (y_a ** 2).sum()
+            sums[output]["b"] += y_b.sum()
+            sums[output]["b2"] += (y_b ** 2).sum()
+            sums[output]["first"] += (y_b * (y_mixed - y_a)).sum(axis=1)
+            sums[output]["total"] += ((y_a - y_mixed) ** 2).sum(axis=1)
+
+    num_rows = len(a)
+
+    first_order, total_order = [], []
+
+    for output in OUTPUTS:
+
+        s = sums[output]
+
+        mean = (s["a"] + s["b"]) / (2 * num_rows)
+        variance = (s["a2"] + s["b2"]) / (2 * num_rows) - mean ** 2
+
+        # A constant output has no variance to apportion
+        variance = variance if variance > 0 else np.nan
+
+        first_order += list(s["first"] / num_rows / variance)
+        total_order += list(s["total"] / (2 * num_rows) / variance)
+
+    return pd.DataFrame({"First Order": first_order, "Total Order": total_order}, index=index)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# The modules under test live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data.constants as constants
+
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    """
+    Run in an empty temporary directory, with the data directories and the manifest under it at the same relative
+    paths as in the app.
+    :return: Dict of directory name -> path.
+    """
+    monkeypatch.chdir(tmp_path)
+    dirs = {}
+    for name in ["processed", "models", "outputs", "archive"]:
+        dirs[name] = os.path.join("data", name)
+        os.makedirs(dirs[name])
+    monkeypatch.setattr(constants, "PROCESSED_DIR", dirs["processed"])
+    monkeypatch.setattr(constants, "MODELS_DIR", dirs["models"])
+    monkeypatch.setattr(constants, "OUTPUTS_DIR", dirs["outputs"])
+    monkeypatch.setattr(constants, "ARCHIVE_DIR", dirs["archive"])
+    monkeypatch.setattr(constants, "MANIFEST_PATH", os.path.join(dirs["processed"], "manifest.json"))
+
+    # Imported here, since the model tests don't need the data modules
+    import data.io_utils as io_utils
+    monkeypatch.setattr(io_utils, "_manifest_cache", {"version": None, "manifest": {"snapshots": {}}})
+    return dirs
@@ -0,0 +1,135 @@
+"""
+Calibration of transmission rates and their use by the scenario cube.
+"""
+
+import datetime
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import calibration_utils
+import data.constants as constants
+import models
+import scenario_utils
+
+TIMESTAMP = datetime.datetime(2020, 4, 14, 9, 30)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch):
+    monkeypatch.setattr(calibration_utils, "_loaded_calibrations", {})
+    monkeypatch.setattr(scenario_utils, "_loaded_cubes", {})
+
+
+def simulate_history(transmission_rate, population, confirmed, hospital_capacity, num_days=21):
+    """
+    Confirmed cases of a region that follows the SIR model with the given transmission rate.
+    """
+    infected = confirmed / constants.ReportingRate.default
+    predictions = models.integrate_sir(
+        susceptible=population - infected,
+        infected=infected,
+        recovered=0,
+        dead=0,
+        num_days=num_days - 1,
+        infection_rate=transmission_rate * constants.AverageDailyContacts.default,
+        recovery_rate=constants.RecoveryRate.default,
+        normal_death_rate=constants.MortalityRate.default * constants.RecoveryRate.default,
+        critical_death_rate=constants.CriticalDeathRate.default * constants.RecoveryRate.default,
+        hospitalization_rate=constants.HospitalizationRate.default,
+        hospital_capacity=hospital_capacity,
+        rounded=False,
+    )
+    total_cases = predictions["Total Cases"]
+    return {
+        "Confirmed": confirmed + constants.ReportingRate.default * (total_cases - total_cases[0]),
+        "Recovered": np.zeros(num_days),
+        "Deaths": np.zeros(num_days),
+    }
+
+
+def make_snapshot(regions, timestamp=TIMESTAMP):
+    """
+    :param regions: Dict of region -> (transmission rate, population, confirmed cases on the first day).
+    """
+    rows, country_data = [], {}
+    for region, (transmission_rate, population, confirmed) in regions.items():
+        history = simulate_history(transmission_rate, population, confirmed, population * 0.003)
+        dates = pd.date_range("2020-03-25", periods=len(history["Confirmed"]))
+        rows.append(pd.DataFrame(dict(history, Date=dates, Region=region)))
+        country_data[region] = {
+            "Confirmed": history["Confirmed"][-1], "Recovered": 0, "Deaths": 0,
+            "Population": population, "Num Hospital Beds": population * 0.003,
+        }
+    return types.SimpleNamespace(
+        countries=list(regions), country_data=country_data, timestamp=timestamp,
+        historical_country_data=pd.concat(rows).set_index("Region"),
+    )
+
+
+def test_fit_recovers_the_transmission_rate():
+    history = simulate_history(0.025, 5e6, 500, 15000)
+
+    fit = calibration_utils.fit_transmission_rate(history, 5e6, 15000)
+
+    assert fit["Transmission Rate Per Contact"] == pytest.approx(0.025, rel=1e-3)
+    assert fit["Num Days"] == 21
+
+
+@pytest.mark.parametrize("population", [0, np.nan])
+def test_regions_without_a_population_are_skipped(population):
+    fit = calibration_utils.fit_transmission_rate(simulate_history(0.025, 5e6, 500, 15000), population, 15000)
+
+    assert np.isnan(fit["Transmission Rate Per Contact"])
+
+
+def test_regions_with_missing_counts_are_skipped():
+    history = simulate_history(0.025, 5e6, 500, 15000)
+    history["Recovered"][0] = np.nan
+
+    fit = calibration_utils.fit_transmission_rate(history, 5e6, 15000)
+
+    assert np.isnan(fit["Transmission Rate Per Contact"]) and np.isnan(fit["Loss"])
+
+
+def test_transmission_rates_default_when_not_calibrated(data_dirs):
+    default = constants.TransmissionRatePerContact.default
+
+    # No calibration for the snapshot yet
+    assert calibration_utils.get_transmission_rate("Australia", TIMESTAMP) == default
+
+    data = make_snapshot({"Australia": (0.02, 2.5e7, 3000), "Tiny": (0.02, 1e5, 5)})
+    calibration_utils.build_calibration(data, data, num_processes=1)
+
+    rates = calibration_utils.get_transmission_rates(["Australia", "Tiny", "Unknown"], TIMESTAMP)
+
+    assert rates[0] == pytest.approx(0.02, rel=1e-3)
+    assert list(rates[1:]) == [default, default]
+
+
+def test_scenario_cube_uses_the_calibrated_rates(data_dirs):
+    data = make_snapshot({"Australia": (0.02, 2.5e7, 3000), "Fiji": (0.03, 9e5, 40)})
+    calibration_utils.build_calibration(data, data, num_processes=1)
+    scenario_utils.build_scenario_cube(data, data, num_days=60)
+
+    for region in data.countries:
+        transmission_rate = calibration_utils.get_transmission_rate(region, TIMESTAMP)
+        region_data = data.country_data[region]
+
+        expected = models.get_predictions(
+            cases_estimator=models.TrueInfectedCasesModel(constants.ReportingRate.default),
+            sir_model=scenario_utils.get_sir_model(region_data, 10, transmission_rate),
+            num_diagnosed=region_data["Confirmed"],
+            num_recovered=region_data["Recovered"],
+            num_deaths=region_data["Deaths"],
+            area_population=region_data["Population"],
+            max_days=60,
+            early_stop=True,
+            cache=None,
+        )
+        predictions = scenario_utils.get_predictions(region, 10, 60, TIMESTAMP)
+
+        np.testing.assert_array_equal(predictions.values, expected.values)
+        np.testing.assert_array_equal(predictions.days, expected.days)
@@ -0,0 +1,220 @@
+"""
+The forecast store: writing, reading back and merging the forecasts of a snapshot.
+"""
+
+import datetime
+import glob
+import os
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data.io_utils as io_utils
+import forecast_utils
+
+TIMESTAMP = datetime.datetime(2020, 4, 14, 9, 30)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(monkeypatch):
+    # Every test has its own data directory, but the same snapshot timestamps
+    monkeypatch.setattr(forecast_utils, "_loaded_stores", {})
+    monkeypatch.setattr(forecast_utils, "_unchanged_regions", {})
+
+
+def make_forecast(start, confirmed):
+    confirmed = np.asarray(confirmed, dtype=np.float64)
+    return pd.DataFrame({
+        "date": pd.date_range(start, periods=len(confirmed)),
+        "confirmed": confirmed,
+        "lower_bound": confirmed * 0.9,
+        "upper_bound": confirmed * 1.1,
+    })
+
+
+def make_country_data(confirmed, timestamp=TIMESTAMP):
+    """
+    :param confirmed: Dict of region -> Series of cumulative cases indexed by date.
+    """
+    hist_data = pd.concat([
+        pd.DataFrame({"Country/Region": country, "Date": series.index, "Confirmed": series.to_numpy()})
+        for country, series in confirmed.items()
+    ]).set_index("Country/Region")
+    return types.SimpleNamespace(countries=list(confirmed), historical_country_data=hist_data, timestamp=timestamp)
+
+
+def assert_same_forecast(actual, expected):
+    expected = expected.copy()
+    for column in forecast_utils.FORECAST_COLUMNS:
+        expected[column] = np.round(expected[column]).astype(np.int64)
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+
+def test_store_round_trip(data_dirs):
+    forecasts = {
+        "forecast": {"Australia": make_forecast("2020-03-01", [10, 20, 40]), "Chad": make_forecast("2020-03-05", [1])},
+        "log": {"Australia": make_forecast("2020-02-28", [5, 10, 20, 40.4, 80.6])},
+    }
+
+    forecast_utils.write_forecast_store(forecasts, TIMESTAMP, backend="numpy", horizon=7)
+
+    for variant, frames in forecasts.items():
+        for country, df in frames.items():
+            assert_same_forecast(forecast_utils.read_forecast(country, TIMESTAMP, variant), df)
+
+    _, index = forecast_utils.load_forecast_store(TIMESTAMP)
+    assert (index["backend"], index["horizon"]) == ("numpy", 7)
+    with pytest.raises(KeyError):
+        forecast_utils.read_forecast("Chad", TIMESTAMP, "log")
+
+
+def test_store_drops_days_missing_from_a_forecast(data_dirs):
+    df = make_forecast("2020-04-07", [100, 110, 120, 130, 140, 150])
+    df = df[df["date"] != "2020-04-10"]
+
+    forecast_utils.write_forecast_store({"forecast": {"Australia": df}}, TIMESTAMP)
+
+    assert_same_forecast(forecast_utils.read_forecast("Australia", TIMESTAMP), df)
+
+
+def test_numpy_forecast_of_history_with_a_gap(data_dirs):
+    dates = pd.date_range("2020-03-20", "2020-04-13")
+    confirmed = pd.Series(np.round(50 * 1.1 ** np.arange(len(dates))), index=dates)
+    confirmed = confirmed.drop(pd.Timestamp("2020-04-10"))
+
+    country_data = make_country_data({"Australia": confirmed})
+
+    forecasts = forecast_utils.NumpyForecaster().forecast(country_data, horizon=7)
+
+    forecast_utils.write_forecast_store(forecasts, TIMESTAMP, backend="numpy", horizon=7)
+
+    df = forecast_utils.read_forecast("Australia", TIMESTAMP)
+
+    assert pd.Timestamp("2020-04-10") not in set(df["date"])
+    assert (df["confirmed"] > 0).all()
+    assert_same_forecast(df, forecasts["forecast"]["Australia"])
+
+
+def test_add_to_store_keeps_other_regions(data_dirs):
+    australia = make_forecast("2020-03-01", [10, 20, 40])
+    chad = make_forecast("2020-03-10", [1, 2])
+
+    first_store, _ = forecast_utils.add_to_forecast_store({"forecast": {"Australia": australia}}, TIMESTAMP)
+    second_store, _ = forecast_utils.add_to_forecast_store({"forecast": {"Chad": chad}}, TIMESTAMP)
+
+    assert_same_forecast(forecast_utils.read_forecast("Australia", TIMESTAMP), australia)
+    assert_same_forecast(forecast_utils.read_forecast("Chad", TIMESTAMP), chad)
+
+    # The index names the new store, the one it replaced is removed
+    assert not os.path.exists(first_store)
+    assert os.path.exists(second_store)
+
+
+def test_on_demand_forecasts_replace_the_manifest_entry(data_dirs):
+    dates = pd.date_range("2020-03-20", "2020-04-13")
+    country_data = make_country_data({
+        country: pd.Series(np.round(scale * 1.1 ** np.arange(len(dates))), index=dates)
+        for country, scale in [("Australia", 50), ("Chad", 5), ("Fiji", 2)]
+    })
+
+    for country in country_data.countries:
+        forecast_utils.forecast_region(country, country_data, backend="numpy")
+
+    index_fname, _ = forecast_utils.get_store_filenames(TIMESTAMP)
+    _, index = forecast_utils.load_forecast_store(TIMESTAMP)
+    store_fname = os.path.join(data_dirs["outputs"], index["store"])
+
+    entry = io_utils.read_manifest()["snapshots"][TIMESTAMP.strftime(forecast_utils.TIME_STAMP_FORMAT)]
+
+    assert entry["files"] == sorted([store_fname, index_fname])
+    assert sorted(entry["hashes"]) == entry["files"]
+    assert not any(os.path.isabs(fname) for fname in entry["files"])
+    assert entry["durations"] == {}
+    assert sorted(os.listdir(data_dirs["outputs"])) == sorted(os.path.basename(fname) for fname in entry["files"])
+
+
+def test_unchanged_regions_are_carried_over_from_the_previous_snapshot(data_dirs, monkeypatch):
+    dates = pd.date_range("2020-03-20", "2020-04-13")
+    history = {
+        country: pd.Series(np.round(scale * 1.1 ** np.arange(len(dates))), index=dates)
+        for country, scale in [("Australia", 50), ("Chad", 5)]
+    }
+    previous_data = make_country_data(history, TIMESTAMP - datetime.timedelta(hours=1))
+
+    forecast_utils.forecast(previous_data, backend="numpy")
+    io_utils.register_snapshot(previous_data.timestamp, [forecast_utils.save_region_hashes(previous_data)])
+
+    history["Australia"] = history["Australia"] + 1
+    country_data = make_country_data(history)
+
+    forecasted = []
+    forecast = forecast_utils.NumpyForecaster.forecast
+
+    def record_forecast(self, country_data, horizon=7, regions=None):
+        forecasted.append(regions)
+        return forecast(self, country_data, horizon, regions)
+
+    monkeypatch.setattr(forecast_utils.NumpyForecaster, "forecast", record_forecast)
+
+    assert forecast_utils.get_unchanged_regions(country_data) == (previous_data.timestamp, ["Chad"])
+
+    # Worked out once per snapshot, not on every request, and without scanning directories
+    def fail(*args, **kwargs):
+        raise AssertionError("previous snapshot looked up again")
+
+    monkeypatch.setattr(io_utils, "get_manifest", fail)
+    monkeypatch.setattr(glob, "glob", fail)
+
+    australia = forecast_utils.forecast_region("Australia", country_data, backend="numpy")
+    chad = forecast_utils.forecast_region("Chad", country_data, backend="numpy")
+
+    assert forecasted == [["Australia"]]
+    assert_same_forecast(australia, forecast(forecast_utils.NumpyForecaster(), country_data, 7)["forecast"]["Australia"])
+    assert_same_forecast(chad, forecast_utils.read_forecast("Chad", previous_data.timestamp))
+
+
+def test_model_cache_is_bounded_by_the_loaded_arrays():
+    loaded = [
+        types.SimpleNamespace(params={"k": np.zeros(1000)}, history=pd.DataFrame({"y": np.zeros(1000)}), name="m")
+        for _ in range(3)
+    ]
+    num_bytes = forecast_utils.get_model_bytes(loaded[0])
+
+    assert num_bytes >= 2 * 8 * 1000
+
+    cache = forecast_utils.ModelCache(max_bytes=int(2.5 * num_bytes))
+    for k, model in enumerate(loaded):
+        cache.put("model_{}.npz".format(k), model, forecast_utils.get_model_bytes(model))
+
+    assert cache.get("model_0.npz") is None
+    assert cache.get("model_2.npz") is loaded[2]
+    assert cache.stats()["bytes"] == 2 * num_bytes
+
+
+@pytest.mark.parametrize("method", ["log_linear", "gompertz"])
+def test_growth_curves_are_extrapolated_exactly(method):
+    t = np.arange(30, dtype=np.float64)
+    exponential = 50 * 1.1 ** t
+    # log(log(N / y)) is linear in t, i.e. daily growth of log cases slowing down exponentially
+    gompertz = 1e5 * np.exp(-5 * np.exp(-0.1 * t))
+    curve = exponential if method == "log_linear" else gompertz
+
+    predicted, lower, upper = forecast_utils.forecast_growth(curve[:23, np.newaxis], 7, method)
+
+    np.testing.assert_allclose(predicted[:, 0], curve[23:], rtol=1e-6)
+    assert (lower <= predicted).all() and (predicted <= upper).all()
+
+
+def test_growth_curves_of_regions_are_fitted_independently():
+    t = np.arange(20, dtype=np.float64)
+    confirmed = np.stack([50 * 1.1 ** t, 1e4 * np.exp(-3 * np.exp(-0.05 * t)), np.full(20, 7.0)], axis=1)
+    confirmed[10, 0] = np.nan
+
+    together = forecast_utils.forecast_growth(confirmed, 7)
+
+    for k in range(confirmed.shape[1]):
+        alone = forecast_utils.forecast_growth(confirmed[:, [k]], 7)
+        for actual, expected in zip(together, alone):
+            np.testing.assert_allclose(actual[:, k], expected[:, 0])
@@ -0,0 +1,82 @@
+"""
+The manifest of snapshots and the caches keyed by file versions.
+"""
+
+import datetime
+import os
+import pickle
+import threading
+
+import data.constants as constants
+import data.io_utils as io_utils
+
+TIMESTAMP = datetime.datetime(2020, 4, 14, 9, 30)
+
+
+def set_mtime(fname, mtime_ns):
+    os.utime(fname, ns=(mtime_ns, mtime_ns))
+
+
+def test_register_snapshot_records_files_and_latest(data_dirs):
+    fname = os.path.join(data_dirs["processed"], "country_data_14-04-2020-09-30-00.pickle")
+    with open(fname, "wb") as handle:
+        pickle.dump({"Australia": 1}, handle)
+
+    io_utils.register_snapshot(TIMESTAMP, [fname], durations={"fetch": 1.5}, latest=True)
+    io_utils.register_snapshot(TIMESTAMP, durations={"models": 2.0})
+
+    manifest = io_utils.read_manifest()
+    entry = manifest["snapshots"]["14-04-2020-09-30-00"]
+
+    assert manifest["latest"] == "14-04-2020-09-30-00"
+    assert entry["files"] == [fname]
+    assert entry["hashes"] == {fname: io_utils.get_file_hash(fname)}
+    assert entry["durations"] == {"fetch": 1.5, "models": 2.0}
+    assert io_utils.get_latest_timestamp() == TIMESTAMP
+
+
+def test_concurrent_updates_are_not_lost(data_dirs):
+    def register(i):
+        for j in range(10):
+            io_utils.register_snapshot(TIMESTAMP + datetime.timedelta(minutes=10 * i + j))
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(io_utils.read_manifest()["snapshots"]) == 40
+    assert os.listdir(data_dirs["processed"]) == ["manifest.json"]
+
+
+def test_get_manifest_sees_rewrites_within_the_mtime_resolution(data_dirs):
+    io_utils.register_snapshot(TIMESTAMP, latest=True)
+    mtime_ns = os.stat(constants.MANIFEST_PATH).st_mtime_ns
+
+    assert io_utils.get_manifest()["latest"] == "14-04-2020-09-30-00"
+
+    later = TIMESTAMP + datetime.timedelta(hours=1)
+    io_utils.register_snapshot(later, latest=True)
+    set_mtime(constants.MANIFEST_PATH, mtime_ns)
+
+    assert io_utils.get_latest_timestamp() == later
+
+
+def test_snapshot_cache_reloads_rewritten_pickles(data_dirs):
+    fname = os.path.join(data_dirs["processed"], "country_data.pickle")
+    cache = io_utils.SnapshotCache(max_size=2)
+
+    with open(fname, "wb") as handle:
+        pickle.dump({"Australia": 1}, handle)
+    mtime_ns = os.stat(fname).st_mtime_ns
+
+    assert cache.load(fname) == {"Australia": 1}
+    assert cache.load(fname) is cache.load(fname)
+
+    with open(fname, "wb") as handle:
+        pickle.dump({"Australia": 1, "Chad": 2}, handle)
+    set_mtime(fname, mtime_ns)
+
+    assert cache.load(fname) == {"Australia": 1, "Chad": 2}
+    assert cache.stats()["misses"] == 2
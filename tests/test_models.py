@@ -0,0 +1,199 @@
+"""
+Parity of the vectorised SIR engine with the original list-based loop of SIRModel.predict.
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+
+import data.constants as constants
+import models
+
+
+def reference_predict(model, susceptible, infected, recovered, dead, num_days):
+    """
+    The day by day loop SIRModel.predict ran before integrate_sir, kept as the reference the engine must reproduce.
+    """
+
+    normal_death_rate = model._normal_death_rate
+
+    population = susceptible + infected + recovered + dead
+
+    S = [int(susceptible)]
+    I = [int(infected)]
+    R = [int(recovered)]
+    D = [int(dead)]
+    H = [round(model._hospitalization_rate * infected)]
+    T = [int(infected) + int(recovered) + int(dead)]
+
+    if int(dead) > 0:
+        normal_death_rate = int(dead) / int(infected)
+
+    for t in range(num_days):
+
+        if I[-1] > 0:
+            underserved_critically_ill_proportion = max(0, H[-1] - model._hospital_capacity) / I[-1]
+        else:
+            underserved_critically_ill_proportion = 0
+        weighted_death_rate = (
+            normal_death_rate * (1 - underserved_critically_ill_proportion)
+            + model._critical_death_rate * underserved_critically_ill_proportion
+        )
+
+        s_t = S[-1] - model._infection_rate * I[-1] * S[-1] / population
+        i_t = (
+            I[-1]
+            + model._infection_rate * I[-1] * S[-1] / population
+            - (weighted_death_rate + model._recovery_rate) * I[-1]
+        )
+        r_t = R[-1] + model._recovery_rate * I[-1]
+        d_t = D[-1] + weighted_death_rate * I[-1]
+
+        h_t = model._hospitalization_rate * i_t
+
+        t_c = i_t + r_t + d_t
+
+        S.append(round(s_t))
+        I.append(round(i_t))
+        R.append(round(r_t))
+        D.append(round(d_t))
+        H.append(round(h_t))
+        T.append(round(t_c))
+
+    return {
+        "Susceptible": S,
+        "Infected": I,
+        "Recovered": R,
+        "Dead": D,
+        "Need Hospitalization": H,
+        "Total Cases": T,
+    }
+
+
+# Population, confirmed, recovered, dead, hospital beds
+SCENARIOS = [
+    (24600000, 6000, 3000, 60, 91683),
+    (511000, 220, 100, 13, 2008),
+    (231200, 28, 0, 0, 908),
+    (50000000, 100000, 20000, 900, 1000),
+]
+
+
+def get_model(contact_rate, hospital_capacity):
+    return models.SIRModel(
+        transmission_rate_per_contact=constants.TransmissionRatePerContact.default,
+        contact_rate=contact_rate,
+        recovery_rate=constants.RecoveryRate.default,
+        normal_death_rate=constants.MortalityRate.default,
+        critical_death_rate=constants.CriticalDeathRate.default,
+        hospitalization_rate=constants.HospitalizationRate.default,
+        hospital_capacity=hospital_capacity,
+    )
+
+
+@pytest.mark.parametrize("contact_rate", [0, 5, 20])
+@pytest.mark.parametrize("population,confirmed,recovered,dead,beds", SCENARIOS)
+def test_predict_matches_reference_loop(contact_rate, population, confirmed, recovered, dead, beds):
+    model = get_model(contact_rate, beds)
+
+    infected = models.TrueInfectedCasesModel(constants.ReportingRate.default).predict(confirmed)
+
+    state = dict(
+        susceptible=population - infected - recovered - dead,
+        infected=infected,
+        recovered=recovered,
+        dead=dead,
+        num_days=730,
+    )
+
+    expected = reference_predict(model, **state)
+
+    predictions = model.predict(**state, rounded=True, early_stop=False)
+
+    for status in models._STATUSES_TO_SHOW:
+        np.testing.assert_array_equal(predictions[status], np.array(expected[status], dtype=np.float64), status)
+
+
+def test_age_groups_add_up_to_sir_under_proportionate_mixing():
+    _, rates = models.get_age_group_rates(["Victoria"])
+    proportion = rates["Proportion"][0]
+    num_groups = len(proportion)
+    state = dict(susceptible=6e6, infected=1e4, recovered=100, dead=50, num_days=365)
+    recovery_rate, critical_death_rate = constants.RecoveryRate.default, constants.CriticalDeathRate.default
+
+    expected = models.integrate_sir(
+        infection_rate=0.3, recovery_rate=recovery_rate, normal_death_rate=0.01 * recovery_rate,
+        critical_death_rate=critical_death_rate * recovery_rate, hospitalization_rate=0.05, hospital_capacity=5000,
+        rounded=False, **state
+    )
+
+    model = models.AgeStructuredSIRModel(
+        0.3, 1, recovery_rate, critical_death_rate, proportion, np.full(num_groups, 0.05), np.full(num_groups, 0.01),
+        5000,
+    )
+    predictions = models.sum_age_groups(model.predict(**state))
+
+    for status, values in expected.items():
+        np.testing.assert_allclose(predictions[status], values, rtol=1e-9, atol=1e-6, err_msg=status)
+
+
+def test_uncoupled_regions_match_the_sir_engine():
+    population = np.array([6e6, 4e6, 1e5])
+    state = dict(infected=np.array([1e4, 100, 0]), recovered=np.array([10, 0, 0]), dead=np.array([5, 0, 0]))
+    state["susceptible"] = population - state["infected"] - state["recovered"] - state["dead"]
+    rates = dict(
+        infection_rate=0.25, recovery_rate=0.1, normal_death_rate=0.001, critical_death_rate=0.0122,
+        hospitalization_rate=0.03, hospital_capacity=np.array([20000, 500, 50]),
+    )
+
+    expected = models.integrate_sir(num_days=400, rounded=False, **state, **rates)
+    predictions = models.integrate_metapopulation_sir(num_days=400, **state, **rates)
+
+    for status, values in expected.items():
+        np.testing.assert_allclose(predictions[status], values, err_msg=status)
+
+
+def test_travel_spreads_infection_and_keeps_population():
+    population = np.array([6e6, 4e6, 1e5])
+    infected = np.array([1e4, 0, 0])
+    coupling = models.get_coupling_matrix(models.get_gravity_trips(population, 0.01), population)
+
+    np.testing.assert_allclose(np.asarray(coupling.sum(axis=1)).ravel(), 1)
+
+    predictions = models.MetapopulationSIRModel(
+        0.018, 15, 0.1, 0.01, 0.122, 0.03, population * 0.004, coupling=coupling
+    ).predict(population - infected, infected, 0, 0, 400)
+
+    assert (predictions["Total Cases"][1:, -1] > 1000).all()
+    total = sum(predictions[status] for status in ["Susceptible", "Infected", "Recovered", "Dead"])
+    np.testing.assert_allclose(total, np.broadcast_to(population[:, np.newaxis], total.shape))
+
+
+def test_prediction_cache_is_keyed_by_parameters_and_snapshot():
+    cache = models.PredictionCache(max_size=2)
+    first, second = datetime.datetime(2020, 4, 14, 9), datetime.datetime(2020, 4, 14, 10)
+
+    def predict(contact_rate, timestamp):
+        return models.get_predictions(
+            cases_estimator=models.TrueInfectedCasesModel(constants.ReportingRate.default),
+            sir_model=get_model(contact_rate, 20000),
+            num_diagnosed=3000, num_recovered=300, num_deaths=30, area_population=2.5e7, max_days=60,
+            region="Australia", timestamp=timestamp, cache=cache,
+        )
+
+    predictions = predict(10, first)
+
+    # Cached rows are shared with every caller, so nobody may write to them
+    with pytest.raises(ValueError):
+        predictions.values[0, 0] = -1
+
+    np.testing.assert_array_equal(predict(10, first).values, predictions.values)
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    assert not np.array_equal(predict(5, first).values, predict(10, first).values)
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 2}
+
+    # A new snapshot drops the entries of the previous one
+    predict(10, second)
+    assert cache.stats() == {"hits": 2, "misses": 3, "size": 1}
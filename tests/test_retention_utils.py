@@ -0,0 +1,101 @@
+"""
+Retention of snapshot files and the manifest entries that track them.
+"""
+
+import datetime
+import errno
+import json
+import os
+
+import pytest
+
+import data.constants as constants
+import data.io_utils as io_utils
+import data.retention_utils as retention_utils
+
+TIMESTAMPS = [datetime.datetime(2020, 4, day, hour) for day in (10, 11, 12) for hour in (9, 21)]
+
+
+@pytest.fixture
+def snapshots(data_dirs):
+    for timestamp in TIMESTAMPS:
+        suffix = timestamp.strftime(retention_utils.TIME_STAMP_FORMAT)
+        for name in ["processed", "models"]:
+            with open(os.path.join(data_dirs[name], "snapshot_{}.pkl".format(suffix)), "w") as handle:
+                handle.write(suffix)
+    return data_dirs
+
+
+def get_suffixes(timestamps):
+    return sorted(timestamp.strftime(retention_utils.TIME_STAMP_FORMAT) for timestamp in timestamps)
+
+
+def test_select_retained_keeps_latest_and_daily_checkpoints():
+    retained, checkpoints = retention_utils.select_retained(TIMESTAMPS, num_latest=1, num_days=2)
+
+    assert checkpoints == {datetime.datetime(2020, 4, 12, 21), datetime.datetime(2020, 4, 11, 21)}
+    assert retained == checkpoints
+
+
+def test_apply_retention_deletes_expired_snapshots(snapshots):
+    expired = retention_utils.apply_retention(num_latest=2, num_days=2, archive=False)
+
+    assert expired == TIMESTAMPS[:3]
+    assert sorted(retention_utils.get_snapshot_files()) == TIMESTAMPS[3:]
+    assert os.listdir(snapshots["archive"]) == []
+
+    manifest = io_utils.read_manifest()
+    assert sorted(manifest["snapshots"]) == get_suffixes(TIMESTAMPS[3:])
+    for entry in manifest["snapshots"].values():
+        assert all(os.path.exists(fname) for fname in entry["files"])
+
+
+def test_apply_retention_archives_across_filesystems(snapshots, monkeypatch):
+    rename = os.rename
+
+    def rename_across_devices(src, dst):
+        # Like the bind mounted data directories of docker-compose, which os.rename can't move out of
+        if os.path.abspath(dst).startswith(os.path.abspath(snapshots["archive"])):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", rename_across_devices)
+
+    # A copy left behind by an earlier attempt doesn't stop the snapshot being archived
+    suffix = TIMESTAMPS[0].strftime(retention_utils.TIME_STAMP_FORMAT)
+    os.makedirs(os.path.join(snapshots["archive"], suffix, "models"))
+
+    expired = retention_utils.apply_retention(num_latest=2, num_days=2, archive=True)
+
+    assert expired == TIMESTAMPS[:3]
+    assert sorted(os.listdir(snapshots["archive"])) == get_suffixes(TIMESTAMPS[:3])
+    assert sorted(os.listdir(os.path.join(snapshots["archive"], suffix))) == ["models", "processed"]
+    with open(os.path.join(snapshots["archive"], suffix, "processed", "snapshot_{}.pkl".format(suffix))) as handle:
+        assert handle.read() == suffix
+
+
+def test_failed_expiry_stays_in_manifest_until_retried(snapshots, monkeypatch):
+    remove = os.remove
+    stuck = os.path.join(snapshots["models"], "snapshot_{}.pkl".format(
+        TIMESTAMPS[0].strftime(retention_utils.TIME_STAMP_FORMAT)
+    ))
+
+    def remove_unless_stuck(fname):
+        if fname == stuck:
+            raise PermissionError(errno.EACCES, "Permission denied")
+        remove(fname)
+
+    monkeypatch.setattr(os, "remove", remove_unless_stuck)
+
+    assert retention_utils.apply_retention(num_latest=2, num_days=2, archive=False) == TIMESTAMPS[1:3]
+
+    with open(constants.MANIFEST_PATH) as handle:
+        entries = json.load(handle)["snapshots"]
+
+    assert sorted(entries) == get_suffixes([TIMESTAMPS[0]] + TIMESTAMPS[3:])
+    assert entries[get_suffixes([TIMESTAMPS[0]])[0]]["files"] == [stuck]
+
+    monkeypatch.setattr(os, "remove", remove)
+
+    assert retention_utils.apply_retention(num_latest=2, num_days=2, archive=False) == [TIMESTAMPS[0]]
+    assert sorted(io_utils.read_manifest()["snapshots"]) == get_suffixes(TIMESTAMPS[3:])
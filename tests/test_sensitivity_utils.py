@@ -0,0 +1,52 @@
+"""
+Sampling and estimators of the sensitivity analysis.
+"""
+
+import numpy as np
+import pytest
+
+import sensitivity_utils
+
+REGION = dict(num_diagnosed=6000, num_recovered=3000, num_deaths=60, area_population=24.6e6, hospital_capacity=91683)
+
+
+def test_evaluate_does_not_depend_on_chunking():
+    lower, upper = sensitivity_utils.get_parameter_ranges()
+    samples = lower + (upper - lower) * np.random.default_rng(0).random((50, len(lower)))
+
+    expected = sensitivity_utils.evaluate(samples, sensitivity_utils.PARAMETERS, num_days=200, chunk_size=50, **REGION)
+    outputs = sensitivity_utils.evaluate(samples, sensitivity_utils.PARAMETERS, num_days=200, chunk_size=7, **REGION)
+
+    for output in sensitivity_utils.OUTPUTS:
+        np.testing.assert_allclose(outputs[output], expected[output], err_msg=output)
+
+
+def test_sobol_indices_of_a_linear_model(monkeypatch):
+    # For y = sum c_k x_k of independent uniform x_k on [0, 1], both indices of x_k are c_k^2 / sum c^2
+    coefficients = np.array([1, 2, 0, 3])
+
+    def evaluate(samples, parameters, **kwargs):
+        return {output: samples @ coefficients for output in sensitivity_utils.OUTPUTS}
+
+    monkeypatch.setattr(sensitivity_utils, "evaluate", evaluate)
+    monkeypatch.setattr(sensitivity_utils, "get_parameter_ranges", lambda parameters: (np.zeros(4), np.ones(4)))
+
+    indices = sensitivity_utils.analyse(**REGION, num_samples=2 ** 14, method="sobol", seed=1)
+
+    expected = coefficients ** 2 / (coefficients ** 2).sum()
+    for output in sensitivity_utils.OUTPUTS:
+        np.testing.assert_allclose(indices.loc[output, "First Order"], expected, atol=0.02)
+        np.testing.assert_allclose(indices.loc[output, "Total Order"], expected, atol=0.02)
+
+
+def test_rank_correlations_follow_the_model():
+    correlations = sensitivity_utils.analyse(**REGION, num_samples=200, method="lhs", num_days=200, seed=0)
+
+    # Recovering sooner leaves fewer people ill at the peak
+    assert correlations.loc[("Peak Need Hospitalization", "RecoveryRate"), "Rank Correlation"] < 0
+    assert correlations.loc[("Peak Need Hospitalization", "HospitalizationRate"), "Rank Correlation"] > 0
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        sensitivity_utils.analyse(**REGION, num_samples=8, method="morris")